@@ -0,0 +1,254 @@
+#
+# aio.py - asyncio command orchestration for the installers
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Runs installer commands as asyncio coroutines
+
+The installers run on a utils.async worker thread. run_until_complete()
+gives that thread its own event loop, on which any number of commands
+started with run_command() can run at once, each with its own timeout,
+output callback and cancellation.
+
+.. code::
+
+    @asyncio.coroutine
+    def step(self):
+        yield from aio.check_command(['usermod', '-a', '-G', 'libvirtd',
+                                      'maas'], error=MaasInstallError)
+
+    aio.run_until_complete(aio.gather(self.step(), other_step()))
+"""
+
+import asyncio
+from collections import deque
+import logging
+import os
+import signal
+import threading
+import time
+
+from cloudinstall.process import (ProcessResult, TIMEOUT_STATUS,
+                                  NOT_FOUND_STATUS, DEFAULT_TAIL_LINES,
+                                  KILL_GRACE)
+from cloudinstall.trace import tracer
+
+log = logging.getLogger('cloudinstall.aio')
+
+
+class CommandError(Exception):
+    """ A command exited with a non-zero status """
+
+    def __init__(self, msg, result):
+        super().__init__(msg)
+        self.result = result
+
+
+class _ThreadedChildWatcher(asyncio.AbstractChildWatcher):
+    """ Waits for each child process on its own thread.
+
+    The default child watchers rely on a SIGCHLD handler, which can only
+    be installed by the main thread, and that one runs the urwid loop.
+    Newer Pythons ship an equivalent ThreadedChildWatcher.
+    """
+
+    def add_child_handler(self, pid, callback, *args):
+        loop = asyncio.get_event_loop()
+
+        def wait():
+            _, status = os.waitpid(pid, 0)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            loop.call_soon_threadsafe(callback, pid, returncode, *args)
+
+        t = threading.Thread(target=wait, name="waitpid-{}".format(pid))
+        t.daemon = True
+        t.start()
+
+    def remove_child_handler(self, pid):
+        return False
+
+    def attach_loop(self, loop):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def run_until_complete(coro_or_future):
+    """ Runs a coroutine to completion on a new event loop owned by the
+    calling thread
+
+    :returns: the coroutine's result
+    """
+    if not hasattr(asyncio, 'ThreadedChildWatcher') and \
+       not isinstance(asyncio.get_child_watcher(), _ThreadedChildWatcher):
+        asyncio.set_child_watcher(_ThreadedChildWatcher())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro_or_future)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def _killpg(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass
+
+
+@asyncio.coroutine
+def run_command(argv, timeout=None, user=None, env=None, on_line=None,
+                tail_lines=DEFAULT_TAIL_LINES, log_output=True):
+    """ Coroutine running argv, without a shell
+
+    Takes the same arguments as process.run. If the coroutine is
+    cancelled the command and its children are killed.
+
+    :rtype: process.ProcessResult, cpu_time is not measured
+    """
+    argv = list(argv)
+    if user:
+        argv = ['sudo', '-H', '-u', user] + argv
+    cmd_env = os.environ.copy()
+    cmd_env.update(env or {})
+    cmd_env['LC_ALL'] = 'C'
+
+    start = time.time()
+    try:
+        p = yield from asyncio.create_subprocess_exec(
+            *argv, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT, env=cmd_env,
+            start_new_session=True)
+    except OSError as e:
+        log.debug("Unable to run {}: {}".format(argv, e))
+        return ProcessResult(argv, NOT_FOUND_STATUS, '', 0, 0.0, 0.0, False)
+
+    tail = deque(maxlen=tail_lines)
+    count = 0
+    name = os.path.basename(argv[0])
+
+    @asyncio.coroutine
+    def read_output():
+        nonlocal count
+        while True:
+            raw = yield from p.stdout.readline()
+            if not raw:
+                break
+            line = raw.decode('utf-8', 'replace')
+            tail.append(line)
+            count += 1
+            if log_output:
+                log.debug("{}[{}]: {}".format(name, p.pid,
+                                              line.rstrip('\n')))
+            if on_line:
+                try:
+                    on_line(line)
+                except Exception:
+                    log.exception("Error handling output of "
+                                  "{}".format(argv))
+        yield from p.wait()
+
+    timed_out = False
+    try:
+        yield from asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        log.warning("Killing {} after {}s".format(argv, timeout))
+        timed_out = True
+        _killpg(p.pid, signal.SIGTERM)
+        try:
+            yield from asyncio.wait_for(p.wait(), KILL_GRACE)
+        except asyncio.TimeoutError:
+            _killpg(p.pid, signal.SIGKILL)
+            yield from p.wait()
+    except asyncio.CancelledError:
+        log.debug("Cancelled, killing {}".format(argv))
+        _killpg(p.pid, signal.SIGKILL)
+        yield from p.wait()
+        raise
+
+    status = TIMEOUT_STATUS if timed_out else p.returncode
+    end = time.time()
+    tracer.complete('process', 'cmd', start, end, argv=argv[:20],
+                    status=status)
+    log.debug("{} exited {} after {:.2f}s ({} lines)".format(
+        argv, status, end - start, count))
+    return ProcessResult(argv, status, ''.join(tail), count, end - start,
+                         0.0, timed_out)
+
+
+@asyncio.coroutine
+def check_command(argv, error=CommandError, message=None, **kwargs):
+    """ Coroutine running argv like run_command, raising error if it
+    exits with a non-zero status
+
+    :param error: exception class, called with the message and, for
+                  CommandError, the ProcessResult
+    :param str message: message for the exception, by default the
+                        command, its status and the end of its output
+    :rtype: process.ProcessResult
+    """
+    result = yield from run_command(argv, **kwargs)
+    if result.status != 0:
+        detail = "{} failed with status {}: {}".format(
+            " ".join(result.argv), result.status, result.output[-1000:])
+        log.debug(detail)
+        if error is CommandError:
+            raise CommandError(message or detail, result)
+        raise error(message or detail)
+    return result
+
+
+@asyncio.coroutine
+def gather(*coros):
+    """ Coroutine running coros, or waiting for futures, concurrently
+
+    Unlike asyncio.gather, the first exception cancels the coroutines
+    still running before it is raised.
+
+    :returns: list of results, in the order of coros
+    """
+    loop = asyncio.get_event_loop()
+    tasks = [c if isinstance(c, asyncio.Future) else loop.create_task(c)
+             for c in coros]
+    done, pending = yield from asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for t in pending:
+        t.cancel()
+    if pending:
+        yield from asyncio.wait(pending)
+    for t in done:
+        if t.exception() is not None:
+            raise t.exception()
+    return [t.result() for t in tasks]
+
+
+@asyncio.coroutine
+def run_in_thread(fn, *args):
+    """ Coroutine running a blocking fn(*args) on the default executor """
+    return (yield from asyncio.get_event_loop().run_in_executor(
+        None, fn, *args))
@@ -0,0 +1,207 @@
+#
+# aptcache.py - Local caching apt proxy
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Runs apt-cacher-ng on the host so packages are downloaded once
+
+The host, the containers and the machines the installer creates fetch
+packages through the proxy. Its cache in /var/cache/apt-cacher-ng is
+left alone by uninstalling, so repeat installs download no packages.
+
+The proxy's transfer log tells how much of what it served came from the
+cache.
+"""
+
+import logging
+import os
+import socket
+import time
+
+from cloudinstall import utils
+
+log = logging.getLogger('cloudinstall.aptcache')
+
+APT_CACHER_PORT = 3142
+
+# apt configuration pointing the host at the proxy
+HOST_PROXY_CONF = '/etc/apt/apt.conf.d/02cloud-install-proxy'
+
+# Run by apt to pick the proxy, so the host goes direct whenever
+# apt-cacher-ng is stopped or removed
+HOST_PROXY_DETECT = '/etc/apt/cloud-install-proxy-detect'
+
+HOST_PROXY_DETECT_SCRIPT = """#!/bin/bash
+# Written by cloud-install: use its apt cache only while it is up
+if (exec 3<>/dev/tcp/127.0.0.1/{port}) 2>/dev/null; then
+    echo http://127.0.0.1:{port}
+else
+    echo DIRECT
+fi
+"""
+
+# apt-cacher-ng reads every .conf file in its configuration directory
+ACNG_CONF = '/etc/apt-cacher-ng/zz_cloud_install.conf'
+
+# https hosts the nodes and MAAS reach through the proxy, for boot
+# images and PPAs. CONNECTs anywhere else are refused, so this is no
+# open relay.
+PASS_THROUGH_HOSTS = ['maas.ubuntu.com', 'images.maas.io',
+                      'cloud-images.ubuntu.com', 'launchpad.net',
+                      'ppa.launchpad.net', 'keyserver.ubuntu.com']
+
+# MAAS also fetches boot images through its http_proxy: let their
+# simplestreams metadata and files through, but keep them out of the
+# cache. They already are in the installer's boot image cache, which
+# MAAS imports from.
+ACNG_SETTINGS = (
+    "PassThroughPattern: ^({}):443$\n".format(
+        "|".join(h.replace('.', '\\.') for h in PASS_THROUGH_HOSTS)) +
+    "VfilePatternEx: /streams/v1/[^/]+\\.s?json$\n"
+    "PfilePatternEx: /(boot-kernel|boot-initrd|root-image\\.gz|root-tgz|"
+    "di-kernel|di-initrd)$\n"
+    "DontCache: /cloud-install-images/|/streams/v1/[^/]+\\.s?json$|"
+    "/(boot-kernel|boot-initrd|root-image\\.gz|root-tgz|di-kernel|"
+    "di-initrd)$\n")
+
+ACNG_LOG = '/var/log/apt-cacher-ng/apt-cacher.log'
+
+# Seconds to wait for the proxy to accept connections once started
+START_TIMEOUT = 30
+
+
+def proxy_url(address):
+    """ URL of the proxy at address, for apt and juju """
+    return "http://{}:{}".format(address, APT_CACHER_PORT)
+
+
+def listening(address='127.0.0.1', timeout=2):
+    """ True if the proxy accepts connections at address """
+    try:
+        with socket.create_connection((address, APT_CACHER_PORT),
+                                      timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def is_installed():
+    out = utils.get_command_output(
+        "dpkg-query -W -f='${Status}' apt-cacher-ng")
+    return out['status'] == 0 and 'install ok installed' in out['output']
+
+
+def settings(addresses=()):
+    """ apt-cacher-ng configuration, listening on localhost and on
+    addresses only
+
+    Any http_proxy of the installer's environment becomes the proxy's
+    own upstream proxy.
+    """
+    conf = "BindAddress: {}\n".format(
+        " ".join(["localhost"] + list(addresses)))
+    conf += ACNG_SETTINGS
+    upstream = os.environ.get('http_proxy')
+    if upstream:
+        conf += "Proxy: {}\n".format(upstream)
+    return conf
+
+
+def start(addresses=()):
+    """ Installs and starts apt-cacher-ng, or reuses a running one.
+
+    The proxy is restarted if it needs to listen on other addresses.
+
+    :param addresses: bridge addresses the containers or nodes reach
+                      the host at, besides localhost
+    :returns: True if the proxy is up
+    """
+    if not is_installed():
+        utils.apt_install('apt-cacher-ng')
+        if not is_installed():
+            log.warning("Unable to install apt-cacher-ng, packages "
+                        "will not be cached")
+            return False
+    conf = settings(addresses)
+    try:
+        changed = utils.slurp(ACNG_CONF) != conf.strip()
+    except IOError:
+        changed = True
+    if changed:
+        utils.spew(ACNG_CONF, conf)
+    elif listening():
+        return True
+    utils.get_command_output('service apt-cacher-ng restart')
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if listening():
+            log.info("apt-cacher-ng is listening on port "
+                     "{}".format(APT_CACHER_PORT))
+            return True
+        time.sleep(0.5)
+    log.warning("apt-cacher-ng did not start, packages will not be cached")
+    return False
+
+
+def transfer_stats(since=0, log_file=ACNG_LOG):
+    """ Bytes the proxy served to clients and fetched from upstream
+
+    :param since: only count transfers after this time
+    :returns: (served, fetched), 0s if there is no log
+    """
+    served = fetched = 0
+    try:
+        with open(log_file) as f:
+            for line in f:
+                # time|I or O|bytes|client|path, I is fetched, O served
+                fields = line.split('|')
+                if len(fields) < 3 or not fields[0].isdigit() or \
+                   int(fields[0]) < since or not fields[2].isdigit():
+                    continue
+                if fields[1] == 'O':
+                    served += int(fields[2])
+                elif fields[1] == 'I':
+                    fetched += int(fields[2])
+    except IOError:
+        pass
+    return (served, fetched)
+
+
+def format_stats(served, fetched):
+    """ eg "apt cache: 92% hit rate, 812 MB served, 64 MB downloaded",
+    None if nothing was served
+    """
+    if served == 0:
+        return None
+    hit_rate = max(0.0, 1 - fetched / served)
+    return "apt cache: {:.0f}% hit rate, {:.0f} MB served, {:.0f} MB " \
+        "downloaded".format(hit_rate * 100, served / 1024 / 1024,
+                            fetched / 1024 / 1024)
+
+
+def summary(since=0, log_file=ACNG_LOG):
+    """ format_stats() of the transfers after since """
+    return format_stats(*transfer_stats(since, log_file))
+
+
+def use_on_host():
+    """ Points the host's apt at the proxy while it is listening """
+    utils.spew(HOST_PROXY_DETECT,
+               HOST_PROXY_DETECT_SCRIPT.format(port=APT_CACHER_PORT))
+    os.chmod(HOST_PROXY_DETECT, 0o755)
+    utils.spew(HOST_PROXY_CONF,
+               'Acquire::http::Proxy-Auto-Detect "{}";\n'.format(
+                   HOST_PROXY_DETECT))
@@ -0,0 +1,154 @@
+#
+# charm_manifest.py - Static charm metadata
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Static charm metadata
+
+Placement and status rendering only need the class attributes of each
+charm. Those are recorded in charms/manifest.yaml (see
+tools/gen-charm-manifest) so that the charm modules themselves are only
+imported once one of their deploy/set_relations/post_proc hooks is
+needed. This module lives outside the charms package so that reading
+the manifest does not import the package either.
+"""
+
+from importlib import import_module
+import logging
+from os import path
+import yaml
+
+from cloudinstall.placement.controller import AssignmentType
+
+log = logging.getLogger('cloudinstall.charm_manifest')
+
+MANIFEST_FILENAME = path.join(path.dirname(__file__), 'charms',
+                              'manifest.yaml')
+
+# Class attributes recorded for every charm, in manifest order.
+MANIFEST_KEYS = ['charm_name', 'display_name', 'related',
+                 'deploy_prerequisites', 'isolate',
+                 'constraints', 'deploy_priority', 'display_priority',
+                 'allow_multi_units', 'allowed_assignment_types',
+                 'optional', 'disabled', 'menuable', 'from_charm_store']
+
+_manifest = None
+
+# libyaml parses the manifest several times faster, when it is installed
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def charm_metadata(charm_class):
+    """ Returns the manifest record for a charm class
+
+    :param charm_class: subclass of CharmBase
+    :rtype: dict
+    """
+    md = {k: getattr(charm_class, k) for k in MANIFEST_KEYS}
+    md['related'] = list(md['related'])
+    md['deploy_prerequisites'] = list(md['deploy_prerequisites'])
+    md['constraints'] = dict(md['constraints'])
+    md['allowed_assignment_types'] = [at.name for at in
+                                      md['allowed_assignment_types']]
+    md['name'] = charm_class.name()
+    # required_num_units may depend on runtime charm config, in which
+    # case the charm module is imported to answer it.
+    if 'required_num_units' in vars(charm_class):
+        md['required_num_units'] = None
+    else:
+        md['required_num_units'] = charm_class.required_num_units()
+    return md
+
+
+class CharmManifestEntry:
+    """ Stands in for a charm class using only its recorded metadata.
+
+    Calling the entry imports the charm module and instantiates the
+    real charm class, so it can be passed anywhere a charm class is
+    expected.
+    """
+
+    def __init__(self, module_name, metadata):
+        self.module_name = module_name
+        self.metadata = metadata
+        self._charm_class = None
+
+    @property
+    def charm_class(self):
+        """ Imports and returns the real charm class """
+        if self._charm_class is None:
+            log.debug("Importing charm module {}".format(self.module_name))
+            m = import_module('cloudinstall.charms.' + self.module_name)
+            self._charm_class = m.__charm_class__
+        return self._charm_class
+
+    def __getattr__(self, attr):
+        if attr == 'metadata':
+            raise AttributeError(attr)
+        if attr in self.metadata:
+            return self.metadata[attr]
+        return getattr(self.charm_class, attr)
+
+    @property
+    def allowed_assignment_types(self):
+        return [AssignmentType.__members__[n] for n in
+                self.metadata['allowed_assignment_types']]
+
+    def name(self):
+        return self.metadata['name']
+
+    def required_num_units(self):
+        n = self.metadata['required_num_units']
+        if n is None:
+            return self.charm_class.required_num_units()
+        return n
+
+    def __call__(self, *args, **kwargs):
+        return self.charm_class(*args, **kwargs)
+
+    def __eq__(self, other):
+        if isinstance(other, CharmManifestEntry):
+            return self.charm_name == other.charm_name
+        if isinstance(other, type):
+            return self.charm_name == getattr(other, 'charm_name', None)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __hash__(self):
+        return hash(self.charm_name)
+
+    def __repr__(self):
+        return self.name()
+
+
+def load_manifest():
+    """ Reads manifest.yaml, once per process
+
+    :returns: manifest entries in the order of the charm modules
+    :rtype: list of CharmManifestEntry
+    """
+    global _manifest
+    if _manifest is None:
+        with open(MANIFEST_FILENAME) as f:
+            records = yaml.load(f, Loader=SafeLoader)
+        _manifest = [CharmManifestEntry(r['module'], r['metadata'])
+                     for r in records]
+    return _manifest
@@ -0,0 +1,252 @@
+#
+# charmrepo.py - Local mirror of charm store charms
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fetches the charms an install deploys before deploying them
+
+The revisions of all the charms are resolved with one charm store
+request, and the archives that are not cached yet are downloaded in
+parallel. Archives are kept by revision under archives/ in the local
+charm repository, and are uploaded to the state server so that services
+are deployed from local: charm urls instead of each deploy fetching its
+charm from the store.
+
+Resolved revisions are remembered for a day, so repeat installs reuse
+the cached archives without any network access, and fall back to them
+when the charm store cannot be reached.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import logging
+import os
+from tempfile import NamedTemporaryFile
+import threading
+import time
+
+import requests
+
+from cloudinstall import utils
+
+log = logging.getLogger('cloudinstall.charmrepo')
+
+# Shared with the charms that are deployed from a local repository
+LOCAL_CHARMS_DIR = os.path.expanduser('~/.cloud-install/local-charms')
+
+CHARM_STORE_URL = 'https://store.juju.ubuntu.com'
+
+DEFAULT_SERIES = 'trusty'
+
+# Archives downloaded or uploaded at once
+DEFAULT_MAX_WORKERS = 8
+
+# Seconds a resolved revision is used without asking the charm store
+RESOLVE_MAX_AGE = 24 * 60 * 60
+
+UPLOAD_TIMEOUT = 300
+
+
+class CharmRepoError(Exception):
+    """ A charm could not be added to the repository or uploaded """
+
+
+def store_info(charm_ids, store_url=CHARM_STORE_URL):
+    """ Latest revisions of charm store charms, in one request
+
+    :param list charm_ids: eg ['cs:trusty/keystone']
+    :returns: {charm id: {'revision': int, 'sha256': str, ...}}
+    """
+    r = requests.get(store_url + '/charm-info',
+                     params=[('charms', c) for c in charm_ids],
+                     timeout=60)
+    r.raise_for_status()
+    return r.json()
+
+
+def upload(archive, series, state_server, password, ca_cert_file,
+           user='user-admin'):
+    """ Adds a charm archive to the environment
+
+    :param str state_server: host:port of the juju api
+    :param str ca_cert_file: the environment's CA certificate, which
+                             signs the state server's
+    :returns: local: charm url to deploy
+    """
+    url = 'https://{}/charms'.format(state_server)
+    with open(archive, 'rb') as f:
+        r = requests.post(url, params=dict(series=series), data=f,
+                          auth=(user, password), verify=ca_cert_file,
+                          headers={'Content-Type': 'application/zip'},
+                          timeout=UPLOAD_TIMEOUT)
+    try:
+        result = r.json()
+    except ValueError:
+        result = {}
+    if r.status_code != 200 or 'CharmURL' not in result:
+        raise CharmRepoError("Unable to upload {}: {}".format(
+            archive, result.get('Error', r.text)))
+    return result['CharmURL']
+
+
+class LocalCharmRepository:
+    """ Charm store archives cached by revision """
+
+    def __init__(self, root=LOCAL_CHARMS_DIR, series=DEFAULT_SERIES,
+                 store_url=CHARM_STORE_URL, info=store_info,
+                 fetch=utils.http_fetch,
+                 max_workers=DEFAULT_MAX_WORKERS,
+                 max_age=RESOLVE_MAX_AGE):
+        """
+        :param info: info(charm ids, store url) resolves charms like
+                     store_info()
+        :param fetch: fetch(url) yields the contents of url in chunks
+        """
+        self.root = root
+        self.series = series
+        self.store_url = store_url
+        self.info = info
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.max_age = max_age
+        self.archives = os.path.join(root, 'archives', series)
+        self.index_path = os.path.join(root, 'archives', 'index.json')
+        self.hits = 0
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def charm_id(self, name):
+        return 'cs:{}/{}'.format(self.series, name)
+
+    def archive_path(self, name, revision):
+        return os.path.join(self.archives,
+                            '{}-{}.charm'.format(name, revision))
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp = self.index_path + '.part'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.index_path)
+
+    def resolve(self, names):
+        """ Revisions to deploy, asking the charm store only about charms
+        not resolved recently
+
+        :returns: {name: {'revision': int, 'sha256': str or None}}, charms
+                  that could not be resolved are left out
+        """
+        index = self._read_index()
+        now = time.time()
+        stale = [n for n in names
+                 if now - index.get(self.charm_id(n), {}).get('resolved', 0)
+                 > self.max_age]
+        if len(stale) > 0:
+            try:
+                info = self.info([self.charm_id(n) for n in stale],
+                                 self.store_url)
+                for n in stale:
+                    i = info.get(self.charm_id(n), {})
+                    if i.get('errors') or 'revision' not in i:
+                        log.warning("Unable to resolve {}: {}".format(
+                            self.charm_id(n), i.get('errors')))
+                        continue
+                    index[self.charm_id(n)] = dict(revision=i['revision'],
+                                                   sha256=i.get('sha256'),
+                                                   resolved=now)
+                self._write_index(index)
+            except (requests.RequestException, ValueError, OSError) as e:
+                log.warning("Unable to reach the charm store, using "
+                            "cached revisions: {}".format(e))
+        return {n: index[self.charm_id(n)] for n in names
+                if self.charm_id(n) in index}
+
+    def _ensure(self, name, revision, sha256):
+        dest = self.archive_path(name, revision)
+        if os.path.exists(dest):
+            with self.lock:
+                self.hits += 1
+            return dest
+        url = '{}/charm/{}/{}-{}'.format(self.store_url, self.series,
+                                         name, revision)
+        log.debug("Fetching {}".format(url))
+        try:
+            utils.download(url, dest, self.fetch, sha256)
+        except utils.ChecksumMismatch as e:
+            raise CharmRepoError(str(e))
+        with self.lock:
+            self.fetched += 1
+        return dest
+
+    def _parallel(self, what, fn, items):
+        """ Runs fn(name, *args) for each (name, args) in items
+
+        :returns: {name: result}, failed names are logged and left out
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(fn, name, *args): name
+                       for name, args in items}
+            for f in as_completed(futures):
+                name = futures[f]
+                try:
+                    results[name] = f.result()
+                except (CharmRepoError, requests.RequestException,
+                        OSError) as e:
+                    log.warning("Unable to {} {}: {}".format(what, name, e))
+        return results
+
+    def mirror(self, names):
+        """ Resolves the charms and fetches the archives that are not
+        cached yet, in parallel
+
+        :returns: {name: archive path}
+        """
+        start = time.time()
+        resolved = self.resolve(names)
+        items = [(n, (r['revision'], r.get('sha256')))
+                 for n, r in sorted(resolved.items())]
+        archives = self._parallel('fetch', self._ensure, items)
+        log.info("Local charm repository: {} charms cached, {} fetched in "
+                 "{:.1f}s".format(self.hits, self.fetched,
+                                  time.time() - start))
+        return archives
+
+    def upload(self, archives, state_server, password, ca_cert):
+        """ Uploads archives to the environment, in parallel
+
+        :param dict archives: {name: archive path}, from mirror()
+        :param str ca_cert: the environment's CA certificate, PEM encoded
+                            as in its jenv
+        :returns: {name: local: charm url}
+        """
+        with NamedTemporaryFile('w', suffix='-ca.pem') as ca_cert_file:
+            ca_cert_file.write(ca_cert)
+            ca_cert_file.flush()
+
+            def upload_charm(name, archive):
+                return upload(archive, self.series, state_server, password,
+                              ca_cert_file.name)
+
+            items = [(n, (a,)) for n, a in sorted(archives.items())]
+            return self._parallel('upload', upload_charm, items)
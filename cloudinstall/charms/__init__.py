@@ -20,37 +20,58 @@ import logging
 from os import path
 import sys
 import yaml
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 import requests
 
 from macumba import MacumbaError
 from cloudinstall import utils
 from cloudinstall.config import Config
+from cloudinstall.journal import DEPLOY_ISSUED, POST_PROC_DONE
 from cloudinstall.placement.controller import AssignmentType
+from cloudinstall.relations import RelationPlanner
+from cloudinstall.trace import tracer
 
 log = logging.getLogger('cloudinstall.charms')
 
 CHARM_CONFIG_FILENAME = path.expanduser("~/.cloud-install/charmconf.yaml")
-CHARM_CONFIG = {}
-CHARM_CONFIG_RAW = None
-if path.exists(CHARM_CONFIG_FILENAME):
-    with open(CHARM_CONFIG_FILENAME) as f:
-        CHARM_CONFIG_RAW = f.read()
-        CHARM_CONFIG = yaml.load(CHARM_CONFIG_RAW)
+_charm_config = None
+_cs_cache = {}
+
+
+def charm_config():
+    """ Returns parsed and raw charm configuration, reading
+    charmconf.yaml on first use rather than at import time.
+
+    :returns: (dict of charm options, raw yaml string or None)
+    :rtype: tuple
+    """
+    global _charm_config
+    if _charm_config is None:
+        config, config_raw = {}, None
+        if path.exists(CHARM_CONFIG_FILENAME):
+            with open(CHARM_CONFIG_FILENAME) as f:
+                config_raw = f.read()
+                config = yaml.load(config_raw)
+        _charm_config = (config, config_raw)
+    return _charm_config
 
 
 def query_cs(charm, series='trusty'):
     """ This helper routine will query the charm store to pull latest revisions
-    and charmstore url for the api.
+    and charmstore url for the api. Answers are cached for the life of
+    the process.
 
     :param str charm: charm name
     :param str series: series, defaults. trusty
     """
-    charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
-    url = path.join(charm_store_url, series, charm)
-    r = requests.get(url)
-    return r.json()
+    if (series, charm) not in _cs_cache:
+        charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
+        url = path.join(charm_store_url, series, charm)
+        r = requests.get(url)
+        _cs_cache[(series, charm)] = r.json()
+    return _cs_cache[(series, charm)]
 
 
 class DisplayPriorities:
@@ -70,18 +91,31 @@ def get_charm(charm_name, juju, juju_state, ui):
     :rtype: Charm
     :returns: charm class
     """
-    for charm in utils.load_charms():
-        c = charm.__charm_class__(juju=juju, juju_state=juju_state, ui=ui)
-        if charm_name == c.name():
-            return c
+    for charm_class in utils.load_charm_manifest():
+        if charm_name == charm_class.name():
+            return charm_class(juju=juju, juju_state=juju_state, ui=ui)
+
+
+class CharmMeta(type):
+    """ Hashes charm classes by charm name so they can be used
+    interchangeably with their manifest entries in sets and dicts.
+    """
+
+    def __hash__(cls):
+        return hash(cls.charm_name)
 
 
-class CharmBase:
+class CharmBase(metaclass=CharmMeta):
     """ Base charm class """
 
     charm_name = None
     display_name = None
     related = []
+    # services that need a started unit before this charm can deploy
+    deploy_prerequisites = []
+    # {service: interface} for relations that must name an interface,
+    # added to `related`
+    relation_endpoints = {}
     isolate = False
     constraints = {}
     deploy_priority = sys.maxsize
@@ -91,6 +125,9 @@ class CharmBase:
     optional = False
     disabled = False
     menuable = False
+    # False if deploy() gets the charm from elsewhere than the charm
+    # store, so there is no point mirroring it in the local repository
+    from_charm_store = True
 
     def __init__(self, juju=None, juju_state=None, machine=None, ui=None):
         """ initialize
@@ -100,6 +137,9 @@ class CharmBase:
         """
         self.config = Config()
         self.charm_path = None
+        # local: charm url uploaded from the local charm repository, the
+        # charm store's charm is deployed if None
+        self.charm_url = None
         self.exposed = False
         self.machine = machine
         self.juju = juju
@@ -171,6 +211,25 @@ export OS_REGION_NAME=RegionOne
         all_args = " ".join(args)
         return "\"{}\"".format(all_args)
 
+    def juju_deploy(self, num_units=1, config_yaml="", machine_spec=""):
+        """ Issues the deploy of this charm's service, from charm_url if
+        set
+
+        :raises: MacumbaError
+        """
+        if self.charm_url is None:
+            return self.juju.deploy(self.charm_name, self.charm_name,
+                                    num_units, config_yaml, self.constraints,
+                                    machine_spec)
+        params = dict(ServiceName=self.charm_name, CharmUrl=self.charm_url,
+                      NumUnits=num_units, ConfigYAML=config_yaml)
+        if self.constraints:
+            params['Constraints'] = self.constraints
+        if machine_spec:
+            params['ToMachineSpec'] = machine_spec
+        return self.juju.call(dict(Type="Client", Request="ServiceDeploy",
+                                   Params=params))
+
     def deploy(self, machine_spec, num_units=1):
         """ Deploy charm and configuration options
 
@@ -185,18 +244,18 @@ export OS_REGION_NAME=RegionOne
         """
         config_yaml = ""
 
-        if self.charm_name in CHARM_CONFIG:
-            config_yaml = CHARM_CONFIG_RAW
+        config, config_raw = charm_config()
+        if self.charm_name in config:
+            config_yaml = config_raw
 
         try:
             # TODO - might not need to pass self.constraints to deploy
 
             log.debug('calling deploy({}, {}, {}, {}, {}, {})'.format(
-                self.charm_name, self.charm_name, num_units,
-                config_yaml, self.constraints, machine_spec))
+                self.charm_url or self.charm_name, self.charm_name,
+                num_units, config_yaml, self.constraints, machine_spec))
 
-            self.juju.deploy(self.charm_name, self.charm_name, num_units,
-                             config_yaml, self.constraints, machine_spec)
+            self.juju_deploy(num_units, config_yaml, machine_spec)
         except MacumbaError:
             log.exception("Error deploying")
             return True
@@ -216,30 +275,33 @@ export OS_REGION_NAME=RegionOne
             return True
         return False
 
+    def desired_relations(self):
+        """ Relations this charm needs
+
+        :returns: list of (endpoint, endpoint), where an endpoint is a
+                  service name optionally followed by ':interface'
+        """
+        rels = []
+        others = self.related + [c for c in self.relation_endpoints
+                                 if c not in self.related]
+        for charm in others:
+            if charm in self.relation_endpoints:
+                iface = self.relation_endpoints[charm]
+                rels.append(("{}:{}".format(self.charm_name, iface),
+                             "{}:{}".format(charm, iface)))
+            else:
+                rels.append((self.charm_name, charm))
+        return rels
+
     def set_relations(self):
         """ Setup charm relations
 
-        Override in charm specific.
+        Returns True if some relations are still missing. Override
+        desired_relations() rather than this.
         """
-        if len(self.related) > 0:
-            services = self.juju_state.service(self.charm_name)
-            unit = services.unit(self.charm_name)
-            if unit.agent_state != "started":
-                return True
-            for charm in self.related:
-                if not self.is_related(charm, services.relations):
-                    try:
-                        log.debug("calling add_relation({}, {})".format(
-                            self.charm_name, charm))
-                        self.juju.add_relation(self.charm_name,
-                                               charm)
-                    except:
-                        msg = "Relation {}-{} not ready, " \
-                              "requeueing.".format(self.charm_name, charm)
-                        log.exception("failure in add_relation {}".format(msg))
-                        self.ui.status_info_message(msg)
-                        return True
-        return False
+        planner = RelationPlanner(self.juju, self.juju_state, [self],
+                                  ui=self.ui)
+        return planner.set_relations()
 
     def post_proc(self):
         """ Perform any post processing
@@ -286,68 +348,224 @@ export OS_REGION_NAME=RegionOne
         return self.name()
 
 
+class CharmTask:
+    """ One queued charm operation and its retry state """
+
+    def __init__(self, stage, charm):
+        self.stage = stage
+        self.charm = charm
+        self.attempts = 0
+        self.next_eligible = 0
+
+    def wakes_on(self, service_name):
+        """ True if a unit of service_name starting may unblock this task """
+        return (service_name == self.charm.charm_name or
+                service_name in self.charm.related or
+                service_name in self.charm.relation_endpoints or
+                service_name in self.charm.deploy_prerequisites)
+
+    def __repr__(self):
+        return "{}:{}".format(self.stage, self.charm)
+
+
 class CharmQueue:
-    """ charm queue for handling relations in the background
+    """ charm queue for handling deploys, relations and post processing
+    in the background
+
+    A single scheduler thread runs every due task on a worker pool, at
+    most one task per charm at a time. Failed tasks are retried with
+    exponential backoff, and are retried immediately when a unit of the
+    charm, or of a charm it relates to, reaches 'started'.
+
+    Given a journal, completed deploys and post processing are recorded
+    in it, and tasks it already records are not queued again.
     """
-    def __init__(self, ui):
-        self.charm_relations_q = Queue()
-        self.charm_deploy_q = Queue()
-        self.charm_post_proc_q = Queue()
-        self.is_running = False
+    STAGES = ['deploy', 'relations', 'post_proc']
+    BACKOFF_INITIAL = 2
+    BACKOFF_MAX = 60
+    STATUS_INTERVAL = 5
+    MAX_WORKERS = 4
+
+    # steps recorded in the journal for each stage; relations are
+    # recorded by the RelationPlanner itself
+    JOURNAL_STEPS = {'deploy': DEPLOY_ISSUED,
+                     'post_proc': POST_PROC_DONE}
+
+    def __init__(self, ui, juju_state=None, journal=None):
         self.ui = ui
+        self.juju_state = juju_state
+        self.journal = journal
+        self.tasks = []
+        self.running = set()
+        self.watched = set()
+        self.completed = {stage: 0 for stage in self.STAGES}
+        self.unit_states = {}
+        self.is_running = False
+        self.cv = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        self._scheduler_started = False
+
+    def _journal_step(self, stage):
+        if self.journal is None:
+            return None
+        return self.JOURNAL_STEPS.get(stage)
+
+    def _add(self, stage, charm):
+        step = self._journal_step(stage)
+        if step and self.journal.done(step, charm.charm_name):
+            log.debug("Skipping {}:{}, already done".format(stage, charm))
+            return
+        with self.cv:
+            if self.juju_state is None:
+                self.juju_state = charm.juju_state
+            self.tasks.append(CharmTask(stage, charm))
+            self.cv.notify_all()
 
     def add_relation(self, charm):
-        self.charm_relations_q.put(charm)
+        self._add('relations', charm)
 
     def add_deploy(self, charm):
-        self.charm_deploy_q.put(charm)
+        self._add('deploy', charm)
 
     def add_post_proc(self, charm):
-        self.charm_post_proc_q.put(charm)
+        self._add('post_proc', charm)
+
+    def _watch(self, stage):
+        log.debug("Starting charm {} watcher.".format(stage))
+        with self.cv:
+            self.watched.add(stage)
+            start = not self._scheduler_started
+            self._scheduler_started = True
+            self.cv.notify_all()
+        if start:
+            self._schedule()
+            self._watch_status()
 
     def watch_deploy(self):
-        log.debug("Starting charm deploy watcher.")
-        while True:
-            try:
-                charm = self.charm_deploy_q.get()
-                err = charm.deploy()  # TODO call with machine placement
-                if err:
-                    self.charm_deploy_q.put(charm)
-                self.charm_deploy_q.task_done()
-            except:
-                msg = "Exception in deploy watcher, re-trying."
-                log.exception(msg)
-                self.ui.status_error_message(msg)
-            time.sleep(10)
+        self._watch('deploy')
 
-    @utils.async
     def watch_relations(self):
-        log.debug("Starting charm relations watcher.")
+        self._watch('relations')
+
+    def watch_post_proc(self):
+        self._watch('post_proc')
+
+    def wait_done(self, timeout=None):
+        """ Blocks until every queued task is done, or for at most
+        timeout seconds
+
+        :returns: True if every task is done
+        """
+        with self.cv:
+            return self.cv.wait_for(lambda: len(self.tasks) == 0, timeout)
+
+    def queue_depth(self):
+        """ Returns number of pending tasks per stage
+
+        :rtype: dict
+        """
+        with self.cv:
+            depth = {stage: 0 for stage in self.STAGES}
+            for t in self.tasks:
+                depth[t.stage] += 1
+            return depth
+
+    def retry_counts(self):
+        """ Returns failed attempts of each pending task so far
+
+        :returns: {(stage, charm name): attempts}
+        :rtype: dict
+        """
+        with self.cv:
+            return {(t.stage, t.charm.charm_name): t.attempts
+                    for t in self.tasks}
+
+    def _backoff(self, task):
+        """ Returns seconds to wait before the next attempt of task """
+        return min(self.BACKOFF_INITIAL * 2 ** (task.attempts - 1),
+                   self.BACKOFF_MAX)
+
+    def _run_task(self, task):
+        if task.stage == 'deploy':
+            return task.charm.deploy(getattr(task.charm, 'machine_id', None))
+        elif task.stage == 'relations':
+            return task.charm.set_relations()
+        return task.charm.post_proc()
+
+    def _task_done(self, task):
+        try:
+            with tracer.span(repr(task), 'charmqueue',
+                             attempt=task.attempts + 1):
+                err = self._run_task(task)
+        except:
+            msg = "Exception in {} watcher, re-trying.".format(task.stage)
+            log.exception(msg)
+            self.ui.status_error_message(msg)
+            err = True
+        step = self._journal_step(task.stage)
+        if step and not err:
+            self.journal.record(step, task.charm.charm_name)
+        with self.cv:
+            self.running.discard(task.charm.charm_name)
+            if err:
+                task.attempts += 1
+                delay = self._backoff(task)
+                task.next_eligible = time.time() + delay
+                log.debug("{} not done after {} attempts, next try in "
+                          "{}s".format(task, task.attempts, delay))
+            else:
+                self.tasks.remove(task)
+                self.completed[task.stage] += 1
+                log.debug("{} done, queue depth: {}".format(
+                    task, self.queue_depth()))
+            self.cv.notify_all()
+
+    @utils.async
+    def _schedule(self):
         while True:
-            try:
-                charm = self.charm_relations_q.get()
-                err = charm.set_relations()
-                if err:
-                    self.charm_relations_q.put(charm)
-                self.charm_relations_q.task_done()
-            except:
-                msg = "Exception in relations watcher, re-trying."
-                log.exception(msg)
-                self.ui.status_error_message(msg)
-            time.sleep(10)
+            with self.cv:
+                now = time.time()
+                waits = []
+                for task in self.tasks:
+                    if task.stage not in self.watched or \
+                       task.charm.charm_name in self.running:
+                        continue
+                    if task.next_eligible > now:
+                        waits.append(task.next_eligible - now)
+                        continue
+                    self.running.add(task.charm.charm_name)
+                    self.pool.submit(self._task_done, task)
+                self.cv.wait(min(waits) if waits else None)
+
+    def _unit_states(self):
+        self.juju_state.invalidate_status_cache()
+        return {u.unit_name: (s.service_name, u.agent_state)
+                for s in self.juju_state.services for u in s.units}
 
     @utils.async
-    def watch_post_proc(self):
-        log.debug("Starting charm post processing watcher.")
+    def _watch_status(self):
+        """ Wakes tasks waiting on a service whose unit just started """
         while True:
+            time.sleep(self.STATUS_INTERVAL)
+            with self.cv:
+                if self.juju_state is None or \
+                   not any(t.attempts > 0 for t in self.tasks):
+                    continue
             try:
-                charm = self.charm_post_proc_q.get()
-                err = charm.post_proc()
-                if err:
-                    self.charm_post_proc_q.put(charm)
-                self.charm_post_proc_q.task_done()
-            except:
-                msg = "Exception in post-processing watcher, re-trying."
-                log.exception(msg)
-                self.ui.status_error_message(msg)
-            time.sleep(10)
+                states = self._unit_states()
+            except Exception:
+                log.exception("Error fetching status for CharmQueue")
+                continue
+            started = set()
+            for name, (svc, state) in states.items():
+                was = self.unit_states.get(name, (svc, None))[1]
+                if state == 'started' and was != 'started':
+                    started.add(svc)
+            self.unit_states = states
+            if len(started) == 0:
+                continue
+            with self.cv:
+                for task in self.tasks:
+                    if any(task.wakes_on(svc) for svc in started):
+                        task.next_eligible = 0
+                self.cv.notify_all()
@@ -48,9 +48,7 @@ class CharmCeph(CharmBase):
             log.debug("Ceph not currently supported on single installs")
             return True
         try:
-            self.juju.deploy(charm=self.charm_name,
-                             service_name=self.charm_name,
-                             num_units=self.default_instances)
+            self.juju_deploy(num_units=self.default_instances)
         except MacumbaError:
             log.exception("Error deploying")
             return True
@@ -28,6 +28,8 @@ class CharmNovaCompute(CharmBase):
     menuable = True
     display_priority = DisplayPriorities.Compute
     related = ['mysql', 'glance', 'nova-cloud-controller']
+    relation_endpoints = {'mysql': 'shared-db',
+                          'rabbitmq-server': 'amqp'}
     isolate = True
     constraints = {'mem': 4096,
                    'root-disk': 40960}
@@ -35,41 +37,4 @@ class CharmNovaCompute(CharmBase):
     allowed_assignment_types = [AssignmentType.BareMetal,
                                 AssignmentType.KVM]
 
-    def set_relations(self):
-        if not self.wait_for_agent(['nova-cloud-controller']):
-            return True
-
-        for charm in self.related:
-            log.debug("{1} adding relation to {0}".format(
-                charm, self.display_name))
-            try:
-                if "mysql" in charm:
-                    rv = self.juju.add_relation(
-                        "{0}:shared-db".format(self.charm_name),
-                        "{0}:shared-db".format(charm))
-                    log.debug("add_relation (shared-db) "
-                              "returned {}".format(rv))
-                else:
-                    self.juju.add_relation(self.charm_name,
-                                           charm)
-                    log.debug("add_relation returned {}".format(rv))
-            except:
-                log.exception("{0} not ready for relation".format(charm))
-                return True
-
-        service = self.juju_state.service(self.charm_name)
-        has_amqp = list(filter(lambda r: 'amqp' in r.relation_name,
-                        service.relations))
-        if len(has_amqp) == 0:
-            log.debug("Setting amqp relation for compute.")
-            try:
-                self.juju.add_relation("{c}:amqp".format(
-                                       c=self.charm_name),
-                                       "rabbitmq-server:amqp")
-            except:
-                log.exception("Not ready to set amqp relation.")
-                return True
-            return False
-        return False
-
 __charm_class__ = CharmNovaCompute
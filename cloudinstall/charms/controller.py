@@ -42,28 +42,25 @@ class CharmNovaCloudController(CharmBase):
         if unit.machine_id == '-1':
             return True
 
+        files = {}
         for u in ['admin', 'ubuntu']:
             env = self._openstack_env(u, self.config.openstack_password,
                                       u, keystone.public_address)
             self._openstack_env_save(u, env)
-            utils.remote_cp(unit.machine_id,
-                            src=self._openstack_env_path(u),
-                            dst='/tmp/openstack-{u}-rc'.format(u=u))
-        utils.remote_cp(
-            unit.machine_id,
-            src=os.path.join(self.config.tmpl_path,
-                             "nova-controller-setup.sh"),
-            dst="/tmp/nova-controller-setup.sh")
-        utils.remote_cp(
-            unit.machine_id,
-            src=self._pubkey(),
-            dst="/tmp/id_rsa.pub")
-        err = utils.remote_run(unit.machine_id,
-                               cmds="/tmp/nova-controller-setup.sh "
-                                    "{p}".format(
-                                        p=self.config.openstack_password))
+            files['/tmp/openstack-{u}-rc'.format(u=u)] = \
+                self._openstack_env_path(u)
+        files["/tmp/nova-controller-setup.sh"] = os.path.join(
+            self.config.tmpl_path, "nova-controller-setup.sh")
+        files["/tmp/id_rsa.pub"] = self._pubkey()
+        err = utils.remote_bundle_run(
+            unit.machine_id, files,
+            cmds=["chmod +x /tmp/nova-controller-setup.sh",
+                  "/tmp/nova-controller-setup.sh {p}".format(
+                      p=self.config.openstack_password)])
         if err['status'] != 0:
             # something happened during nova setup, re-run
+            log.debug("nova-controller-setup failed ({}): {}".format(
+                err['error'], err['output']))
             return True
         return False
 
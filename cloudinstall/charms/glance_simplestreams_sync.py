@@ -21,8 +21,9 @@ import requests
 import shutil
 import subprocess
 
+from cloudinstall.charmrepo import LOCAL_CHARMS_DIR
 from cloudinstall.charms import (CharmBase, DisplayPriorities,
-                                 CHARM_CONFIG,
+                                 charm_config,
                                  CHARM_CONFIG_FILENAME)
 
 CHARM_STABLE_URL = ("https://api.github.com/repos/Ubuntu-Solutions-Engineering"
@@ -30,7 +31,7 @@ CHARM_STABLE_URL = ("https://api.github.com/repos/Ubuntu-Solutions-Engineering"
 
 # Not necessarily required to match because we're local, but easy enough to get
 CURRENT_DISTRO = platform.linux_distribution()[-1]
-CHARMS_DIR = os.path.expanduser("~/.cloud-install/local-charms")
+CHARMS_DIR = LOCAL_CHARMS_DIR
 
 log = logging.getLogger(__name__)
 
@@ -43,6 +44,8 @@ class CharmGlanceSimplestreamsSync(CharmBase):
     display_name = 'Glance - Simplestreams Image Sync'
     display_priority = DisplayPriorities.Other
     related = ['keystone']
+    # deployed from the stable branch on github
+    from_charm_store = False
 
     def download_stable(self):
         if not os.path.exists(CHARMS_DIR):
@@ -101,7 +104,8 @@ class CharmGlanceSimplestreamsSync(CharmBase):
                ' --constraints {constraints}'
                ' --to {mspec}').format(**kwds)
 
-        if self.charm_name in CHARM_CONFIG:
+        config, _ = charm_config()
+        if self.charm_name in config:
             cmd += ' --config ' + CHARM_CONFIG_FILENAME
 
         try:
@@ -118,14 +122,13 @@ class CharmGlanceSimplestreamsSync(CharmBase):
             return True
         return False
 
-    def set_relations(self):
+    def desired_relations(self):
+        rels = super(CharmGlanceSimplestreamsSync, self).desired_relations()
         if os.path.exists(os.path.join(CHARMS_DIR, CURRENT_DISTRO,
                                        'glance-simplestreams-sync')):
             if 'rabbitmq-server' not in self.related:
-                self.related.append('rabbitmq-server')
-                log.debug("Added rabbitmq to relation list")
-
-        return super(CharmGlanceSimplestreamsSync, self).set_relations()
+                rels.append((self.charm_name, 'rabbitmq-server'))
+        return rels
 
 
 __charm_class__ = CharmGlanceSimplestreamsSync
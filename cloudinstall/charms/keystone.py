@@ -25,6 +25,7 @@ class CharmKeystone(CharmBase):
     charm_name = 'keystone'
     display_name = 'Keystone'
     related = ['mysql']
+    deploy_prerequisites = ['mysql']
     deploy_priority = 1
     menuable = True
 
@@ -30,6 +30,7 @@ class CharmQuantum(CharmBase):
     # them as Neutron
     display_name = 'Neutron'
     related = ['mysql', 'nova-cloud-controller']
+    relation_endpoints = {'rabbitmq-server': 'amqp'}
     isolate = True
     optional = False
     menuable = True
@@ -38,28 +39,6 @@ class CharmQuantum(CharmBase):
     allowed_assignment_types = [AssignmentType.BareMetal,
                                 AssignmentType.KVM]
 
-    def set_relations(self):
-        repoll = super().set_relations()
-        if repoll:
-            return True
-        service = self.juju_state.service(self.charm_name)
-        if self.is_related('rabbitmq-server', service.relations):
-            return False
-
-        try:
-            log.debug("calling add_relation(quantum-gateway:amqp, "
-                      "rabbitmq-server:amqp")
-            self.juju.add_relation('quantum-gateway:amqp',
-                                   'rabbitmq-server:amqp')
-        except:
-            msg = ("Relation quantum-gateway-rabbitmq-server not ready, "
-                   "requeueing.")
-            log.exception("failure in add_relation {}".format(msg))
-            self.ui.status_info_message(msg)
-            return True
-
-        return False
-
     def post_proc(self):
         """ performs additional network configuration for charm """
         if not self.wait_for_agent():
@@ -72,14 +51,17 @@ class CharmQuantum(CharmBase):
 
         self.ui.status_info_message("Updating network parameters "
                                     "for Neutron")
-        utils.remote_cp(
+        err = utils.remote_bundle_run(
             unit.machine_id,
-            src=os.path.join(self.config.tmpl_path, "quantum-network.sh"),
-            dst="/tmp/quantum-network.sh")
-        utils.remote_run(unit.machine_id,
-                         cmds="sudo chmod +x /tmp/quantum-network.sh")
-        utils.remote_run(unit.machine_id,
-                         cmds="sudo /tmp/quantum-network.sh")
+            {"/tmp/quantum-network.sh": os.path.join(self.config.tmpl_path,
+                                                     "quantum-network.sh")},
+            cmds=["chmod +x /tmp/quantum-network.sh",
+                  "/tmp/quantum-network.sh"])
+        if err['error'] in ['connection', 'unpack']:
+            # the script never ran, safe to try again
+            return True
+        if err['error']:
+            log.error("quantum-network.sh failed: {}".format(err['output']))
         self.ui.status_info_message(
             "Neutron deployed and configured, images will now be synced.")
         return False
@@ -14,7 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from cloudinstall.charms import (CharmBase, CHARM_CONFIG,
+from cloudinstall.charms import (CharmBase, charm_config,
                                  DisplayPriorities)
 
 log = logging.getLogger('cloudinstall.charms.compute')
@@ -37,9 +37,10 @@ class CharmSwift(CharmBase):
 
     @classmethod
     def required_num_units(self):
-        if 'swift-proxy' in CHARM_CONFIG:
-            num_replicas = CHARM_CONFIG.get('replicas',
-                                            self.default_replicas)
+        config, _ = charm_config()
+        if 'swift-proxy' in config:
+            num_replicas = config.get('replicas',
+                                      self.default_replicas)
         else:
             num_replicas = self.default_replicas
         return num_replicas
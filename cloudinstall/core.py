@@ -22,23 +22,34 @@ import json
 import time
 import random
 import sys
+import threading
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from os import path, getenv
 
 from operator import attrgetter
 
-from cloudinstall import utils
+from cloudinstall import aptcache, utils
 from cloudinstall.config import Config
 from cloudinstall.juju import JujuState
+from cloudinstall.journal import (DeployJournal, JOURNAL_FILENAME,
+                                  MACHINE_ADDED, DEPLOY_ISSUED,
+                                  environment_id)
 from cloudinstall.maas import MaasState, MaasMachineStatus, MaasMachine
 from maasclient.auth import MaasAuth
 from maasclient import MaasClient
-from cloudinstall.charms import CharmQueue, get_charm
+from cloudinstall.charmrepo import LocalCharmRepository
+from cloudinstall.deploy import (DeployExecutor, DeployGraph,
+                                 DeployScheduler)
+from cloudinstall.fanout import FanOut
+from cloudinstall.installbase import INSTALL_STARTED_ENV
 from cloudinstall.log import PrettyLog
 from cloudinstall.placement.controller import (PlacementController,
                                                AssignmentType)
+from cloudinstall.relations import RelationPlanner
+from cloudinstall.trace import tracer, traced, TracedClient
 
 from macumba import JujuClient
 from macumba import Jobs as JujuJobs
@@ -48,6 +59,14 @@ log = logging.getLogger('cloudinstall.core')
 sys.excepthook = utils.global_exchandler
 
 
+# Seconds scale_out waits for its new machines, and then for their units,
+# to start
+SCALE_OUT_TIMEOUT = 3600
+
+# Seconds the post-deploy steps wait for relations and post processing
+DEPLOY_DONE_TIMEOUT = 3600
+
+
 @unique
 class ControllerState(Enum):
 
@@ -130,15 +149,18 @@ class DisplayController:
         self.nodes = None
         self.placement_controller = None
         self.current_state = ControllerState.INSTALL_WAIT
+        self.unit_states = {}
 
-    def authenticate_juju(self):
+    def juju_state_server(self):
+        """ host:port of the juju api """
         if not len(self.config.juju_env['state-servers']) > 0:
-            state_server = 'localhost:17070'
-        else:
-            state_server = self.config.juju_env['state-servers'][0]
-        self.juju = JujuClient(
-            url=path.join('wss://', state_server),
-            password=self.config.juju_api_password)
+            return 'localhost:17070'
+        return self.config.juju_env['state-servers'][0]
+
+    def authenticate_juju(self):
+        self.juju = TracedClient(JujuClient(
+            url=path.join('wss://', self.juju_state_server()),
+            password=self.config.juju_api_password), 'juju')
         self.juju.login()
         self.juju_state = JujuState(self.juju)
         log.debug('Authenticated against juju api.')
@@ -153,7 +175,7 @@ class DisplayController:
         else:
             auth = MaasAuth()
             auth.get_api_key('root')
-        self.maas = MaasClient(auth)
+        self.maas = TracedClient(MaasClient(auth), 'maas')
         self.maas_state = MaasState(self.maas)
         log.debug('Authenticated against maas api.')
 
@@ -292,7 +314,10 @@ class DisplayController:
                                        handle_mouse=True,
                                        unhandled_input=self.header_hotkeys)
             self.info_message("Welcome ..")
+            start = time.time()
             self.initialize()
+            log.info("Controller initialized in "
+                     "{:.3f}s".format(time.time() - start))
 
         self.update()
         self.loop.run()
@@ -326,15 +351,21 @@ class DisplayController:
                                    key=attrgetter('service_name'))
         deployed_service_names = [s.service_name for s in deployed_services]
 
-        charm_classes = sorted([m.__charm_class__ for m in utils.load_charms()
-                                if m.__charm_class__.charm_name in
-                                deployed_service_names],
+        charm_classes = sorted([cc for cc in utils.load_charm_manifest()
+                                if cc.charm_name in deployed_service_names],
                                key=attrgetter('charm_name'))
 
         self.nodes = list(zip(charm_classes, deployed_services))
 
         for n in deployed_services:
             for u in n.units:
+                prev_state = self.unit_states.get(u.unit_name)
+                if prev_state != u.agent_state:
+                    tracer.instant("{} {}".format(u.unit_name,
+                                                  u.agent_state),
+                                   'unit', unit=u.unit_name,
+                                   state=u.agent_state, previous=prev_state)
+                    self.unit_states[u.unit_name] = u.agent_state
                 if u.is_horizon and u.agent_state == "started":
                     self.set_dashboard_url(u.public_address)
                 if u.is_jujugui and u.agent_state == "started":
@@ -356,10 +387,8 @@ class DisplayController:
         if key in ['a', 'A', 'f6']:
             if self.current_state != ControllerState.SERVICES:
                 return
-            charm_modules = utils.load_charms()
-            charm_classes = [m.__charm_class__ for m in charm_modules
-                             if m.__charm_class__.allow_multi_units and
-                             not m.__charm_class__.disabled]
+            charm_classes = [cc for cc in utils.load_charm_manifest()
+                             if cc.allow_multi_units and not cc.disabled]
             self.ui.show_add_charm_info(charm_classes, self.add_charm)
         if key in ['q', 'Q']:
             self.exit()
@@ -373,9 +402,18 @@ class Controller(DisplayController):
     """ Controller for Juju deployments and Maas machine init """
 
     def __init__(self, **kwds):
-        self.charm_modules = utils.load_charms()
-        self.juju_m_idmap = None  # for single, {instance_id: machine id}
+        # {maas instance id or placeholder id: juju machine id}
+        self.juju_m_idmap = {}
+        # deploy threads read and refresh juju_m_idmap concurrently
+        self.juju_m_idmap_lock = threading.RLock()
         self.deployed_charm_classes = []
+        self.deploy_executor = DeployExecutor()
+        self.journal = None
+        # {charm name: local: charm url} of the mirrored charms
+        self.local_charm_urls = {}
+        # set by the installer that started us, see INSTALL_STARTED_ENV
+        self.install_started = float(getenv(INSTALL_STARTED_ENV,
+                                            time.time()))
         super().__init__(**kwds)
 
     @utils.async
@@ -412,6 +450,13 @@ class Controller(DisplayController):
     @utils.async
     def begin_deployment(self):
         log.debug("begin_deployment")
+        self.journal = DeployJournal(
+            path.join(self.config.cfg_path, JOURNAL_FILENAME),
+            environment=environment_id(self.config.juju_env))
+        # charms are fetched while the machines come up
+        mirror_pool = ThreadPoolExecutor(max_workers=1)
+        mirrored = mirror_pool.submit(self.mirror_charms)
+
         if self.config.is_multi:
 
             # now all machines are added
@@ -427,7 +472,14 @@ class Controller(DisplayController):
         elif self.config.is_single:
             self.add_machines_to_juju_single()
 
-        while not self.all_juju_machines_started():
+        # machines are prepared in parallel as soon as each one starts
+        prepare = FanOut(self.prepare_machine)
+        while True:
+            all_started = self.all_juju_machines_started()
+            for machine_id in self.started_placed_machine_ids():
+                prepare.submit(machine_id)
+            if all_started:
+                break
             sd = self.juju_state.machines_summary()
             summary = ", ".join(["{} {}".format(v, k) for k, v
                                  in sd.items()])
@@ -435,17 +487,33 @@ class Controller(DisplayController):
                               "start: {}".format(summary))
             time.sleep(3)
 
-        self.current_state = ControllerState.SERVICES
-        if self.config.is_single:
-            controller_machine = self.juju_m_idmap['controller']
-            self.configure_lxc_network(controller_machine)
-
-        # FIXME: this is never populated during a multi_install
-        # for juju_machine_id in self.juju_m_idmap.values():
-        #    self.run_apt_go_fast(juju_machine_id)
+        self.info_message("Preparing machines")
+        prepare.wait()
+        self.local_charm_urls = mirrored.result()
+        mirror_pool.shutdown()
 
+        self.current_state = ControllerState.SERVICES
         self.deploy_using_placement()
-        self.enqueue_deployed_charms()
+        charm_q = self.enqueue_deployed_charms()
+        if not charm_q.wait_done(DEPLOY_DONE_TIMEOUT):
+            log.warning("Relations or post processing still pending after "
+                        "{}s: {}".format(DEPLOY_DONE_TIMEOUT,
+                                         charm_q.retry_counts()))
+        self.report_apt_cache(self.install_started)
+
+    def report_apt_cache(self, since):
+        """ Shows the apt cache's hit rate over the install, once the
+        deployment is done. Single installs deploy from their container,
+        which cannot read the host's apt cache log, so their installer
+        logs the hit rate instead.
+
+        :param since: time the install started
+        """
+        msg = aptcache.summary(since=since)
+        if msg is None:
+            return
+        log.info(msg)
+        self.info_message(msg)
 
     def all_maas_machines_ready(self):
         self.maas_state.invalidate_nodes_cache()
@@ -467,18 +535,25 @@ class Controller(DisplayController):
             return False
         return True
 
-    def add_machines_to_juju_multi(self):
+    def add_machines_to_juju_multi(self, machines=None):
         """Adds each of the machines used for the placement to juju, if it
-        isn't already there."""
+        isn't already there, in a single add_machines call.
+
+        :param machines: MAAS machines to add instead of all machines used
+        """
 
         self.juju_state.invalidate_status_cache()
-        juju_ids = [jm.instance_id for jm in self.juju_state.machines()]
+        self.update_juju_m_idmap()
 
+        if machines is None:
+            machines = self.placement_controller.machines_used()
         machine_params = []
-        for maas_machine in self.placement_controller.machines_used():
-            if maas_machine.instance_id in juju_ids:
+        added = []
+        for maas_machine in machines:
+            if maas_machine.instance_id in self.juju_m_idmap:
                 # ignore machines that are already added to juju
                 continue
+            added.append(maas_machine)
             cd = dict(tags=[maas_machine.system_id])
             mp = dict(Series="", ContainerType="", ParentId="",
                       Constraints=cd, Jobs=[JujuJobs.HostUnits])
@@ -490,6 +565,43 @@ class Controller(DisplayController):
                       " {}".format(pprint.pformat(machine_params)))
             rv = self.juju.add_machines(machine_params)
             log.debug("add_machines returned '{}'".format(rv))
+            # results are in the same order as machine_params
+            for maas_machine, d in zip(added, rv['Machines']):
+                if d['Error']:
+                    log.error("Error adding {} to juju: {}".format(
+                        maas_machine, d['Error']))
+                    continue
+                self.juju_m_idmap[maas_machine.instance_id] = d['Machine']
+                self.journal.record(MACHINE_ADDED, maas_machine.instance_id,
+                                    machine_id=d['Machine'])
+
+    def journaled_machine_ids(self):
+        """ Juju machine ids the journal records for MAAS instance ids,
+        for the machines that juju status still has
+
+        :returns: {instance id: juju machine id}
+        """
+        existing = set(jm.machine_id for jm in self.juju_state.machines())
+        ids = {}
+        for instance_id in self.journal.keys(MACHINE_ADDED):
+            machine_id = self.journal.data(MACHINE_ADDED,
+                                           instance_id).get('machine_id')
+            if machine_id in existing:
+                ids[instance_id] = machine_id
+            else:
+                log.debug("Journaled machine {} ({}) is not in juju "
+                          "status".format(machine_id, instance_id))
+        return ids
+
+    def update_juju_m_idmap(self):
+        """Adds the juju machine ids known from the journal and from juju
+        status to juju_m_idmap.
+        """
+        with self.juju_m_idmap_lock:
+            self.juju_m_idmap.update(self.journaled_machine_ids())
+            for jm in self.juju_state.machines():
+                if jm.instance_id and jm.instance_id != 'pending':
+                    self.juju_m_idmap[jm.instance_id] = jm.machine_id
 
     def all_juju_machines_started(self):
         self.juju_state.invalidate_status_cache()
@@ -499,13 +611,17 @@ class Controller(DisplayController):
         return n_allocated >= n_needed
 
     def add_machines_to_juju_single(self):
-        self.juju_m_idmap = {}
-        for jm in self.juju_state.machines():
-            response = self.juju.get_annotations(jm.machine_id,
-                                                 'machine')
-            ann = response['Annotations']
-            if 'instance_id' in ann:
-                self.juju_m_idmap[ann['instance_id']] = jm.machine_id
+        self.juju_m_idmap.update(self.journaled_machine_ids())
+
+        machines_used = self.placement_controller.machines_used()
+        if not all(m.instance_id in self.juju_m_idmap
+                   for m in machines_used):
+            for jm in self.juju_state.machines():
+                response = self.juju.get_annotations(jm.machine_id,
+                                                     'machine')
+                ann = response['Annotations']
+                if 'instance_id' in ann:
+                    self.juju_m_idmap[ann['instance_id']] = jm.machine_id
 
         log.debug("existing juju machines: {}".format(self.juju_m_idmap))
 
@@ -517,7 +633,7 @@ class Controller(DisplayController):
             else:
                 return d['Machine']
 
-        for machine in self.placement_controller.machines_used():
+        for machine in machines_used:
             if machine.instance_id in self.juju_m_idmap:
                 machine.machine_id = self.juju_m_idmap[machine.instance_id]
                 log.debug("machine instance_id {} already exists as #{}, "
@@ -533,122 +649,211 @@ class Controller(DisplayController):
                                            {'instance_id':
                                             machine.instance_id})
             self.juju_m_idmap[machine.instance_id] = m_id
+            self.journal.record(MACHINE_ADDED, machine.instance_id,
+                                machine_id=m_id)
+
+    def started_placed_machine_ids(self):
+        """ Juju machine ids of the placed machines whose agent started,
+        from the last juju status
+        """
+        placed = set(self.juju_m_idmap.get(m.instance_id) for m in
+                     self.placement_controller.machines_used())
+        return [jm.machine_id for jm in self.juju_state.machines()
+                if jm.agent_state == 'started' and jm.machine_id in placed]
+
+    def hosts_lxc(self, machine_id):
+        """ True if services are placed in lxc containers on the juju
+        machine machine_id
+        """
+        for instance_id, d in self.placement_controller.assignments.items():
+            if self.juju_m_idmap.get(instance_id) == machine_id and \
+               len(d.get(AssignmentType.LXC, [])) > 0:
+                return True
+        return False
+
+    def prepare_machine(self, machine_id):
+        """ Speeds up apt on a newly started machine, and on single
+        installs sets up lxc networking on the machines hosting lxc
+        containers, ie the controller.
+
+        apt-go-fast is optional: its failure is logged, and does not
+        stop the lxc network from being set up.
+        """
+        ret = self.run_apt_go_fast(machine_id)
+        if ret['status'] != 0:
+            log.warning("apt-go-fast failed on machine {}: {}".format(
+                machine_id, ret['output']))
+        if self.config.is_single and self.hosts_lxc(machine_id):
+            ret = self.configure_lxc_network(machine_id)
+        return ret
 
     def run_apt_go_fast(self, machine_id):
-        utils.remote_cp(machine_id,
-                        src=path.join(self.config.share_path,
-                                      "tools/apt-go-fast"),
-                        dst="/tmp/apt-go-fast")
-        utils.remote_run(machine_id,
-                         cmds="sudo sh /tmp/apt-go-fast")
+        return utils.remote_bundle_run(
+            machine_id,
+            {"/tmp/apt-go-fast": path.join(self.config.share_path,
+                                           "tools/apt-go-fast")},
+            cmds="sh /tmp/apt-go-fast")
 
     def configure_lxc_network(self, machine_id):
-        # upload our lxc-host-only template and setup bridge
+        # upload our lxc-host-only template and setup bridge, in a
+        # single round trip
         self.info_message('Copying network specifications to machine.')
         srcpath = path.join(self.config.tmpl_path, 'lxc-host-only')
         destpath = "/tmp/lxc-host-only"
-        utils.remote_cp(machine_id, src=srcpath, dst=destpath)
-        self.info_message('Updating network configuration for machine.')
-        utils.remote_run(machine_id,
-                         cmds="sudo chmod +x /tmp/lxc-host-only")
-        utils.remote_run(machine_id,
-                         cmds="sudo /tmp/lxc-host-only")
+        ret = utils.remote_bundle_run(
+            machine_id, {destpath: srcpath},
+            cmds=["chmod +x {}".format(destpath), destpath])
+        if ret['error']:
+            log.error("Unable to configure lxc network on machine {} "
+                      "({}): {}".format(machine_id, ret['error'],
+                                        ret['output']))
+        return ret
+
+    def mirror_charms(self):
+        """ Fetches the placed charms into the local charm repository and
+        uploads them to the environment, so that deploys do not each
+        fetch their charm from the charm store.
+
+        Charms that could not be mirrored are deployed from the store.
+
+        :returns: {charm name: local: charm url}
+        """
+        names = [cc.charm_name for cc in
+                 self.placement_controller.placed_charm_classes()
+                 if cc.from_charm_store and
+                 not self.journal.done(DEPLOY_ISSUED, cc.charm_name)]
+        if len(names) == 0:
+            return {}
+        self.info_message("Fetching charms")
+        try:
+            repo = LocalCharmRepository()
+            with tracer.span('mirror_charms', 'charmrepo'):
+                archives = repo.mirror(names)
+                return repo.upload(archives, self.juju_state_server(),
+                                   self.config.juju_api_password,
+                                   self.config.juju_env['ca-cert'])
+        except Exception:
+            log.exception("Unable to mirror charms, deploying them from "
+                          "the charm store")
+            return {}
 
     def deploy_using_placement(self):
-        """Deploy charms using machine placement from placement controller,
-        waiting for any deferred charms.  Then enqueue all charms for
-        further processing and return.
+        """Deploy charms using machine placement from placement controller.
+
+        Charms are deployed as soon as the charms they depend on (see
+        :class:`~cloudinstall.deploy.DeployGraph`) are ready, in
+        parallel. Returns once every placed charm's deploy is issued.
         """
 
         self.info_message("Verifying service deployments")
         placed_charm_classes = self.placement_controller.placed_charm_classes()
-        charm_classes = sorted(placed_charm_classes,
-                               key=attrgetter('deploy_priority'))
-
-        def undeployed_charm_classes():
-            return [c for c in charm_classes
-                    if c not in self.deployed_charm_classes]
-
-        def update_pending_display():
-            pending_names = [c.display_name for c in
-                             undeployed_charm_classes()]
-            self.ui.set_pending_deploys(pending_names)
-
-        while len(undeployed_charm_classes()) > 0:
-            update_pending_display()
-
-            for charm_class in undeployed_charm_classes():
-                self.info_message("Checking if {c} is deployed".format(
-                    c=charm_class.display_name))
-
-                service_names = [s.service_name for s in
-                                 self.juju_state.services]
-
-                if charm_class.charm_name in service_names:
-                    self.info_message("{c} is already deployed, "
-                                      "skipping".format(
-                                          c=charm_class.display_name))
-                    self.deployed_charm_classes.append(charm_class)
-                    continue
-
-                err = self.try_deploy(charm_class)
-                name = charm_class.display_name
-                if err:
-                    self.info_message("{} is waiting for another service, will"
-                                      " re-try in a few seconds.".format(name))
-                    break
-                else:
-                    log.debug("Issued deploy for {}".format(name))
-                    self.deployed_charm_classes.append(charm_class)
-
-                self.juju_state.invalidate_status_cache()
-                update_pending_display()
-
-            num_remaining = len(undeployed_charm_classes())
-            if num_remaining > 0:
-                log.debug("{} charms pending deploy.".format(num_remaining))
-                log.debug("deployed_charm_classes={}".format(
-                    PrettyLog(self.deployed_charm_classes)))
-
-                time.sleep(5)
-            update_pending_display()
-
+        graph = DeployGraph(placed_charm_classes)
+
+        def update_pending_display(pending):
+            self.ui.set_pending_deploys([c.display_name for c in pending])
+
+        def refresh():
+            self.juju_state.invalidate_status_cache()
+            services = self.juju_state.services
+            started = [s.service_name for s in services
+                       if any(u.agent_state == 'started' for u in s.units)]
+            return (set(s.service_name for s in services), set(started))
+
+        def deploy(charm_class):
+            name = charm_class.display_name
+            err = self.try_deploy(charm_class)
+            if err:
+                self.info_message("{} is waiting for another service, will"
+                                  " re-try shortly.".format(name))
+            else:
+                log.debug("Issued deploy for {}".format(name))
+                self.journal.record(DEPLOY_ISSUED, charm_class.charm_name)
+            return err
+
+        # journaled deploys count only if the service is really there
+        deployed, _ = refresh()
+        journaled = [cc for cc in graph.order
+                     if self.journal.done(DEPLOY_ISSUED, cc.charm_name) and
+                     cc.charm_name in deployed]
+        scheduler = DeployScheduler(graph, deploy, refresh,
+                                    on_update=update_pending_display,
+                                    issued=journaled)
+        self.deployed_charm_classes = scheduler.run()
+        log.debug("deployed_charm_classes={}".format(
+            PrettyLog(self.deployed_charm_classes)))
+        for op, (n, mean, worst) in self.deploy_executor.summary().items():
+            log.info("{} latency over {} calls: mean {:.2f}s, "
+                     "max {:.2f}s".format(op, n, mean, worst))
+
+    @traced('deploy')
     def try_deploy(self, charm_class):
         "returns True if deploy is deferred and should be tried again."
 
         charm = charm_class(juju=self.juju,
                             juju_state=self.juju_state,
                             ui=self.ui)
+        charm.charm_url = self.local_charm_urls.get(charm_class.charm_name)
 
         placements = self.placement_controller.machines_for_charm(charm_class)
         errs = []
-        first_deploy = True
+        mspecs = []
+        unresolved = []
         for atype, ml in placements.items():
             for machine in ml:
                 # get machine spec from atype and machine instance id:
                 mspec = self.get_machine_spec(machine, atype)
                 if mspec is None:
-                    errs.append(machine)
+                    unresolved.append((machine, atype))
                     continue
-                if first_deploy:
-                    self.info_message("Deploying {c} "
-                                      "to machine {mspec}".format(
-                                          c=charm_class.display_name,
-                                          mspec=mspec))
-                    deploy_err = charm.deploy(mspec)
-                    if deploy_err:
-                        errs.append(machine)
-                    else:
-                        first_deploy = False
+                mspecs.append((machine, mspec))
+
+        if len(unresolved) > 0:
+            # machines added since the map was last updated
+            with self.juju_m_idmap_lock:
+                self.juju_state.invalidate_status_cache()
+                self.update_juju_m_idmap()
+            for machine, atype in unresolved:
+                mspec = self.get_machine_spec(machine, atype)
+                if mspec is None:
+                    errs.append(machine)
                 else:
-                    # service already deployed, need to add-unit
-                    self.info_message("Adding one unit of {c} "
-                                      "to machine {mspec}".format(
-                                          c=charm_class.display_name,
-                                          mspec=mspec))
-                    deploy_err = charm.add_unit(machine_spec=mspec)
-                    if deploy_err:
-                        errs.append(machine)
+                    mspecs.append((machine, mspec))
+            if len(errs) > 0:
+                log.error("could not find juju machines for {}: {}".format(
+                    charm_class.display_name,
+                    ", ".join("{} (instance id {})".format(
+                        m, m.instance_id) for m in errs)))
+
+        # The service has to exist before units can be added to it, so
+        # the first deploy is waited on. Units for the remaining
+        # machines are then added in parallel.
+        while len(mspecs) > 0:
+            machine, mspec = mspecs.pop(0)
+            self.info_message("Deploying {c} "
+                              "to machine {mspec}".format(
+                                  c=charm_class.display_name,
+                                  mspec=mspec))
+            f = self.deploy_executor.submit('deploy', charm_class.charm_name,
+                                            mspec, charm.deploy, mspec)
+            if f.result():
+                errs.append(machine)
+            else:
+                break
+
+        futures = []
+        for machine, mspec in mspecs:
+            # service already deployed, need to add-unit
+            self.info_message("Adding one unit of {c} "
+                              "to machine {mspec}".format(
+                                  c=charm_class.display_name,
+                                  mspec=mspec))
+            f = self.deploy_executor.submit('add_unit', charm_class.charm_name,
+                                            mspec, charm.add_unit,
+                                            machine_spec=mspec)
+            futures.append((machine, f))
+        for machine, f in futures:
+            if f.result():
+                errs.append(machine)
 
         had_err = len(errs) > 0
         if had_err:
@@ -657,24 +862,20 @@ class Controller(DisplayController):
         return had_err
 
     def get_machine_spec(self, maas_machine, atype):
-        """Given a machine and assignment type, return a juju machine spec"""
-        jm = next((m for m in self.juju_state.machines()
-                   if (m.instance_id == maas_machine.instance_id
-                       or
-                       m.machine_id == maas_machine.machine_id)), None)
-        if jm is None:
-            log.error("could not find juju machine matching {}"
-                      " (instance id {})".format(maas_machine,
-                                                 maas_machine.instance_id))
-
+        """Given a machine and assignment type, return a juju machine spec,
+        or None if the machine is not in juju_m_idmap.
+        """
+        with self.juju_m_idmap_lock:
+            machine_id = self.juju_m_idmap.get(maas_machine.instance_id)
+        if machine_id is None:
             return None
 
         if atype == AssignmentType.BareMetal:
-            return jm.machine_id
+            return machine_id
         elif atype == AssignmentType.LXC:
-            return "lxc:{}".format(jm.machine_id)
+            return "lxc:{}".format(machine_id)
         elif atype == AssignmentType.KVM:
-            return "kvm:{}".format(jm.machine_id)
+            return "kvm:{}".format(machine_id)
         else:
             log.error("unexpected atype: {}".format(atype))
             return None
@@ -682,17 +883,26 @@ class Controller(DisplayController):
     def enqueue_deployed_charms(self):
         """Send all deployed charms to CharmQueue for relation setting and
         post-proc.
+
+        :returns: the CharmQueue
         """
+        # the charms package is only needed once deploying starts
+        from cloudinstall.charms import CharmQueue
 
         log.debug("Starting CharmQueue for relation setting and"
                   " post-processing enqueueing {}".format(
                       [c.charm_name for c in self.deployed_charm_classes]))
 
-        charm_q = CharmQueue(ui=self.ui)
-        for charm_class in self.deployed_charm_classes:
-            charm = charm_class(juju=self.juju, juju_state=self.juju_state,
-                                ui=self.ui)
-            charm_q.add_relation(charm)
+        charm_q = CharmQueue(ui=self.ui, juju_state=self.juju_state,
+                             journal=self.journal)
+        charms = [charm_class(juju=self.juju, juju_state=self.juju_state,
+                              ui=self.ui)
+                  for charm_class in self.deployed_charm_classes]
+        charm_q.add_relation(RelationPlanner(self.juju, self.juju_state,
+                                             charms, ui=self.ui,
+                                             executor=self.deploy_executor,
+                                             journal=self.journal))
+        for charm in charms:
             charm_q.add_post_proc(charm)
 
         charm_q.watch_relations()
@@ -704,18 +914,127 @@ class Controller(DisplayController):
             " pending. Please wait for all services to be checked before"
             " deploying compute nodes.")
         self.render_nodes(self.nodes, self.juju_state, self.maas_state)
+        return charm_q
+
+    @utils.async
+    def scale_out(self, charm_class, count):
+        """Adds count units of an already deployed charm, each on a
+        machine of its own.
+
+        On multi installs, empty MAAS machines satisfying the charm's
+        constraints are placed, added to juju in one batch and get a
+        unit each once started, in parallel. Progress of the machines
+        and units is shown in the status bar until every new unit is
+        started or in error, or until SCALE_OUT_TIMEOUT, when the units
+        that did not start are reported.
+        """
+        name = charm_class.display_name
+        self.juju_state.invalidate_status_cache()
+        existing_units = set(u.unit_name for u in
+                             self.juju_state.service(
+                                 charm_class.charm_name).units)
+
+        if not self.config.is_multi:
+            self.info_message("Adding {} units of {}".format(count, name))
+            self.juju.add_unit(charm_class.charm_name, num_units=count)
+        else:
+            machines = self.placement_controller.select_machines(
+                charm_class, count)
+            if len(machines) < count:
+                self.error_message("Only {} machines available for {} "
+                                   "of {} requested".format(
+                                       len(machines), count, name))
+            if len(machines) == 0:
+                return
+            count = len(machines)
+            self.maas.tag_name(self.maas.nodes)
+            self.add_machines_to_juju_multi(machines)
+
+            instance_ids = set(m.instance_id for m in machines)
+            deadline = time.time() + SCALE_OUT_TIMEOUT
+            while True:
+                self.juju_state.invalidate_status_cache()
+                started = set(jm.instance_id for jm
+                              in self.juju_state.machines()
+                              if jm.instance_id in instance_ids and
+                              jm.agent_state == 'started')
+                self.info_message("Adding {} units of {}: {}/{} machines "
+                                  "started".format(count, name, len(started),
+                                                   count))
+                if len(started) == count:
+                    break
+                if time.time() > deadline:
+                    self.error_message(
+                        "{} of {} machines for {} did not start within {} "
+                        "seconds".format(count - len(started), count, name,
+                                         SCALE_OUT_TIMEOUT))
+                    machines = [m for m in machines
+                                if m.instance_id in started]
+                    count = len(machines)
+                    break
+                time.sleep(3)
+
+            charm = charm_class(juju=self.juju, juju_state=self.juju_state,
+                                ui=self.ui)
+            futures = []
+            for m in machines:
+                mspec = self.get_machine_spec(m, AssignmentType.BareMetal)
+                if mspec is None:
+                    log.error("could not find juju machine for {}".format(m))
+                    continue
+                futures.append(self.deploy_executor.submit(
+                    'add_unit', charm_class.charm_name, mspec,
+                    charm.add_unit, machine_spec=mspec))
+            n_errs = count - len([f for f in futures if not f.result()])
+            if n_errs > 0:
+                self.error_message("{} of {} {} units could not be "
+                                   "added".format(n_errs, count, name))
+                count -= n_errs
+
+        deadline = time.time() + SCALE_OUT_TIMEOUT
+        while True:
+            self.juju_state.invalidate_status_cache()
+            new_units = [u for u in self.juju_state.service(
+                charm_class.charm_name).units
+                if u.unit_name not in existing_units]
+            n_started = len([u for u in new_units
+                             if u.agent_state == 'started'])
+            n_errors = len([u for u in new_units
+                            if u.agent_state == 'error'])
+            msg = "Adding {} units of {}: {}/{} units started".format(
+                count, name, n_started, count)
+            if n_errors > 0:
+                msg += ", {} in error".format(n_errors)
+            self.info_message(msg)
+            if n_started + n_errors >= count:
+                break
+            if time.time() > deadline:
+                self.error_message(
+                    "{} of {} {} units did not start within {} "
+                    "seconds".format(count - n_started - n_errors, count,
+                                     name, SCALE_OUT_TIMEOUT))
+                break
+            time.sleep(3)
 
     def add_charm(self, count=0, charm=None):
+        from cloudinstall.charms import CharmQueue, get_charm
+
         if not charm:
             self.ui.hide_add_charm_info()
             return
         svc = self.juju_state.service(charm)
-        if svc.service:
+        charm_class = next((cc for cc in utils.load_charm_manifest()
+                            if cc.charm_name == charm), None)
+        if svc.service and charm_class and charm_class.isolate and \
+           charm_class.allow_multi_units:
+            self.scale_out(charm_class, int(count))
+        elif svc.service:
             self.info_message("Adding {n} units of {charm}".format(
                 n=count, charm=charm))
             self.juju.add_unit(charm, num_units=int(count))
         else:
-            charm_q = CharmQueue(ui=self.ui)
+            charm_q = CharmQueue(ui=self.ui, juju_state=self.juju_state,
+                                 journal=self.journal)
             charm_sel = get_charm(charm,
                                   self.juju,
                                   self.juju_state,
@@ -0,0 +1,261 @@
+#
+# deploy.py - Dependency-ordered charm deployment
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Schedules charm deploys as a DAG derived from charm relations """
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.deploy')
+
+
+# Size of the DeployExecutor thread pool
+DEFAULT_MAX_WORKERS = 16
+
+# Juju API calls (deploy/add_unit) allowed in flight at once
+DEFAULT_MAX_IN_FLIGHT = 6
+
+
+class DeployGraphError(Exception):
+    pass
+
+
+DeployOp = namedtuple('DeployOp', ['op', 'charm_name', 'machine_spec',
+                                   'started', 'duration', 'error'])
+
+
+class DeployExecutor:
+    """ Runs deploy and add-unit operations on a bounded thread pool.
+
+    At most max_in_flight operations talk to the Juju state server at
+    once, however many callers are submitting. The latency of every
+    operation is recorded in ops.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.ops = []
+        self.lock = threading.Lock()
+
+    def _run(self, op, charm_name, machine_spec, fn, args, kwargs):
+        with self.in_flight:
+            start = time.time()
+            error = True
+            try:
+                error = fn(*args, **kwargs)
+                return error
+            finally:
+                duration = time.time() - start
+                log.debug("{} {} to {} took {:.2f}s{}".format(
+                    op, charm_name, machine_spec, duration,
+                    " (deferred)" if error else ""))
+                with self.lock:
+                    self.ops.append(DeployOp(op, charm_name, machine_spec,
+                                             start, duration, bool(error)))
+
+    def submit(self, op, charm_name, machine_spec, fn, *args, **kwargs):
+        """ Queues fn(*args, **kwargs), which returns True on error
+
+        :param str op: operation name for the latency record, eg 'deploy'
+        :returns: concurrent.futures.Future of fn's return value
+        """
+        return self.pool.submit(self._run, op, charm_name, machine_spec,
+                                fn, args, kwargs)
+
+    def summary(self):
+        """ Returns {op: (count, mean seconds, max seconds)} """
+        by_op = {}
+        with self.lock:
+            for o in self.ops:
+                by_op.setdefault(o.op, []).append(o.duration)
+        return {op: (len(d), sum(d) / len(d), max(d))
+                for op, d in by_op.items()}
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+class DeployGraph:
+    """ Deploy dependencies between a set of charm classes.
+
+    A charm waits for the deploy of every charm in its `related` list to
+    have been issued, and for every charm in its `deploy_prerequisites`
+    list to have a started unit. Charms outside the set are ignored.
+    """
+
+    def __init__(self, charm_classes):
+        self.charm_classes = list(charm_classes)
+        by_name = {cc.charm_name: cc for cc in self.charm_classes}
+        self.related = {}
+        self.prerequisites = {}
+        for cc in self.charm_classes:
+            self.related[cc] = [by_name[n] for n in cc.related
+                                if n in by_name and n != cc.charm_name]
+            self.prerequisites[cc] = [by_name[n] for n in
+                                      cc.deploy_prerequisites
+                                      if n in by_name]
+        self.order = self.topological_order()
+
+    def dependencies(self, charm_class):
+        """ All charm classes that charm_class waits on """
+        return set(self.related[charm_class] +
+                   self.prerequisites[charm_class])
+
+    def topological_order(self):
+        """ Returns charm classes with dependencies before dependants,
+        ties broken by deploy_priority.
+
+        Raises DeployGraphError if the dependencies contain a cycle.
+        """
+        order = []
+        remaining = sorted(self.charm_classes,
+                           key=lambda cc: (cc.deploy_priority,
+                                           cc.charm_name))
+        while remaining:
+            ready = [cc for cc in remaining
+                     if self.dependencies(cc).issubset(order)]
+            if not ready:
+                raise DeployGraphError("Cyclic deploy dependencies "
+                                       "between {}".format(remaining))
+            order += ready
+            remaining = [cc for cc in remaining if cc not in ready]
+        return order
+
+    def can_deploy(self, charm_class, issued, started):
+        """ True if charm_class's dependencies are met
+
+        :param issued: charm classes whose deploy has been issued
+        :param started: charm classes with at least one started unit
+        """
+        return (all(cc in issued for cc in self.related[charm_class]) and
+                all(cc in started for cc in
+                    self.prerequisites[charm_class]))
+
+
+class DeployScheduler:
+    """ Deploys every charm whose dependencies are met, in parallel.
+
+    deploy(charm_class) is called on a worker thread and returns True if
+    the deploy was deferred. Deferred charms are retried once the
+    environment has been refreshed again.
+
+    refresh() is called at most every poll_interval seconds, and
+    whenever a deploy finishes. It returns a pair of sets of service
+    names: (deployed services, services with a started unit).
+    """
+
+    def __init__(self, graph, deploy, refresh, poll_interval=3,
+                 on_update=None, issued=None):
+        """
+        :param issued: charm classes already known to be deployed, eg
+                       from the deployment journal
+        """
+        self.graph = graph
+        self.deploy = deploy
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.on_update = on_update
+        self.issued = list(issued or [])
+        self.started = set()
+        self.running = set()
+        self.deferred = {}
+        self.issue_times = {}
+        self.cv = threading.Condition()
+
+    def pending(self):
+        return [cc for cc in self.graph.order if cc not in self.issued]
+
+    def _update_from_environment(self):
+        deployed_names, started_names = self.refresh()
+        with self.cv:
+            for cc in self.pending():
+                if cc.charm_name in deployed_names and \
+                   cc not in self.running:
+                    log.debug("{} is already deployed".format(cc))
+                    self.issued.append(cc)
+            self.started = set(cc for cc in self.graph.charm_classes
+                               if cc.charm_name in started_names)
+
+    def _worker(self, charm_class):
+        try:
+            deferred = self.deploy(charm_class)
+        except Exception:
+            log.exception("Error deploying {}".format(charm_class))
+            deferred = True
+        with self.cv:
+            self.running.discard(charm_class)
+            if deferred:
+                self.deferred[charm_class] = \
+                    self.deferred.get(charm_class, 0) + 1
+            else:
+                self.issued.append(charm_class)
+                self.issue_times[charm_class] = time.time()
+            self.cv.notify_all()
+
+    def _start_runnable(self, retry_deferred):
+        for cc in self.pending():
+            if cc in self.running:
+                continue
+            if cc in self.deferred and not retry_deferred:
+                continue
+            if not self.graph.can_deploy(cc, self.issued, self.started):
+                continue
+            self.running.add(cc)
+            t = threading.Thread(target=self._worker, args=(cc,),
+                                 name="deploy-{}".format(cc.charm_name))
+            t.daemon = True
+            t.start()
+
+    def run(self):
+        """ Blocks until every charm's deploy has been issued.
+
+        :returns: charm classes in the order their deploys were issued
+        """
+        start_time = time.time()
+        last_refresh = 0
+        while len(self.pending()) > 0:
+            refreshed = False
+            if time.time() - last_refresh >= self.poll_interval:
+                self._update_from_environment()
+                last_refresh = time.time()
+                refreshed = True
+
+            with self.cv:
+                if len(self.pending()) == 0:
+                    break
+                self._start_runnable(retry_deferred=refreshed)
+                if self.on_update:
+                    self.on_update(self.pending())
+                n_issued = len(self.issued)
+                self.cv.wait(self.poll_interval)
+                if len(self.issued) > n_issued:
+                    # a deploy finished, dependants may be runnable now
+                    last_refresh = 0
+
+        log.debug("Deploys issued in {:.2f}s: {}".format(
+            time.time() - start_time,
+            ["{} (+{:.2f}s)".format(cc, self.issue_times[cc] - start_time)
+             for cc in self.issued if cc in self.issue_times]))
+        if self.on_update:
+            self.on_update([])
+        return self.issued
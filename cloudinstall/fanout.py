@@ -0,0 +1,142 @@
+#
+# fanout.py - Run remote operations on many machines at once
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fans a remote operation out to a set of Juju machines
+
+The operation is any function taking a machine id and returning a dict
+with a 'status' key, like utils.remote_run, utils.remote_cp or
+utils.remote_bundle_run. Machines run concurrently on a bounded pool and
+failed machines are retried.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from cloudinstall.trace import tracer
+
+log = logging.getLogger('cloudinstall.fanout')
+
+# Machines operated on at once
+DEFAULT_MAX_WORKERS = 8
+
+# Further attempts for a machine whose operation failed
+DEFAULT_RETRIES = 2
+
+# Seconds between attempts on a machine
+DEFAULT_RETRY_DELAY = 5
+
+
+FanOutResult = namedtuple('FanOutResult', ['machine_id', 'status',
+                                           'output', 'attempts',
+                                           'duration'])
+
+
+class FanOut:
+    """ Runs fn(machine_id, *args) on many machines concurrently.
+
+    Machines can be submitted as they become available, results are
+    collected per machine by wait().
+    """
+
+    def __init__(self, fn, name=None, max_workers=DEFAULT_MAX_WORKERS,
+                 retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+        """
+        :param fn: operation, returns a dict with 'status' and 'output'
+        :param str name: operation name for logs, defaults to fn's name
+        """
+        self.fn = fn
+        self.name = name or fn.__name__
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def _run(self, machine_id, args):
+        start = time.time()
+        attempts = 0
+        status, output = None, ''
+        while attempts <= self.retries:
+            if attempts > 0:
+                log.debug("Retrying {} on machine {} ({}): {}".format(
+                    self.name, machine_id, status, output))
+                time.sleep(self.retry_delay)
+            attempts += 1
+            with tracer.span(self.name, 'fanout', machine_id=machine_id):
+                try:
+                    ret = self.fn(machine_id, *args)
+                    status, output = ret['status'], ret['output']
+                except Exception as e:
+                    log.exception("{} on machine {} failed".format(
+                        self.name, machine_id))
+                    status, output = None, str(e)
+            if status == 0:
+                break
+        return FanOutResult(machine_id, status, output, attempts,
+                            time.time() - start)
+
+    def submit(self, machine_id, *args):
+        """ Starts the operation on machine_id, unless already submitted
+
+        :returns: concurrent.futures.Future of a FanOutResult
+        """
+        with self.lock:
+            if machine_id not in self.futures:
+                self.futures[machine_id] = self.pool.submit(
+                    self._run, machine_id, args)
+            return self.futures[machine_id]
+
+    def wait(self):
+        """ Blocks until every submitted machine is done
+
+        :returns: {machine_id: FanOutResult}
+        """
+        with self.lock:
+            futures = dict(self.futures)
+        results = {m: f.result() for m, f in futures.items()}
+        self.pool.shutdown()
+        self.log_summary(results)
+        return results
+
+    def run(self, machine_ids, *args):
+        """ Runs the operation on every machine and waits for them all
+
+        :returns: {machine_id: FanOutResult}
+        """
+        for m in machine_ids:
+            self.submit(m, *args)
+        return self.wait()
+
+    def log_summary(self, results):
+        if len(results) == 0:
+            return
+        failed = sorted(m for m, r in results.items() if r.status != 0)
+        durations = [r.duration for r in results.values()]
+        log.debug("{} on {} machines: mean {:.2f}s, max {:.2f}s, "
+                  "retried {}".format(
+                      self.name, len(results),
+                      sum(durations) / len(durations), max(durations),
+                      sorted(m for m, r in results.items()
+                             if r.attempts > 1)))
+        for m in failed:
+            log.error("{} failed on machine {} after {} attempts: "
+                      "{}".format(self.name, m, results[m].attempts,
+                                  results[m].output))
@@ -0,0 +1,123 @@
+#
+# inotify.py - Wait for files to appear without polling
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Waits for a path to be created, using the kernel's inotify through
+libc, so the wait sleeps until something changes
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import time
+
+log = logging.getLogger('cloudinstall.inotify')
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        try:
+            _libc = ctypes.CDLL(name, use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def available():
+    """ True if inotify can be used here """
+    libc = _load_libc()
+    return bool(libc) and hasattr(libc, 'inotify_init1')
+
+
+def _check(ret, what):
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, "{}: {}".format(what, os.strerror(e)))
+    return ret
+
+
+def wait_for_path(path, timeout=None, wake_interval=None,
+                  keep_waiting=None):
+    """ Blocks until path exists
+
+    Watches the deepest directory on the way to path that exists, and
+    moves down as the missing directories are created.
+
+    :param int timeout: seconds to wait, None waits forever
+    :param int wake_interval: also check path at least this often, eg to
+                              notice a watched directory that went away
+    :param keep_waiting: callable checked on every wakeup, the wait
+                         gives up once it returns False
+    :returns: True if path exists, False on timeout or if keep_waiting
+              returned False
+    :raises: OSError if inotify is not available
+    """
+    if not available():
+        raise OSError(errno.ENOSYS, "inotify is not available")
+    libc = _load_libc()
+    deadline = None if timeout is None else time.time() + timeout
+    fd = _check(libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK),
+                "inotify_init1")
+    try:
+        watched = None
+        while True:
+            if os.path.exists(path):
+                return True
+            if keep_waiting is not None and not keep_waiting():
+                return False
+            d = os.path.dirname(path)
+            while not os.path.isdir(d):
+                d = os.path.dirname(d)
+            if d != watched:
+                _check(libc.inotify_add_watch(
+                    fd, os.fsencode(d),
+                    IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF),
+                    "watching {}".format(d))
+                log.debug("Waiting for {} in {}".format(path, d))
+                watched = d
+                # path may have been created before the watch was added
+                continue
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return False
+            if wake_interval is not None:
+                wait = wake_interval if wait is None \
+                    else min(wait, wake_interval)
+            ready, _, _ = select.select([fd], [], [], wait)
+            if ready:
+                try:
+                    os.read(fd, 65536)
+                except BlockingIOError:
+                    pass
+    finally:
+        os.close(fd)
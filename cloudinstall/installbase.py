@@ -14,16 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import logging
-import os
+import threading
 import time
-import yaml
 
-from cloudinstall import utils
+from cloudinstall import aio, aptcache, utils
 from cloudinstall.config import Config
+from cloudinstall.timings import TimingStore, host_facts, new_run_id
+from cloudinstall.trace import tracer
 
 log = logging.getLogger('cloudinstall.installbase')
 
+# Environment variable handing the installer's start time to the
+# openstack-status it runs, for reports covering the whole install
+INSTALL_STARTED_ENV = 'CLOUD_INSTALL_STARTED'
+
 
 class InstallBase:
 
@@ -33,7 +39,7 @@ class InstallBase:
     To use: register a list of task names using register_tasks:
     self.register_tasks(["A", "B", "C"])
 
-    Then, in that same order, as tasks are started, call start_task:
+    Then, as tasks are started, call start_task:
 
     self.start_task("A")
     ... do A
@@ -43,6 +49,8 @@ class InstallBase:
     self.start_task("C")
     ... do C
 
+    Tasks that can overlap are run with run_task_graph instead, which
+    starts each task as soon as the tasks it depends on have finished.
     """
 
     def __init__(self, display_controller):
@@ -52,57 +60,230 @@ class InstallBase:
 
         self.tasks = []  # (name, starttime, endtime=None)
         self.tasks_started_debug = []
-        self.current_task_index = 0
+        self.task_deps = {}
+        self.task_progress = {}
+        self.task_markup = {}
+        self.last_markup = None
+        self.current_task = None
+        self.tasks_lock = threading.Lock()
+        self.timings = TimingStore()
+        self.run_id = new_run_id()
+        self.start_time = time.time()
+        # set by installers that know how many machines they deploy to
+        self.node_count = None
         # stop_current_task can be called from any thread, and uses
         # stop_called to tell update to not reschedule itself.
         self.stop_called = False
 
     def register_tasks(self, tasks):
-        self.tasks = [(n, None, None) for n in tasks]
-        self.max_width = max([len(n) for n in tasks])
+        """ Sets the tasks shown in the progress view, in order
 
-    def start_task(self, newtaskname):
-        self.tasks_started_debug.append(newtaskname)
+        :param tasks: task names, or (name, [names of the tasks it
+                      depends on]) tuples for use with run_task_graph
+        """
+        self.tasks = []
+        for t in tasks:
+            if isinstance(t, str):
+                name, deps = t, []
+            else:
+                name, deps = t
+            self.tasks.append((name, None, None))
+            if deps:
+                self.task_deps[name] = list(deps)
+        self.max_width = max([len(n) for (n, _, _) in self.tasks])
+        self.task_markup = {}
+
+    def _set_task(self, name, start, end):
+        with self.tasks_lock:
+            for i, (n, _, _) in enumerate(self.tasks):
+                if n == name:
+                    self.tasks[i] = (n, start, end)
+                    break
+            else:
+                log.error("unknown task {}, tasks: {}".format(name,
+                                                              self.tasks))
+                return False
+        return True
+
+    def task_times(self, name):
+        """ Returns (starttime, endtime) of a task, None if not set """
+        with self.tasks_lock:
+            for (n, s, e) in self.tasks:
+                if n == name:
+                    return (s, e)
+        return (None, None)
+
+    def begin_task(self, name):
+        """ Marks a task as running, alongside any others that are """
+        self.tasks_started_debug.append(name)
+        self._set_task(name, time.time(), None)
 
-        if len(self.tasks) <= self.current_task_index:
-            log.error("ran off end of task list, "
-                      "can't start {}".format(newtaskname))
+    def end_task(self, name):
+        """ Marks a running task as finished """
+        s, e = self.task_times(name)
+        if s is None or e is not None:
+            log.error("end_task: {} is not running.\n"
+                      "tasks_started: {}".format(name,
+                                                 self.tasks_started_debug))
             return
+        e = time.time()
+        if self._set_task(name, s, e):
+            tracer.complete(name, 'installer', s, e)
+            self.timings.record(self.run_id, name, s, e,
+                                host_facts(self.install_type(),
+                                           self.node_count))
+
+    def install_type(self):
+        """ Install type the timings of this run are compared within """
+        if self.config.is_landscape:
+            return 'landscape'
+        if self.config.is_multi:
+            if getattr(self, 'installing_new_maas', False):
+                return 'multi-new-maas'
+            return 'multi'
+        return 'single'
 
-        (n, s, e) = self.tasks[self.current_task_index]
-        if s is not None and e is None:
+    def start_task(self, newtaskname):
+        """ Stops the current task, if any, and starts newtaskname """
+        if self.current_task is not None:
             self.stop_current_task()
-            if len(self.tasks) <= self.current_task_index:
-                log.error("ran off end of task list")
-                return
-
-        (expectedname, _, _) = self.tasks[self.current_task_index]
-        if expectedname != newtaskname:
-            log.warning("task name: expected {}, got {}".format(expectedname,
-                                                                newtaskname))
-            log.info("tasks        : {}\n"
-                     "tasks_started: {}".format(self.tasks,
-                                                self.tasks_started_debug))
-
-        self.tasks[self.current_task_index] = (expectedname, time.time(), None)
+        self.begin_task(newtaskname)
+        self.current_task = newtaskname
         self.update_progress()
-        utils.spew(os.path.join(self.config.cfg_path, 'timings.yaml'),
-                   yaml.dump(self.tasks),
-                   utils.install_user())
 
     def stop_current_task(self):
-        if self.current_task_index >= len(self.tasks):
-            log.error("stop_current_task called too many times, skipping.\n "
-                      "self.tasks={}\nself.current_task_index={}\n"
+        if self.current_task is None:
+            log.error("stop_current_task called with no current task, "
+                      "skipping.\n self.tasks={}\n"
                       "tasks_started: {}".format(self.tasks,
-                                                 self.current_task_index,
                                                  self.tasks_started_debug))
             return
-        n, s, _ = self.tasks[self.current_task_index]
-        self.tasks[self.current_task_index] = (n, s, time.time())
-        self.current_task_index += 1
+        self.end_task(self.current_task)
+        self.current_task = None
         self.stop_called = True
 
+    def run_task_graph(self, graph):
+        """ Runs tasks concurrently, each as soon as its dependencies are
+        done, and reports the critical path once they all are.
+
+        Each task function is called on its own thread. If one raises,
+        the tasks still waiting are cancelled and the error re-raised.
+        The whole graph is checked before any task starts.
+
+        :param graph: (task name, function) tuples, with dependencies
+                      from register_tasks, or (task name, [names of
+                      tasks it depends on], function) tuples. Tasks are
+                      listed after the tasks they depend on.
+        """
+        entries = []
+        for entry in graph:
+            if len(entry) == 2:
+                name, fn = entry
+                deps = self.task_deps.get(name, [])
+            else:
+                name, deps, fn = entry
+            listed = [n for n, _, _ in entries]
+            unknown = [d for d in deps if d not in listed]
+            if unknown:
+                raise ValueError("{} depends on {}, which are not "
+                                 "listed before it".format(name, unknown))
+            entries.append((name, list(deps), fn))
+
+        tasks = {}
+
+        @asyncio.coroutine
+        def run_task(name, deps, fn):
+            for d in deps:
+                yield from tasks[d]
+            self.begin_task(name)
+            yield from aio.run_in_thread(fn)
+            self.end_task(name)
+
+        @asyncio.coroutine
+        def run_graph():
+            loop = asyncio.get_event_loop()
+            for name, deps, fn in entries:
+                self.task_deps[name] = deps
+                tasks[name] = loop.create_task(run_task(name, deps, fn))
+            yield from aio.gather(*tasks.values())
+
+        aio.run_until_complete(run_graph())
+        self.report_critical_path()
+
+    def critical_path(self):
+        """ The chain of finished tasks that the last one to finish
+        waited on, each preceded by the dependency that finished last.
+
+        :returns: [(name, duration)] in execution order
+        """
+        with self.tasks_lock:
+            times = {n: (s, e) for (n, s, e) in self.tasks
+                     if e is not None}
+        if len(times) == 0:
+            return []
+        name = max(times, key=lambda n: times[n][1])
+        path = [name]
+        while True:
+            deps = [d for d in self.task_deps.get(name, []) if d in times]
+            if len(deps) == 0:
+                break
+            name = max(deps, key=lambda d: times[d][1])
+            path.append(name)
+        return [(n, times[n][1] - times[n][0]) for n in reversed(path)]
+
+    def report_critical_path(self):
+        """ Shows the chain of tasks the install waited on """
+        path = self.critical_path()
+        if len(path) == 0:
+            return
+        msg = "Critical path: " + " -> ".join(
+            "{} ({:.0f}s)".format(n, d) for n, d in path)
+        log.info(msg)
+        self.display_controller.info_message(msg)
+
+    def report_apt_cache(self):
+        """ Logs the apt cache's hit rate since the install started, if
+        packages went through it
+        """
+        msg = aptcache.summary(since=self.start_time)
+        if msg is not None:
+            log.info(msg)
+
+    def set_task_progress(self, name, progress):
+        """ Shows progress within a task next to its time
+
+        :param str progress: eg "3/5 nodes ready" or "120/400 MB"
+        """
+        with self.tasks_lock:
+            self.task_progress[name] = progress
+
+    def _waiting_for(self, name, finished):
+        waiting = [d for d in self.task_deps.get(name, [])
+                   if d not in finished]
+        if len(waiting) == 0:
+            return ''
+        return "waiting for {}".format(", ".join(waiting))
+
+    def _task_markup(self, n, s, e, progress, finished):
+        """ Markup for a task that is not running, cached until its
+        state changes
+        """
+        if s is None:
+            key = (s, e, self._waiting_for(n, finished))
+        else:
+            key = (s, e, progress)
+        cached = self.task_markup.get(n)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if s is None:
+            ts, extra = '   -', key[2]
+        else:
+            ts, extra = "{:6.2f} sec".format(e - s), progress
+        markup = ('label', "{n:>{mw}}: {ts:<22}{x}\n".format(
+            n=n, mw=self.max_width, ts=ts, x=extra))
+        self.task_markup[n] = (key, markup)
+        return markup
+
     def update_progress(self, loop=None, userdata=None):
         if self.stop_called:
             # if stop_called was set in a separate thread, return and
@@ -111,23 +292,27 @@ class InstallBase:
             return
 
         m = []
-        for (n, s, e) in self.tasks:
-            if s is None:
-                m.append(('label', "{n:>{mw}}: "
-                          "{ts:<22}\n".format(n=n, mw=self.max_width,
-                                              ts='   -')))
-            elif e is None:
-                e = time.time()
-                ts = "{:6.2f} sec elapsed".format(e - s)
-                m.append("{n:>{mw}}: {ts:<22}"
-                         "\n".format(n=n, mw=self.max_width, ts=ts))
+        now = time.time()
+        with self.tasks_lock:
+            tasks = list(self.tasks)
+            task_progress = dict(self.task_progress)
+        finished = set(n for (n, s, e) in tasks if e is not None)
+        running = False
+        for (n, s, e) in tasks:
+            progress = task_progress.get(n, '')
+            if s is not None and e is None:
+                # only running tasks change on every update
+                running = True
+                ts = "{:6.2f} sec elapsed".format(now - s)
+                m.append("{n:>{mw}}: {ts:<22}{p}"
+                         "\n".format(n=n, mw=self.max_width, ts=ts,
+                                     p=progress))
             else:
-                ts = "{:6.2f} sec".format(e - s)
-                m.append(('label', "{n:>{mw}}: {ts:<22}"
-                          "\n".format(n=n, mw=self.max_width,
-                                      ts=ts)))
+                m.append(self._task_markup(n, s, e, progress, finished))
 
-        self.display_controller.render_node_install_wait(m)
+        if running or m != self.last_markup:
+            self.display_controller.render_node_install_wait(m)
+            self.last_markup = m
         self.display_controller.loop.set_alarm_in(0.6, self.update_progress)
 
 
@@ -0,0 +1,142 @@
+#
+# journal.py - Write-ahead deployment journal
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Records completed deployment steps so a restart can skip them
+
+The journal is a file of JSON lines, one per completed step, each
+written and fsync'd before the step is considered done.
+
+A journal belongs to one Juju environment. Its first step records the
+environment's identity, and a journal written for another environment,
+eg before a re-bootstrap, is set aside rather than replayed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.journal')
+
+JOURNAL_FILENAME = 'deploy-journal.jsonl'
+
+# Step names
+ENVIRONMENT = 'environment'
+MACHINE_ADDED = 'machine-added'
+DEPLOY_ISSUED = 'deploy-issued'
+RELATION_ADDED = 'relation-added'
+POST_PROC_DONE = 'post-proc-done'
+
+
+def environment_id(juju_env):
+    """ Identifies a bootstrapped Juju environment
+
+    :param dict juju_env: contents of the environment's .jenv file
+    :returns: the environment uuid, or a digest of the CA certificate
+              that bootstrap generated if juju does not record a uuid
+    """
+    if juju_env.get('environ-uuid'):
+        return juju_env['environ-uuid']
+    return hashlib.sha256(
+        juju_env.get('ca-cert', '').encode('utf-8')).hexdigest()
+
+
+class DeployJournal:
+    """ Append-only journal of completed deployment steps """
+
+    def __init__(self, filename, environment=None):
+        """
+        :param str filename: journal path, created on first record
+        :param str environment: from environment_id(), if given a
+                                journal of another environment is
+                                discarded
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.steps = {}
+        self._replay()
+        if environment is None:
+            return
+        if len(self.steps) > 0 and \
+           self.keys(ENVIRONMENT) != [environment]:
+            stale = self.filename + '.stale'
+            log.warning("{} belongs to another juju environment, moved "
+                        "to {}".format(self.filename, stale))
+            os.rename(self.filename, stale)
+            self.steps = {}
+        if not self.done(ENVIRONMENT, environment):
+            self.record(ENVIRONMENT, environment)
+
+    def _replay(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            contents = f.read()
+        if not contents.endswith("\n"):
+            # a write interrupted by a crash leaves a partial last line,
+            # drop it so later records start on a line of their own
+            good = contents.rfind("\n") + 1
+            log.warning("Dropping partial journal entry: "
+                        "{}".format(contents[good:]))
+            with open(self.filename, 'r+') as f:
+                f.truncate(good)
+            contents = contents[:good]
+        n = 0
+        for line in contents.splitlines():
+            try:
+                entry = json.loads(line)
+                self.steps[(entry['step'], entry['key'])] = entry['data']
+            except (ValueError, TypeError, KeyError):
+                log.warning("Skipping undecodable journal entry: "
+                            "{}".format(line))
+                continue
+            n += 1
+        log.info("Replayed {} steps from {}".format(n, self.filename))
+
+    def record(self, step, key, **data):
+        """ Durably records that a step completed
+
+        :param str step: one of the step names above
+        :param str key: what the step applied to, eg a charm name
+        :param data: JSON-serialisable details to keep with the step
+        """
+        entry = dict(step=step, key=key, data=data, time=time.time())
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.steps[(step, key)] = data
+        log.debug("journal: {} {}".format(step, key))
+
+    def done(self, step, key):
+        """ True if the step has been recorded for key """
+        with self.lock:
+            return (step, key) in self.steps
+
+    def data(self, step, key):
+        """ Returns the data recorded with a step, or None """
+        with self.lock:
+            return self.steps.get((step, key))
+
+    def keys(self, step):
+        """ Returns every key recorded for step """
+        with self.lock:
+            return [k for s, k in self.steps if s == step]
@@ -20,6 +20,7 @@
 
 from collections import Counter
 import logging
+import threading
 import time
 
 from cloudinstall.config import Config
@@ -41,6 +42,8 @@ class JujuState:
         self.juju = juju
         self.start_time = time.time()
         self._juju_status = None
+        # deploy threads share one JujuState, only one of them fetches
+        self._status_lock = threading.Lock()
         self.valid_states = ['pending', 'started', 'down']
 
     def status(self):
@@ -50,17 +53,19 @@ class JujuState:
         Call invalidate_status_cache() to force next status call to
         fetch from server.
         """
-        elapsed_time = time.time() - self.start_time
-        if not self._juju_status or elapsed_time > 20:
-            self._juju_status = self.juju.status()
-            self.start_time = time.time()
-        return self._juju_status
+        with self._status_lock:
+            elapsed_time = time.time() - self.start_time
+            if not self._juju_status or elapsed_time > 20:
+                self._juju_status = self.juju.status()
+                self.start_time = time.time()
+            return self._juju_status
 
     def invalidate_status_cache(self):
         """Invalidates cache of status.  Use this to force fetching from
         server more often than every 20 seconds.
         """
-        self._juju_status = None
+        with self._status_lock:
+            self._juju_status = None
 
     def machines_summary(self):
         """ Returns summary of known machines and their status
@@ -0,0 +1,176 @@
+#
+# bootimages.py - MAAS boot image import progress
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tracks how far a MAAS boot image import has got
+
+Progress comes from the boot resources MAAS reports, with the sizes of
+their files and how much of each is complete, and from the growth of the
+boot resources storage directory on disk, whichever is further along.
+"""
+
+from collections import deque, namedtuple
+import logging
+import os
+import time
+
+log = logging.getLogger('cloudinstall.maas.bootimages')
+
+# storage from share/templates/bootresources.yaml
+BOOT_RESOURCES_STORAGE = '/var/lib/maas/boot-resources'
+
+# Seconds without any progress before an import is considered stalled
+DEFAULT_STALL_TIMEOUT = 600
+
+# Seconds of samples the throughput is averaged over
+DEFAULT_RATE_WINDOW = 120
+
+
+class BootImageImportStalled(Exception):
+    """ The import has not made progress for too long """
+
+
+ImportProgress = namedtuple('ImportProgress', ['done', 'total', 'rate',
+                                               'eta'])
+
+
+def resource_bytes(resource):
+    """ Bytes imported and total bytes of one boot resource
+
+    :param dict resource: output of `maas <profile> boot-resource read`
+    :returns: (done, total), total is None if MAAS does not report it
+    """
+    sets = resource.get('sets') or {}
+    if len(sets) == 0:
+        return (0, None)
+    # set names are version dates, the newest is the one being imported
+    latest = sets[max(sets)]
+    files = latest.get('files') or {}
+    total = latest.get('size')
+    if total is None and files:
+        total = sum(f.get('size', 0) for f in files.values())
+    if latest.get('complete'):
+        return (total or 0, total)
+    if latest.get('progress') is not None and total:
+        return (int(total * latest['progress'] / 100), total)
+    done = 0
+    for f in files.values():
+        if f.get('complete'):
+            done += f.get('size', 0)
+        elif f.get('progress') is not None:
+            done += int(f.get('size', 0) * f['progress'] / 100)
+    return (done, total)
+
+
+def disk_usage(path):
+    """ Bytes in the files under path, 0 if it does not exist """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # files come and go while the import runs
+                pass
+    return total
+
+
+def format_bytes(n):
+    return "{:.0f} MB".format(n / 1024 / 1024)
+
+
+def format_progress(progress):
+    """ eg "120/400 MB, 3.2 MB/s, 1:27 left" """
+    if progress.total:
+        parts = ["{:.0f}/{}".format(progress.done / 1024 / 1024,
+                                    format_bytes(progress.total))]
+    else:
+        parts = [format_bytes(progress.done)]
+    if progress.rate:
+        parts.append("{:.1f} MB/s".format(progress.rate / 1024 / 1024))
+    if progress.eta is not None:
+        parts.append("{}:{:02d} left".format(int(progress.eta) // 60,
+                                             int(progress.eta) % 60))
+    return ", ".join(parts)
+
+
+class BootImageTracker:
+    """ Samples an import's progress and notices when it stalls.
+
+    An import stalls when neither MAAS nor the disk show new bytes for
+    stall_timeout seconds before every byte is downloaded.
+    """
+
+    def __init__(self, read_resources, storage=BOOT_RESOURCES_STORAGE,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT,
+                 rate_window=DEFAULT_RATE_WINDOW):
+        """
+        :param read_resources: returns the boot resources as read from
+                               MAAS, an empty list if they are unavailable
+        :param str storage: boot resources directory, measured for the
+                            bytes written by the import
+        """
+        self.read_resources = read_resources
+        self.storage = storage
+        self.stall_timeout = stall_timeout
+        self.rate_window = rate_window
+        self.disk_start = disk_usage(storage)
+        self.samples = deque()
+        self.best = -1
+        self.last_progress = time.time()
+
+    def sample(self):
+        """ Measures the import's progress
+
+        :rtype: ImportProgress
+        :raises: BootImageImportStalled
+        """
+        now = time.time()
+        done, total = 0, 0
+        for resource in self.read_resources():
+            d, t = resource_bytes(resource)
+            done += d
+            total = None if t is None or total is None else total + t
+        done = max(done, disk_usage(self.storage) - self.disk_start)
+        if total:
+            done = min(done, total)
+        else:
+            total = None
+
+        if done > self.best:
+            self.best = done
+            self.last_progress = now
+        elif now - self.last_progress > self.stall_timeout and \
+                not (total and done >= total):
+            # once everything is downloaded MAAS still has to unpack
+            # and register the images, which is not measured
+            raise BootImageImportStalled(
+                "Boot image import made no progress for {:.0f} seconds "
+                "at {}".format(now - self.last_progress,
+                               format_bytes(done)))
+
+        self.samples.append((now, done))
+        while self.samples[0][0] < now - self.rate_window:
+            self.samples.popleft()
+        t0, d0 = self.samples[0]
+        rate = (done - d0) / (now - t0) if now > t0 else None
+        eta = None
+        if rate and total:
+            eta = (total - done) / rate
+        progress = ImportProgress(done, total, rate, eta)
+        log.debug("Boot image import: {}".format(format_progress(progress)))
+        return progress
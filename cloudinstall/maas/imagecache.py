@@ -0,0 +1,199 @@
+#
+# imagecache.py - Local simplestreams mirror of MAAS boot images
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Caches MAAS boot images across installs
+
+Boot image files are stored once under objects/, named by their sha256,
+in a directory that uninstalling leaves alone. mirror/ is a simplestreams
+tree for MAAS to import from: the signed index and product files are
+copied from upstream as they are, and each image file selected by
+bootresources.yaml is a link to its object. Only files missing from the
+cache are downloaded, so repeat installs import at disk speed.
+"""
+
+import json
+import logging
+import os
+import re
+
+import requests
+
+from cloudinstall import utils
+
+log = logging.getLogger('cloudinstall.maas.imagecache')
+
+IMAGE_CACHE_DIR = '/var/cache/cloud-install/boot-images'
+
+UPSTREAM_URL = 'http://maas.ubuntu.com/images/ephemeral-v2/releases/'
+
+# The mirror is published by the MAAS apache server
+MIRROR_WEB_PATH = '/var/www/html/cloud-install-images'
+MIRROR_URL = 'http://localhost/cloud-install-images/'
+
+INDEX_PATH = 'streams/v1/index.sjson'
+
+SIGNED_JSON = re.compile(r'-----BEGIN PGP SIGNED MESSAGE-----\n'
+                         r'(?:[^\n]+\n)*\n(.*)\n-----BEGIN PGP SIGNATURE',
+                         re.DOTALL)
+
+
+class ImageCacheError(Exception):
+    """ A boot image could not be added to the cache """
+
+
+def read_signed_json(content):
+    """ Parses simplestreams json, clearsigned or not """
+    m = SIGNED_JSON.search(content)
+    return json.loads(m.group(1) if m else content)
+
+
+def _matches(value, wanted):
+    if wanted is None:
+        return True
+    if isinstance(wanted, str):
+        wanted = [wanted]
+    return '*' in wanted or value in wanted
+
+
+def selected(product, selections):
+    """ True if a simplestreams product matches any of the selections
+    of a bootresources.yaml source
+    """
+    for s in selections:
+        if _matches(product.get('release'), s.get('release')) and \
+           _matches(product.get('arch'), s.get('arches')) and \
+           _matches(product.get('subarch'), s.get('subarches')) and \
+           _matches(product.get('label'), s.get('labels')):
+            return True
+    return False
+
+
+class BootImageCache:
+    """ Content-addressed store of boot image files, with a simplestreams
+    mirror of the selected images on top
+    """
+
+    def __init__(self, root=IMAGE_CACHE_DIR, upstream=UPSTREAM_URL,
+                 fetch=utils.http_fetch):
+        """
+        :param str upstream: simplestreams URL mirrored, ending in /
+        :param fetch: fetch(url) yields the contents of url in chunks
+        """
+        self.root = root
+        self.upstream = upstream
+        self.fetch = fetch
+        self.objects = os.path.join(root, 'objects')
+        self.mirror = os.path.join(root, 'mirror')
+        self.hits = 0
+        self.misses = 0
+        self.bytes_fetched = 0
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects, sha256[:2], sha256)
+
+    def _download(self, url, dest, sha256=None, on_chunk=None):
+        def counted(n):
+            self.bytes_fetched += n
+            if on_chunk:
+                on_chunk(n)
+
+        try:
+            utils.download(url, dest, self.fetch, sha256, counted)
+        except utils.ChecksumMismatch as e:
+            raise ImageCacheError(str(e))
+
+    def _metadata(self, path):
+        """ Mirrors a simplestreams metadata file, keeping the last good
+        copy if upstream cannot be reached
+        """
+        dest = os.path.join(self.mirror, path)
+        try:
+            self._download(self.upstream + path, dest)
+        except (requests.RequestException, OSError) as e:
+            if not os.path.exists(dest):
+                raise ImageCacheError("Unable to fetch {}{}: {}".format(
+                    self.upstream, path, e))
+            log.warning("Using cached {}, upstream failed: {}".format(
+                path, e))
+        with open(dest) as f:
+            return read_signed_json(f.read())
+
+    def selected_items(self, selections):
+        """ The files of the latest version of every selected product
+
+        :param list selections: selections of a bootresources.yaml source
+        :returns: [(product name, version, item dict)]
+        """
+        index = self._metadata(INDEX_PATH)
+        items = []
+        for name, stream in sorted(index['index'].items()):
+            if stream.get('datatype') != 'image-downloads':
+                continue
+            products = self._metadata(stream['path'])['products']
+            for pname, product in sorted(products.items()):
+                if not selected(product, selections):
+                    continue
+                version = max(product['versions'])
+                for item in product['versions'][version]['items'].values():
+                    items.append((pname, version, item))
+        return items
+
+    def sync(self, selections, on_progress=None):
+        """ Fetches the selected images that are not cached yet and
+        links them into the mirror
+
+        :param on_progress: called with (bytes done, bytes total) as
+                            files are fetched
+        :returns: (files already cached, files fetched)
+        """
+        items = self.selected_items(selections)
+        # products can share files, each is fetched once
+        missing = {i['sha256']: i for (_, _, i) in items
+                   if not os.path.exists(self.object_path(i['sha256']))}
+        missing = list(missing.values())
+        total = sum(i.get('size', 0) for i in missing)
+        done = [0]
+
+        def on_chunk(n):
+            done[0] += n
+            if on_progress:
+                on_progress(done[0], total)
+
+        for item in missing:
+            self._download(self.upstream + item['path'],
+                           self.object_path(item['sha256']),
+                           item['sha256'], on_chunk)
+        for (_, _, item) in items:
+            link = os.path.join(self.mirror, item['path'])
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.object_path(item['sha256']), link)
+
+        hits = len(set(i['sha256'] for (_, _, i) in items)) - len(missing)
+        self.hits += hits
+        self.misses += len(missing)
+        log.info("Boot image cache: {} files cached, {} fetched ({} "
+                 "bytes)".format(hits, len(missing), self.bytes_fetched))
+        return (hits, len(missing))
+
+    def publish(self, web_path=MIRROR_WEB_PATH):
+        """ Makes the mirror available to MAAS at MIRROR_URL """
+        if os.path.lexists(web_path):
+            os.remove(web_path)
+        os.symlink(self.mirror, web_path)
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import glob
 from ipaddress import ip_address, ip_network
 import json
@@ -22,18 +23,27 @@ import os
 import pwd
 import re
 import time
+import yaml
 
 from subprocess import check_output
 from tempfile import TemporaryDirectory
 
 from cloudinstall.config import Config
-from cloudinstall.installbase import InstallBase
+from cloudinstall.installbase import InstallBase, INSTALL_STARTED_ENV
+from cloudinstall.maas.bootimages import (BootImageTracker,
+                                          BootImageImportStalled,
+                                          format_progress)
+from cloudinstall.maas.imagecache import (BootImageCache, ImageCacheError,
+                                          MIRROR_URL, UPSTREAM_URL)
+from maasclient.auth import MaasAuth
+from maasclient import MaasClient
+from cloudinstall.trace import tracer
 from cloudinstall.netutils import (get_ip_addr, get_bcast_addr, get_network,
                                    get_default_gateway, get_netmask,
                                    get_network_interfaces,
                                    ip_range_max)
 
-from cloudinstall import utils
+from cloudinstall import aio, aptcache, process, utils
 
 
 log = logging.getLogger('cloudinstall.multi_install')
@@ -77,6 +87,7 @@ class MultiInstall(InstallBase):
         else:
             self.post_tasks = []
         self.installing_new_maas = False
+        self.apt_proxy = None
         # Sets install type
         if not self.config.is_landscape:
             utils.spew(os.path.join(self.config.cfg_path,
@@ -97,15 +108,28 @@ class MultiInstall(InstallBase):
                 raise MaasInstallError(
                     "Unable to set ownership for {}".format(d))
 
+    def maas_node_count(self):
+        """ Nodes MAAS knows about, None if MAAS cannot be asked """
+        maas_creds = self.config.maas_creds
+        auth = MaasAuth(api_url='http://{}/MAAS/api/1.0/'.format(
+            maas_creds['api_host']), api_key=maas_creds['api_key'])
+        try:
+            return len(MaasClient(auth).nodes)
+        except Exception:
+            log.exception("Unable to count MAAS nodes")
+            return None
+
     def do_install(self):
         self.start_task("Starting Juju server")
+        self.node_count = self.maas_node_count()
 
         maas_creds = self.config.maas_creds
         maas_env = utils.load_template('juju-env/maas.yaml')
         maas_env_modified = maas_env.render(
             maas_server=maas_creds['api_host'],
             maas_apikey=maas_creds['api_key'],
-            openstack_password=self.config.openstack_password)
+            openstack_password=self.config.openstack_password,
+            apt_proxy=self.apt_proxy)
         check_output(['mkdir', '-p', self.config.juju_path])
         utils.spew(self.config.juju_environments_path,
                    maas_env_modified)
@@ -126,22 +150,25 @@ class MultiInstall(InstallBase):
         # Starts the party
         self.display_controller.info_message("Bootstrapping juju ..")
 
-        dbgflags = ""
+        dbgflags = []
         if os.getenv("DEBUG_JUJU_BOOTSTRAP"):
-            dbgflags = "--debug"
+            dbgflags = ["--debug"]
 
-        bsflags = ""
+        bsflags = []
         # FIXME: this tag is never defined, removing to allow
         # installers to work again
         # if not self.installing_new_maas:
-        #    bsflags = " --constraints tags=physical"
+        #    bsflags = ["--constraints", "tags=physical"]
 
-        out = utils.get_command_output("juju {} bootstrap {}".format(dbgflags,
-                                                                     bsflags),
-                                       timeout=None,
-                                       user_sudo=True)
-        if out['status'] != 0:
-            log.debug("Problem during bootstrap: '{}'".format(out))
+        def show_progress(line):
+            self.display_controller.info_message(
+                "Bootstrapping juju: {}".format(line.strip()[:60]))
+
+        out = aio.run_until_complete(aio.run_command(
+            ["juju"] + dbgflags + ["bootstrap"] + bsflags,
+            user=utils.install_user(), on_line=show_progress))
+        if out.status != 0:
+            log.debug("Problem during bootstrap: '{}'".format(out.output))
             raise Exception("Problem with juju bootstrap.")
 
         # workaround to avoid connection failure at beginning of
@@ -167,6 +194,9 @@ class MultiInstall(InstallBase):
                 args.append('--placement')
 
             self.drop_privileges()
+            os.environ[INSTALL_STARTED_ENV] = str(self.start_time)
+            # exec skips the atexit handler that writes the trace
+            tracer.write()
             os.execvp('openstack-status', args)
         else:
             log.debug("Finished MAAS step, now deploying Landscape.")
@@ -210,13 +240,23 @@ class MultiInstallNewMaas(MultiInstall):
 
     def run(self):
         self.installing_new_maas = True
-        self.register_tasks(["Installing MAAS",
-                             "Configuring MAAS",
-                             "Waiting for MAAS cluster registration",
-                             "Searching for existing DHCP servers",
-                             "Configuring MAAS networks",
-                             "Importing MAAS boot images",
-                             "Creating KVM for Juju state server",
+        registration = "Waiting for MAAS cluster registration"
+        dhcp_search = "Searching for existing DHCP servers"
+        networks = "Configuring MAAS networks"
+        images = "Importing MAAS boot images"
+        # the DHCP search runs alongside the MAAS install. Configuring
+        # the networks takes the interface down to move it into br0, so
+        # boot images are only downloaded once it is done. virt-install
+        # PXE boots the juju state server's KVM as soon as it is
+        # defined, so that has to wait for the images too.
+        self.register_tasks([("Installing MAAS", []),
+                             ("Configuring MAAS", ["Installing MAAS"]),
+                             (registration, ["Configuring MAAS"]),
+                             (dhcp_search, []),
+                             (networks, [registration, dhcp_search]),
+                             (images, [networks]),
+                             ("Creating KVM for Juju state server",
+                              [images]),
                              "Starting Juju server"] +
                             self.post_tasks)
 
@@ -245,19 +285,34 @@ class MultiInstallNewMaas(MultiInstall):
     @utils.async
     def continue_with_interface(self):
         self.display_controller.ui.hide_widget_on_top()
-        self.start_task("Installing MAAS")
 
-        check_output('mkdir -p /etc/openstack', shell=True)
-        check_output(['cp', '/etc/network/interfaces',
-                      '/etc/openstack/interfaces.cloud.bak'])
-        check_output(['cp', '-r', '/etc/network/interfaces.d',
-                      '/etc/openstack/interfaces.cloud.d.bak'])
+        self.run_task_graph([
+            ("Installing MAAS", self.install_maas),
+            ("Searching for existing DHCP servers", self.search_for_dhcp),
+            ("Configuring MAAS", self.configure_maas),
+            ("Waiting for MAAS cluster registration", self.register_cluster),
+            ("Configuring MAAS networks", self.configure_networks),
+            ("Importing MAAS boot images", self.import_boot_images),
+            ("Creating KVM for Juju state server",
+             lambda: aio.run_until_complete(self.create_bootstrap_kvm()))])
+
+        self.do_install()
+
+    def install_maas(self):
+        os.makedirs('/etc/openstack', exist_ok=True)
+        aio.run_until_complete(aio.gather(
+            aio.check_command(['cp', '/etc/network/interfaces',
+                               '/etc/openstack/interfaces.cloud.bak']),
+            aio.check_command(['cp', '-r', '/etc/network/interfaces.d',
+                               '/etc/openstack/interfaces.cloud.d.bak'])))
 
         utils.spew('/etc/openstack/interface', self.target_iface)
 
+        if aptcache.start():
+            aptcache.use_on_host()
         utils.apt_install('openstack-multi')
 
-        self.start_task("Configuring MAAS")
+    def configure_maas(self):
         self.create_superuser()
         self.apikey = self.get_apikey()
 
@@ -271,14 +326,38 @@ class MultiInstallNewMaas(MultiInstall):
             raise MaasInstallError("Unable to set permissions on {}".format(
                 os.path.join(utils.install_home(), '.maascli.db')))
 
-        self.start_task("Waiting for MAAS cluster registration")
-        cluster_uuid = self.wait_for_registration()
+        if "MAAS_HTTP_PROXY" in os.environ:
+            self.set_maas_http_proxy(os.environ['MAAS_HTTP_PROXY'])
+
+    def set_maas_http_proxy(self, pv):
+        out = utils.get_command_output('maas maas maas set-config '
+                                       'name=http_proxy '
+                                       'value={}'.format(pv))
+        if out['status'] != 0:
+            log.debug("Error setting maas proxy config: {}".format(out))
+            raise MaasInstallError("Error setting proxy config")
+
+    def configure_apt_proxy(self):
+        """ Points nodes at the host's apt cache, unless MAAS was given a
+        proxy. Needs br0, the address nodes reach the host at
+        """
+        if "MAAS_HTTP_PROXY" in os.environ or not aptcache.listening():
+            return
+        bridge_address = get_ip_addr('br0')
+        if not aptcache.start([bridge_address]):
+            return
+        self.apt_proxy = aptcache.proxy_url(bridge_address)
+        self.set_maas_http_proxy(self.apt_proxy)
+
+    def register_cluster(self):
+        self.cluster_uuid = self.wait_for_registration()
+
+    def configure_networks(self):
         self.create_maas_bridge(self.target_iface)
 
         self.prompt_for_bridge()
 
-        self.start_task("Configuring MAAS networks")
-        self.configure_maas_networking(cluster_uuid,
+        self.configure_maas_networking(self.cluster_uuid,
                                        'br0',
                                        self.gateway,
                                        self.dhcp_range,
@@ -286,41 +365,102 @@ class MultiInstallNewMaas(MultiInstall):
 
         self.configure_dns()
 
+        self.configure_apt_proxy()
+
         self.config.save_maas_creds(self.gateway,
                                     self.apikey)
 
-        if "MAAS_HTTP_PROXY" in os.environ:
-            pv = os.environ['MAAS_HTTP_PROXY']
-            out = utils.get_command_output('maas maas maas set-config '
-                                           'name=http_proxy '
-                                           'value={}'.format(pv))
+    def use_boot_image_cache(self):
+        """ Fills the local boot image cache and points MAAS at it,
+        falling back to importing from upstream if that fails
+        """
+        task = "Importing MAAS boot images"
+        conf = utils.load_template('bootresources.yaml').render(
+            source_path=MIRROR_URL)
+        selections = yaml.load(conf)['boot']['sources'][0]['selections']
+
+        def on_progress(done, total):
+            self.set_task_progress(task, "caching {:.0f}/{:.0f} MB".format(
+                done / 1024 / 1024, total / 1024 / 1024))
+
+        cache = BootImageCache()
+        try:
+            cache.sync(selections, on_progress)
+            cache.publish()
+        except (ImageCacheError, OSError) as e:
+            log.warning("Not using the boot image cache: {}".format(e))
+            conf = utils.load_template('bootresources.yaml').render(
+                source_path=UPSTREAM_URL)
+            utils.spew('/etc/maas/bootresources.yaml', conf)
+            return
+        self.set_task_progress(task, "")
+        utils.spew('/etc/maas/bootresources.yaml', conf)
+
+        # MAAS 1.7 and later keep boot sources in their database
+        out = utils.get_command_output('maas maas boot-sources read',
+                                       full_output=True, log_output=False)
+        if out['status'] != 0:
+            return
+        for source in json.loads(out['output']):
+            out = utils.get_command_output(
+                'maas maas boot-source update {} url={}'.format(
+                    source['id'], MIRROR_URL))
             if out['status'] != 0:
-                log.debug("Error setting maas proxy config: {}".format(out))
-                raise MaasInstallError("Error setting proxy config")
+                log.debug("Error setting boot source {} to the cache: "
+                          "{}".format(source['id'], out))
+                raise MaasInstallError("Error setting boot image source")
 
+    def import_boot_images(self):
         self.display_controller.info_message("Importing MAAS boot images")
-        self.start_task("Importing MAAS boot images")
+        self.use_boot_image_cache()
         out = utils.get_command_output('maas maas boot-resources import')
         if out['status'] != 0:
             log.debug("Error starting boot images import: {}".format(out))
-            raise MaasInstallError("Error setting proxy config")
+            raise MaasInstallError("Error starting boot images import")
+
+        # the tracker gives up well before the timeout if the import
+        # stops making progress
+        tracker = BootImageTracker(self.read_boot_resources)
 
         def pred(out):
-            return out['output'] != '[]'
+            if out['output'] != '[]':
+                return True
+            self.set_task_progress("Importing MAAS boot images",
+                                   format_progress(tracker.sample()))
+            return False
 
-        ok = utils.poll_until_true('maas maas boot-images read '
-                                   ' {}'.format(cluster_uuid),
-                                   pred, 15, timeout=7200)
+        try:
+            ok = utils.poll_until_true('maas maas boot-images read '
+                                       ' {}'.format(self.cluster_uuid),
+                                       pred, 5, timeout=7200, backoff=1.5,
+                                       max_frequency=30)
+        except BootImageImportStalled as e:
+            raise MaasInstallError(str(e))
         if not ok:
             log.debug("poll timed out for getting boot images")
             raise MaasInstallError("Downloading boot images timed out")
 
         self.display_controller.info_message("Done importing boot images.")
 
-        self.start_task("Creating KVM for Juju state server")
-        self.create_bootstrap_kvm()
+    def read_boot_resources(self):
+        """ Boot resources with their files, as MAAS reports them
 
-        self.do_install()
+        :returns: list of dicts, empty if MAAS does not report them
+        """
+        out = utils.get_command_output('maas maas boot-resources read',
+                                       full_output=True, log_output=False)
+        if out['status'] != 0:
+            return []
+        resources = []
+        try:
+            for r in json.loads(out['output']):
+                out = utils.get_command_output(
+                    'maas maas boot-resource read {}'.format(r['id']))
+                if out['status'] == 0:
+                    resources.append(json.loads(out['output']))
+        except (ValueError, KeyError, TypeError) as e:
+            log.debug("Unable to read boot resources: {}".format(e))
+        return resources
 
     def prompt_for_dhcp_range(self):
         """ Prompts for configurable dhcp ranges
@@ -355,10 +495,10 @@ class MultiInstallNewMaas(MultiInstall):
 
         if self.should_bridge_maasnw:
             log.debug("bridging maas network")
-            self.configure_nat(get_network('br0'))
-            log.debug("configured NAT")
-            self.enable_ipv4_forwarding()
-            log.debug("enabled forwarding")
+            aio.run_until_complete(aio.gather(
+                self.configure_nat(get_network('br0')),
+                self.enable_ipv4_forwarding()))
+            log.debug("configured NAT and enabled forwarding")
             self.gateway = get_ip_addr('br0')
             # excludes = [self.iface_ip]
         else:
@@ -369,9 +509,9 @@ class MultiInstallNewMaas(MultiInstall):
         # nw = ip_network(self.iface_network, strict=False)
         # self.dhcp_range = ip_range_max(nw, excludes)
 
+    def search_for_dhcp(self):
         self.display_controller.info_message(
             "Detecting Existing DHCP server")
-        self.start_task("Searching for existing DHCP servers")
         # TODO Handle existing dhcp with another dialog or user interaction
         # to accept the consequences.
         if self.detect_existing_dhcp(self.target_iface):
@@ -380,19 +520,19 @@ class MultiInstallNewMaas(MultiInstall):
                 "the network may be incorrectly configured.")
             pass
 
+    @asyncio.coroutine
+    def allow_maas_virsh_power(self):
+        """ lets MAAS power the bootstrap kvm through libvirt """
+        for argv in [['usermod', '-a', '-G', 'libvirtd', 'maas'],
+                     ['service', 'maas-clusterd', 'restart']]:
+            yield from aio.check_command(
+                argv, error=MaasInstallError,
+                message="error in creating bootstrap kvm")
+
+    @asyncio.coroutine
     def create_bootstrap_kvm(self):
         self.display_controller.info_message(
             "Initializing environment for Juju ...")
-        out = utils.get_command_output('usermod -a -G libvirtd maas')
-        if out['status'] != 0:
-            log.debug("error adding maas user to libvirtd: {}".format(out))
-            raise MaasInstallError("error in creating bootstrap kvm")
-
-        out = utils.get_command_output('service maas-clusterd restart')
-        if out['status'] != 0:
-            log.debug("error restarting maas-clusterd: {}".format(out))
-            raise MaasInstallError("error in creating bootstrap kvm")
-
         if self.config.is_landscape:
             vcpus = 2
             ram = 4096
@@ -404,35 +544,32 @@ class MultiInstallNewMaas(MultiInstall):
             disk = 20
         # TODO investigate if this breaks with someone attempting nested
         # kvm installations. REF http://git.io/8z4xBw
-        cmd = ("virt-install --name juju-bootstrap "
-               "--ram={ram} --vcpus={vcpus} "
-               "--hvm --virt-type=kvm --pxe --boot network,hd "
-               "--os-variant=ubuntutrusty --graphics vnc --noautoconsole "
-               "--os-type=linux --accelerate "
-               "--disk=/var/lib/libvirt/images/juju-bootstrap.qcow2,"
-               # no space here...
-               "bus=virtio,format=qcow2,cache=none,sparse=true,"
-               # no space here...
-               "size={disk} "
-               "--network=bridge=br0,model=virtio".format(ram=ram,
-                                                          vcpus=vcpus,
-                                                          disk=disk))
-
-        out = utils.get_command_output(cmd)
-        if out['status'] != 0:
-            log.debug("error creating kvm: {}".format(out))
-            raise MaasInstallError("Could not create KVM with {}MB RAM, "
-                                   "{}G disk and {} vcpus.".format(ram,
-                                                                   disk,
-                                                                   vcpus))
-
-        out = utils.get_command_output("virsh dumpxml juju-bootstrap "
-                                       " | grep 'mac address' | cut -d\\' -f2")
-        if out['status'] != 0:
-            log.debug("error creating kvm: {}".format(out))
+        argv = ["virt-install", "--name", "juju-bootstrap",
+                "--ram={}".format(ram), "--vcpus={}".format(vcpus),
+                "--hvm", "--virt-type=kvm", "--pxe", "--boot", "network,hd",
+                "--os-variant=ubuntutrusty", "--graphics", "vnc",
+                "--noautoconsole", "--os-type=linux", "--accelerate",
+                "--disk=/var/lib/libvirt/images/juju-bootstrap.qcow2,"
+                "bus=virtio,format=qcow2,cache=none,sparse=true,"
+                "size={}".format(disk),
+                "--network=bridge=br0,model=virtio"]
+
+        # maas-clusterd serves the VM's PXE boot, so it is restarted
+        # before the VM starts
+        yield from self.allow_maas_virsh_power()
+        yield from aio.check_command(
+            argv, error=MaasInstallError,
+            message="Could not create KVM with {}MB RAM, "
+            "{}G disk and {} vcpus.".format(ram, disk, vcpus))
+
+        out = yield from aio.check_command(
+            ["virsh", "dumpxml", "juju-bootstrap"], error=MaasInstallError,
+            message="error in creating bootstrap kvm", log_output=False)
+        match = re.search("mac address='([^']+)'", out.output)
+        if match is None:
+            log.debug("no mac address for kvm: {}".format(out.output))
             raise MaasInstallError("error in creating bootstrap kvm")
-
-        kvm_mac = out['output'].strip()
+        kvm_mac = match.group(1)
 
         cmd = ("maas maas nodes new architecture=amd64/generic "
                "mac_addresses={} "
@@ -441,19 +578,18 @@ class MultiInstallNewMaas(MultiInstall):
                "power_parameters_power_address=qemu:///system "
                "power_parameters_power_id=juju-bootstrap".format(kvm_mac))
 
-        out = utils.get_command_output(cmd)
+        out = yield from aio.run_in_thread(utils.get_command_output, cmd)
         if out['status'] != 0:
             log.debug("error creating bootstrap node: {}"
                       "command was:\n{}".format(out, cmd))
             raise MaasInstallError("error in creating bootstrap kvm")
 
-        out = utils.get_command_output('maas maas nodes list '
-                                       'mac_address={}'.format(kvm_mac))
-        if out['status'] != 0:
-            log.debug("error getting system id of kvm: {}".format(out))
-            raise MaasInstallError("error in creating bootstrap kvm")
+        out = yield from aio.check_command(
+            ['maas', 'maas', 'nodes', 'list',
+             'mac_address={}'.format(kvm_mac)],
+            error=MaasInstallError, message="error in creating bootstrap kvm")
 
-        system_id = json.loads(out['output'])[0]['system_id']
+        system_id = json.loads(out.output)[0]['system_id']
 
         # out = utils.get_command_output('juju --show-log sync-tools',
         #                                user_sudo=True)
@@ -465,10 +601,10 @@ class MultiInstallNewMaas(MultiInstall):
             return json.loads(output)[0]['status']
 
         # wait until status is 4
-        ok = utils.poll_until_true('maas maas nodes list '
-                                   'id={}'.format(system_id),
-                                   lambda o: get_node_status(o['output']) == 4,
-                                   5)
+        ok = yield from aio.run_in_thread(
+            utils.poll_until_true,
+            'maas maas nodes list id={}'.format(system_id),
+            lambda o: get_node_status(o['output']) == 4, 5)
         if not ok:
             log.debug("waiting for status == 4 timed out.")
             raise MaasInstallError("error in bootstrap node creation")
@@ -513,7 +649,7 @@ class MultiInstallNewMaas(MultiInstall):
     def get_apikey(self):
         credcmd = ("maas-region-admin apikey "
                    "--username root")
-        out = utils.get_command_output(credcmd)
+        out = utils.get_command_output(credcmd, log_output=False)
         if out['status'] != 0:
             log.debug("failed to get apikey: {}".format(out))
             raise MaasInstallError("Couldn't get apikey")
@@ -673,10 +809,12 @@ class MultiInstallNewMaas(MultiInstall):
                     old_f.write(''.join(new_f.readlines()))
         return changed_config
 
+    @asyncio.coroutine
     def configure_nat(self, network):
-        cmd = ('iptables -t nat -a POSTROUTING '
-               '-s {} ! -d {} -j MASQUERADE'.format(network, network))
-        utils.get_command_output(cmd)
+        yield from aio.run_command(['iptables', '-t', 'nat', '-a',
+                                    'POSTROUTING', '-s', str(network),
+                                    '!', '-d', str(network),
+                                    '-j', 'MASQUERADE'])
 
         utils.spew('/etc/network/iptables.rules',
                    "*nat\n"
@@ -686,19 +824,21 @@ class MultiInstallNewMaas(MultiInstall):
                    ":POSTROUTING ACCEPT [0:0]\n"
                    "-A POSTROUTING -s {} ! -d {} -j MASQUERADE\n"
                    "COMMIT\n".format(network, network))
-        utils.get_command_output('chmod 0600 /etc/network/iptables.rules')
-        cmd = ("sed -e '/^iface lo inet loopback$/a\ "
-               "pre-up iptables-restore < /etc/network/iptables.rules' "
-               "-i /etc/network/interfaces")
-        res = utils.get_command_output(cmd)
-        if res['status'] != 0:
-            log.debug("error editing /etc/network/interfaces: {}".format(res))
-
+        os.chmod('/etc/network/iptables.rules', 0o600)
+        res = yield from aio.run_command(
+            ['sed', '-e', '/^iface lo inet loopback$/a\\ '
+             'pre-up iptables-restore < /etc/network/iptables.rules',
+             '-i', '/etc/network/interfaces'])
+        if res.status != 0:
+            log.debug("error editing /etc/network/interfaces: "
+                      "{}".format(res.output))
+
+    @asyncio.coroutine
     def enable_ipv4_forwarding(self):
-        cmd = ("sed -e 's/^#net.ipv4.ip_forward=1$/net.ipv4.ip_forward=1/' "
-               " -i /etc/sysctl.conf")
-        utils.get_command_output(cmd)
-        utils.get_command_output('sysctl -p')
+        yield from aio.run_command(
+            ['sed', '-e', 's/^#net.ipv4.ip_forward=1$/net.ipv4.ip_forward=1/',
+             '-i', '/etc/sysctl.conf'])
+        yield from aio.run_command(['sysctl', '-p'])
 
     def configure_maas_networking(self, cluster_uuid, interface,
                                   gateway, dhcp_range, static_range):
@@ -708,7 +848,8 @@ class MultiInstallNewMaas(MultiInstall):
         """
         maas_query_cmd = ('maas maas node-group-interfaces'
                           ' list {}'.format(cluster_uuid))
-        out = utils.get_command_output(maas_query_cmd)
+        out = utils.get_command_output(maas_query_cmd, full_output=True,
+                                       log_output=False)
         interfaces = json.loads(out['output'])
         nmatching = len([i for i in interfaces
                          if i['interface'] == interface])
@@ -821,13 +962,12 @@ class LandscapeInstallFinal:
         # Juju deployer
         self.multi_installer.start_task("Deploying Landscape")
 
-        out = utils.get_command_output("juju-deployer -WdvL -w 180 -c {0} "
-                                       "landscape-dense-maas".format(
-                                           self.lscape_yaml_path),
-                                       timeout=None,
-                                       user_sudo=True)
-        if out['status']:
-            log.error("Problem deploying Landscape: {}".format(out))
+        out = process.run(["juju-deployer", "-WdvL", "-w", "180",
+                           "-c", self.lscape_yaml_path,
+                           "landscape-dense-maas"],
+                          user=utils.install_user())
+        if out.status:
+            log.error("Problem deploying Landscape: {}".format(out.output))
             raise Exception("Error deploying Landscape.")
 
         # Configure landscape
@@ -836,22 +976,19 @@ class LandscapeInstallFinal:
         # --admin-name foo@bar.com --system-email foo@bar.com --maas-host
         # 172.16.0.1
         self.multi_installer.start_task("Registering against Landscape")
-        cmd = ("{bin} --admin-email {admin_email} "
-               "--admin-name {name} "
-               "--system-email {sys_email} "
-               "--maas-host {maas_host}".format(
-                   bin=self.lscape_configure_bin,
-                   admin_email=self.config.landscape_creds['admin_email'],
-                   name=self.config.landscape_creds['admin_name'],
-                   sys_email=self.config.landscape_creds['system_email'],
-                   maas_host=self.config.maas_creds['api_host']))
+        cmd = [self.lscape_configure_bin,
+               "--admin-email", self.config.landscape_creds['admin_email'],
+               "--admin-name", self.config.landscape_creds['admin_name'],
+               "--system-email", self.config.landscape_creds['system_email'],
+               "--maas-host", self.config.maas_creds['api_host']]
 
         log.debug("Running landscape configure: {}".format(cmd))
 
-        out = utils.get_command_output(cmd, timeout=None, user_sudo=True)
+        out = process.run(cmd, user=utils.install_user())
 
-        if out['status']:
-            log.error("Problem with configuring Landscape: {}.".format(out))
+        if out.status:
+            log.error("Problem with configuring Landscape: {}.".format(
+                out.output))
             raise Exception("Error configuring Landscape.")
 
         self.multi_installer.stop_current_task()
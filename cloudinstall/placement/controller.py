@@ -21,7 +21,8 @@ from multiprocessing import cpu_count
 import yaml
 
 from cloudinstall.machine import satisfies
-from cloudinstall.utils import load_charms
+from cloudinstall.maas import MaasMachineStatus
+from cloudinstall.utils import load_charm_manifest
 
 log = logging.getLogger('cloudinstall.placement')
 
@@ -170,15 +171,14 @@ class PlacementController:
         return ms
 
     def charm_classes(self):
-        cl = [m.__charm_class__ for m in load_charms()
-              if not m.__charm_class__.optional and
-              not m.__charm_class__.disabled]
+        cl = [cc for cc in load_charm_manifest()
+              if not cc.optional and not cc.disabled]
 
         if self.opts.enable_swift:
-            for m in load_charms():
-                n = m.__charm_class__.name()
+            for cc in load_charm_manifest():
+                n = cc.name()
                 if n == "swift-storage" or n == "swift-proxy":
-                    cl.append(m.__charm_class__)
+                    cl.append(cc)
         return cl
 
     def placed_charm_classes(self):
@@ -196,6 +196,31 @@ class PlacementController:
         self.assignments[machine.instance_id][atype].append(charm_class)
         self.update_and_save()
 
+    def select_machines(self, charm_class, count,
+                        atype=AssignmentType.BareMetal):
+        """Assigns charm_class to up to count empty, ready machines that
+        satisfy its constraints, saving once.
+
+        Returns the list of machines assigned, which is shorter than
+        count if not enough machines are available.
+        """
+        selected = []
+        for m in self.machines():
+            if len(selected) == count:
+                break
+            if m.status != MaasMachineStatus.READY:
+                continue
+            if sum(len(al) for al in
+                   self.assignments.get(m.instance_id, {}).values()) > 0:
+                continue
+            if not satisfies(m, charm_class.constraints)[0]:
+                continue
+            self.assignments[m.instance_id][atype].append(charm_class)
+            selected.append(m)
+
+        self.update_and_save()
+        return selected
+
     def machines_for_charm(self, charm_class):
         """ returns assignments for a given charm
         returns {assignment_type : [machines]}
@@ -0,0 +1,181 @@
+#
+# poll.py - Wait for conditions without spinning
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Polls run on a shared scheduler
+
+A Poll calls a function until a predicate of its result is true or a
+deadline passes, sleeping between attempts with optional exponential
+backoff and jitter. Any number of polls share one scheduler thread and a
+small pool of worker threads for the attempts themselves.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from cloudinstall.trace import tracer
+
+log = logging.getLogger('cloudinstall.poll')
+
+# Attempts running at once, across all polls
+DEFAULT_MAX_WORKERS = 8
+
+
+class Poll:
+    """ Calls fn() until predicate(fn()) is true or timeout seconds pass.
+
+    The n-th wait between attempts is interval * backoff ** (n - 1),
+    capped at max_interval and varied by up to +/- jitter of itself.
+    """
+
+    def __init__(self, fn, predicate, interval, timeout=600, backoff=1.0,
+                 max_interval=None, jitter=0.1, ignore_exceptions=False,
+                 name=None):
+        """
+        :param bool ignore_exceptions: log exceptions raised by fn or
+                                       predicate and keep polling, instead
+                                       of failing the poll with them
+        """
+        self.fn = fn
+        self.predicate = predicate
+        self.interval = interval
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.ignore_exceptions = ignore_exceptions
+        self.name = name or getattr(fn, '__name__', 'poll')
+        self.attempts = 0
+        self.latencies = []
+        self.start = time.time()
+        self.deadline = self.start + timeout
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def next_delay(self):
+        """ Seconds to wait before the next attempt """
+        delay = self.interval * self.backoff ** max(self.attempts - 1, 0)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0, min(delay, self.deadline - time.time()))
+
+    def _finish(self, result, error=None):
+        self.result = result
+        self.error = error
+        elapsed = time.time() - self.start
+        log.debug("Poll {} {} after {} attempts in {:.1f}s "
+                  "({:.2f}s mean attempt)".format(
+                      self.name,
+                      "failed" if error else
+                      "succeeded" if result else "timed out",
+                      self.attempts, elapsed,
+                      sum(self.latencies) / max(len(self.latencies), 1)))
+        self.finished.set()
+
+    def attempt(self):
+        """ Makes one attempt
+
+        :returns: True once the poll is finished
+        """
+        self.attempts += 1
+        start = time.time()
+        try:
+            with tracer.span('poll ' + self.name, 'poll',
+                             attempt=self.attempts):
+                ok = self.predicate(self.fn())
+        except Exception as e:
+            if not self.ignore_exceptions:
+                self._finish(False, e)
+                return True
+            log.debug("**Ignoring** exception: {}".format(e))
+            ok = False
+        finally:
+            self.latencies.append(time.time() - start)
+        if ok:
+            self._finish(True)
+        elif time.time() >= self.deadline:
+            self._finish(False)
+        return self.finished.is_set()
+
+    def wait(self):
+        """ Blocks until the poll finishes
+
+        :returns: True if the predicate became true, False on timeout
+        """
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def stats(self):
+        """ Returns (attempts, mean attempt seconds, elapsed seconds) """
+        return (self.attempts,
+                sum(self.latencies) / max(len(self.latencies), 1),
+                time.time() - self.start)
+
+
+class PollScheduler:
+    """ Runs the attempts of many polls as they fall due """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.queue = []
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+        self.thread = None
+
+    def _push(self, due, poll):
+        with self.cv:
+            heapq.heappush(self.queue, (due, next(self.seq), poll))
+            self.cv.notify()
+
+    def _attempt(self, poll):
+        if not poll.attempt():
+            self._push(time.time() + poll.next_delay(), poll)
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.cv.wait(self.queue[0][0] - time.time()
+                                 if self.queue else None)
+                _, _, poll = heapq.heappop(self.queue)
+            self.pool.submit(self._attempt, poll)
+
+    def submit(self, poll):
+        """ Schedules poll's first attempt right away
+
+        :returns: poll
+        """
+        with self.cv:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="poll-scheduler")
+                self.thread.daemon = True
+                self.thread.start()
+        self._push(time.time(), poll)
+        return poll
+
+
+scheduler = PollScheduler()
@@ -0,0 +1,158 @@
+#
+# process.py - Run commands and stream their output
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Runs commands from argv lists, without a shell
+
+Output is read line by line as the command runs: each line can be
+logged and passed to callbacks, and only the last lines are kept in
+memory. Timeouts are enforced here rather than with timeout(1).
+"""
+
+from collections import deque, namedtuple
+import errno
+import logging
+import os
+import signal
+from subprocess import Popen, PIPE, STDOUT
+import threading
+import time
+
+from cloudinstall.trace import tracer
+
+log = logging.getLogger('cloudinstall.process')
+
+# Exit status of a command killed for running too long, as timeout(1)
+TIMEOUT_STATUS = 124
+
+# Exit status of a command that could not be found, as sh(1)
+NOT_FOUND_STATUS = 127
+
+# Output lines kept by default
+DEFAULT_TAIL_LINES = 1000
+
+# Seconds between SIGTERM and SIGKILL for a timed out command
+KILL_GRACE = 5
+
+
+ProcessResult = namedtuple('ProcessResult', ['argv', 'status', 'output',
+                                             'lines', 'wall_time',
+                                             'cpu_time', 'timed_out'])
+
+
+def _exit_status(wait_status):
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+
+def run(argv, timeout=None, user=None, env=None, on_line=None,
+        tail_lines=DEFAULT_TAIL_LINES, log_output=True):
+    """ Runs argv and waits for it to exit
+
+    :param list argv: command and arguments, not interpreted by a shell
+    :param int timeout: seconds before the command is killed
+    :param str user: run as this user, through sudo -H
+    :param dict env: extra environment variables. LC_ALL is always C
+    :param on_line: called with each line of output, as it is read
+    :param int tail_lines: output lines kept, None keeps them all
+    :param bool log_output: log each line of output at debug level
+    :returns: status is the exit status, negated signal number if the
+              command was killed by a signal, or TIMEOUT_STATUS.
+              output is the last tail_lines lines of stdout and stderr,
+              lines the count of all lines.
+    :rtype: ProcessResult
+    """
+    argv = list(argv)
+    if user:
+        argv = ['sudo', '-H', '-u', user] + argv
+    cmd_env = os.environ.copy()
+    cmd_env.update(env or {})
+    cmd_env['LC_ALL'] = 'C'
+
+    start = time.time()
+    with tracer.span('process', 'cmd', argv=argv[:20]) as span:
+        try:
+            # own session, so a timeout kills the command's children too
+            p = Popen(argv, stdout=PIPE, stderr=STDOUT, env=cmd_env,
+                      close_fds=True, start_new_session=True)
+        except OSError as e:
+            if e.errno in [errno.ENOENT, errno.EACCES]:
+                log.debug("Unable to run {}: {}".format(argv, e))
+                return ProcessResult(argv, NOT_FOUND_STATUS, '', 0, 0.0,
+                                     0.0, False)
+            raise
+
+        tail = deque(maxlen=tail_lines)
+        count = [0]
+        name = os.path.basename(argv[0])
+
+        def read_output():
+            for raw in p.stdout:
+                line = raw.decode('utf-8', 'replace')
+                tail.append(line)
+                count[0] += 1
+                if log_output:
+                    log.debug("{}[{}]: {}".format(name, p.pid,
+                                                  line.rstrip('\n')))
+                if on_line:
+                    try:
+                        on_line(line)
+                    except Exception:
+                        log.exception("Error handling output of "
+                                      "{}".format(argv))
+            p.stdout.close()
+
+        # wait4 reaps the command and reports the CPU time it used
+        exited = threading.Event()
+        rusage = {}
+
+        def wait_exit():
+            _, wait_status, ru = os.wait4(p.pid, 0)
+            p.returncode = _exit_status(wait_status)
+            rusage['cpu'] = ru.ru_utime + ru.ru_stime
+            exited.set()
+
+        reader = threading.Thread(target=read_output,
+                                  name="output-{}".format(name))
+        waiter = threading.Thread(target=wait_exit,
+                                  name="wait-{}".format(name))
+        reader.daemon = waiter.daemon = True
+        reader.start()
+        waiter.start()
+
+        timed_out = not exited.wait(timeout)
+        if timed_out:
+            log.warning("Killing {} after {}s".format(argv, timeout))
+            for sig, grace in [(signal.SIGTERM, KILL_GRACE),
+                               (signal.SIGKILL, None)]:
+                try:
+                    os.killpg(p.pid, sig)
+                except OSError:
+                    pass
+                if exited.wait(grace):
+                    break
+        reader.join()
+
+        status = TIMEOUT_STATUS if timed_out else p.returncode
+        result = ProcessResult(argv, status, ''.join(tail), count[0],
+                               time.time() - start, rusage.get('cpu', 0.0),
+                               timed_out)
+        span.update(status=status, cpu_time=result.cpu_time)
+    log.debug("{} exited {} after {:.2f}s ({:.2f}s cpu, {} lines)".format(
+        argv, status, result.wall_time, result.cpu_time, result.lines))
+    return result
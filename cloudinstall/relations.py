@@ -0,0 +1,158 @@
+#
+# relations.py - Environment-wide relation planning
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Plans and issues the relations between a set of charms """
+
+import logging
+
+from cloudinstall.journal import RELATION_ADDED
+
+log = logging.getLogger('cloudinstall.relations')
+
+
+def endpoint_service(endpoint):
+    """ Service name of an endpoint like 'nova-compute:amqp' """
+    return endpoint.split(':')[0]
+
+
+def relation_key(endpoints):
+    """ Identifies a relation by its pair of service names """
+    return frozenset(endpoint_service(e) for e in endpoints)
+
+
+def journal_key(key):
+    """ Journal key of a relation key """
+    return "-".join(sorted(key))
+
+
+class RelationPlanner:
+    """ Computes every relation wanted by a set of charms and adds the
+    missing ones.
+
+    Each pass takes a single status snapshot, diffs the desired relations
+    against it, and issues every relation whose services both have a
+    started unit in one batch.
+
+    A planner can be queued on a :class:`~cloudinstall.charms.CharmQueue`
+    in place of a charm, through its set_relations().
+    """
+
+    charm_name = 'relations'
+
+    def __init__(self, juju, juju_state, charms, ui=None, executor=None,
+                 journal=None):
+        """
+        :param charms: charm instances whose relations to plan
+        :param executor: optional DeployExecutor to issue the batch on
+        :param journal: optional DeployJournal; relations it records
+                        are not checked again
+        """
+        self.juju = juju
+        self.juju_state = juju_state
+        self.charms = list(charms)
+        self.ui = ui
+        self.executor = executor
+        self.journal = journal
+
+    @property
+    def related(self):
+        """ Every service a desired relation involves """
+        return sorted(set(s for key in self.desired() for s in key))
+
+    def desired(self):
+        """ Returns {relation key: (endpoint, endpoint)}, without the
+        relations recorded in the journal
+        """
+        desired = {}
+        for charm in self.charms:
+            for endpoints in charm.desired_relations():
+                key = relation_key(endpoints)
+                if self.journal and \
+                   self.journal.done(RELATION_ADDED, journal_key(key)):
+                    continue
+                desired.setdefault(key, endpoints)
+        return desired
+
+    def plan(self, services):
+        """ Diffs desired relations against one status snapshot
+
+        :param services: list of :class:`~cloudinstall.service.Service`
+        :returns: (ready, waiting) lists of missing (endpoint, endpoint)
+        """
+        current = set()
+        started = set()
+        for svc in services:
+            for r in svc.relations:
+                for other in r.charms:
+                    current.add(frozenset([svc.service_name, other]))
+            if any(u.agent_state == 'started' for u in svc.units):
+                started.add(svc.service_name)
+
+        ready, waiting = [], []
+        for key, endpoints in sorted(self.desired().items(),
+                                     key=lambda kv: sorted(kv[0])):
+            if key in current:
+                continue
+            if key.issubset(started):
+                ready.append(endpoints)
+            else:
+                waiting.append(endpoints)
+        return ready, waiting
+
+    def _add_relation(self, endpoints):
+        try:
+            log.debug("calling add_relation({}, {})".format(*endpoints))
+            self.juju.add_relation(*endpoints)
+        except:
+            msg = "Relation {}-{} not ready, requeueing.".format(*endpoints)
+            log.exception("failure in add_relation {}".format(msg))
+            if self.ui:
+                self.ui.status_info_message(msg)
+            return True
+        if self.journal:
+            self.journal.record(RELATION_ADDED,
+                                journal_key(relation_key(endpoints)),
+                                endpoints=list(endpoints))
+        return False
+
+    def set_relations(self):
+        """ Adds every ready relation
+
+        :returns: True if relations are still missing, False otherwise
+        """
+        self.juju_state.invalidate_status_cache()
+        ready, waiting = self.plan(self.juju_state.services)
+        if len(ready) > 0:
+            log.debug("Adding {} relations: {}".format(len(ready), ready))
+        if len(waiting) > 0:
+            log.debug("Relations waiting on started units: {}".format(
+                waiting))
+
+        if self.executor is None:
+            errs = [self._add_relation(e) for e in ready]
+        else:
+            futures = [self.executor.submit('add_relation',
+                                            endpoint_service(e[0]),
+                                            endpoint_service(e[1]),
+                                            self._add_relation, e)
+                       for e in ready]
+            errs = [f.result() for f in futures]
+        return any(errs) or len(waiting) > 0
+
+    def __repr__(self):
+        return self.charm_name
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
 import os
 import sys
@@ -21,11 +22,24 @@ import json
 import time
 from cloudinstall.config import Config
 from cloudinstall.installbase import InstallBase
-from cloudinstall import utils
+from cloudinstall import aptcache, inotify, utils
+from cloudinstall.netutils import get_ip_addr
+from cloudinstall.placement.controller import PlacementController
 
 
 log = logging.getLogger('cloudinstall.single_install')
 
+# Provisioned container the bootstrap container is cloned from
+BASE_CONTAINER = 'uoi-bootstrap-base'
+
+# Seconds before the base container is rebuilt, to pick up updates
+BASE_CONTAINER_MAX_AGE = 7 * 24 * 60 * 60
+
+# Written by cloud-init when it finishes
+CLOUD_INIT_RESULT = '/run/cloud-init/result.json'
+
+CLOUD_INIT_TIMEOUT = 3600
+
 
 class SingleInstallException(Exception):
     pass
@@ -43,62 +57,152 @@ class SingleInstall(InstallBase):
                                               self.container_name)
         self.userdata = os.path.join(
             self.config.cfg_path, 'userdata.yaml')
+        self.clone_userdata = os.path.join(
+            self.config.cfg_path, 'userdata-clone.yaml')
+        self.base_info = os.path.join(self.container_path, BASE_CONTAINER,
+                                      'cloud-install-base.json')
+        self.apt_proxy = None
 
         # Sets install type
         utils.spew(os.path.join(self.config.cfg_path, 'single'),
                    'auto-generated')
 
+    def placed_node_count(self):
+        """ Machines of the single install's topology: the controller
+        and a KVM per unit of each isolated charm
+        """
+        pc = PlacementController(opts=self.opts)
+        pc.gen_single()
+        return len(pc.machines())
+
     def prep_userdata(self):
-        """ preps userdata file for container install """
-        dst_file = os.path.join(self.config.cfg_path,
-                                'userdata.yaml')
+        """ preps userdata files for the base container and its clones """
         original_data = utils.load_template('userdata.yaml')
         modified_data = original_data.render(
             extra_sshkeys=[utils.ssh_readkey()],
-            extra_pkgs=['juju-local'])
-        utils.spew(dst_file, modified_data)
+            extra_pkgs=['juju-local'],
+            apt_proxy=self.apt_proxy)
+        utils.spew(self.userdata, modified_data)
+        clone_data = original_data.render(
+            extra_sshkeys=[utils.ssh_readkey()],
+            cached_base=True,
+            apt_proxy=self.apt_proxy)
+        utils.spew(self.clone_userdata, clone_data)
+
+    def base_container_key(self):
+        """ Identifies what the base container is built from: the
+        userdata, without the ssh keys that clones get anyway. The apt
+        proxy is part of it as cloud-init writes it into the base's apt
+        configuration, which clones inherit
+        """
+        data = utils.load_template('userdata.yaml').render(
+            extra_pkgs=['juju-local'],
+            apt_proxy=self.apt_proxy)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def base_container_current(self):
+        """ True if the base container was built from the current
+        userdata within BASE_CONTAINER_MAX_AGE
+        """
+        try:
+            info = json.loads(utils.slurp(self.base_info))
+        except (OSError, ValueError):
+            return False
+        if info.get('key') != self.base_container_key():
+            log.info("Base container userdata changed, rebuilding")
+            return False
+        if time.time() - info.get('created', 0) > BASE_CONTAINER_MAX_AGE:
+            log.info("Base container is out of date, rebuilding")
+            return False
+        return True
+
+    def build_base_container(self, backingstore):
+        """ Creates the base container, provisions it with cloud-init and
+        stops it, ready to be cloned
+        """
+        if os.path.exists(os.path.join(self.container_path,
+                                       BASE_CONTAINER)):
+            utils.container_destroy(BASE_CONTAINER)
+        utils.container_create(BASE_CONTAINER, self.userdata,
+                               'btrfs' if backingstore == 'btrfs' else None)
+        utils.container_start(BASE_CONTAINER)
+        utils.container_wait(BASE_CONTAINER)
+        self.wait_for_cloud_init(BASE_CONTAINER)
+        utils.container_stop(BASE_CONTAINER)
+        utils.spew(self.base_info,
+                   json.dumps(dict(key=self.base_container_key(),
+                                   created=time.time())))
 
     def create_container_and_wait(self):
-        """ Creates container and waits for cloud-init to finish
+        """ Clones the container from the cached base container, which is
+        built first if missing or out of date, and waits for cloud-init
+        to finish
         """
-        self.start_task("Creating container")
-        utils.container_create(self.container_name, self.userdata)
+        task = "Creating container"
+        self.start_task(task)
+        backingstore = utils.container_snapshot_backingstore(
+            self.container_path)
+        if not self.base_container_current():
+            self.set_task_progress(task, "building base container")
+            self.build_base_container(backingstore)
+        self.set_task_progress(task, "cloning base container "
+                               "({})".format(backingstore))
+        utils.container_clone(BASE_CONTAINER, self.container_name,
+                              self.clone_userdata, backingstore)
         utils.container_start(self.container_name)
         utils.container_wait(self.container_name)
-        tries = 1
-        while not self.cloud_init_finished():
-            time.sleep(1)
-            tries = tries + 1
+        self.wait_for_cloud_init(self.container_name)
+        self.set_task_progress(task, "")
 
-    def cloud_init_finished(self):
-        """checks cloud-init result.json in container to find out status
+    def wait_for_cloud_init(self, name):
+        """ Waits for cloud-init to finish in a container.
 
-        returns True if cloud-init finished with no errors, False if
-        it's not done yet, and raises an exception if it had errors.
+        result.json is watched with inotify from the host, through the
+        container's init process, since /run is private to the
+        container. If that is not possible, one remote command waits
+        for it instead.
         """
-        cmd = 'sudo cat /run/cloud-init/result.json'
-        try:
-            result_json = utils.container_run(self.container_name, cmd)
-            # convert from bytes for json to process
-            result_json = result_json.decode("utf-8")
-            log.debug(result_json)
-        except:
-            log.debug("Waiting for cloud-init status result")
-            return False
-
-        if result_json == '':
-            return False
-
+        pid = utils.container_init_pid(name)
+        result_json = None
+        if pid is not None and inotify.available():
+            path = '/proc/{}/root{}'.format(pid, CLOUD_INIT_RESULT)
+
+            def running():
+                return os.path.isdir('/proc/{}'.format(pid))
+            try:
+                # /proc has no inotify events, so wake now and then to
+                # notice a container that stopped
+                if not inotify.wait_for_path(path, CLOUD_INIT_TIMEOUT,
+                                             wake_interval=10,
+                                             keep_waiting=running):
+                    if not running():
+                        raise SingleInstallException(
+                            "Container {} stopped before cloud-init "
+                            "finished".format(name))
+                    raise SingleInstallException(
+                        "Timed out waiting for cloud-init in {}".format(
+                            name))
+                result_json = utils.slurp(path)
+            except OSError as e:
+                log.debug("Unable to watch {}, waiting remotely: "
+                          "{}".format(path, e))
+        if result_json is None:
+            result_json = utils.container_wait_for_file(
+                name, CLOUD_INIT_RESULT, CLOUD_INIT_TIMEOUT)
+        self.check_cloud_init_result(name, result_json)
+
+    def check_cloud_init_result(self, name, result_json):
+        """ Logs the errors reported in cloud-init's result.json """
+        log.debug(result_json)
         ret = json.loads(result_json)
         errors = ret['v1']['errors']
         if len(errors):
-            log.error("Container cloud-init finished with "
-                      "errors: {}".format(errors))
+            log.error("Container {} cloud-init finished with "
+                      "errors: {}".format(name, errors))
             # FIXME: Log errors for now, don't be fatal as the main
             # error is coming from a pollinate command unable
             # to run which doesn't seem to effect the installer.
             # raise Exception("Container cloud-init returned errors")
-        return True
 
     def copy_installdata_and_set_perms(self):
         """ copies install data and sets permissions on files/dirs
@@ -114,15 +218,6 @@ class SingleInstall(InstallBase):
 
         # copy over the rest of our installation data from host
         # and setup permissions
-
-        # setup charm configurations
-        charm_conf = utils.load_template('charmconf.yaml')
-        charm_conf_modified = charm_conf.render(
-            openstack_password=self.config.openstack_password)
-        utils.spew(os.path.join(self.config.cfg_path,
-                                'charmconf.yaml'),
-                   charm_conf_modified)
-
         utils.container_run(
             self.container_name, 'mkdir -p .cloud-install')
         utils.container_run(
@@ -140,6 +235,21 @@ class SingleInstall(InstallBase):
                            '.ssh/.')
         utils.container_run(self.container_name, "chmod 600 .ssh/id_rsa*")
 
+    def prep_configs(self):
+        """ renders the juju environment and charm configurations """
+        single_env = utils.load_template('juju-env/single.yaml')
+        single_env_modified = single_env.render(
+            openstack_password=self.config.openstack_password,
+            apt_proxy=self.apt_proxy)
+        utils.spew('/tmp/single.yaml', single_env_modified)
+
+        charm_conf = utils.load_template('charmconf.yaml')
+        charm_conf_modified = charm_conf.render(
+            openstack_password=self.config.openstack_password)
+        utils.spew(os.path.join(self.config.cfg_path,
+                                'charmconf.yaml'),
+                   charm_conf_modified)
+
     def run(self):
         self.register_tasks([
             "Initializing Environment",
@@ -152,6 +262,7 @@ class SingleInstall(InstallBase):
     @utils.async
     def do_install(self):
         self.display_controller.info_message("Building environment")
+        self.node_count = self.placed_node_count()
         if os.path.exists(self.container_abspath):
             # Container exists, handle return code in installer
             raise Exception("Container exists, please uninstall or kill "
@@ -159,17 +270,21 @@ class SingleInstall(InstallBase):
 
         utils.ssh_genkey()
 
+        # The container, and the machines juju creates in it, reach the
+        # host's apt proxy over lxcbr0
+        bridge_address = get_ip_addr('lxcbr0')
+        if bridge_address and aptcache.start([bridge_address]):
+            self.apt_proxy = aptcache.proxy_url(bridge_address)
+
         # Prepare cloud-init file for creation
         self.prep_userdata()
 
         # Start container
         self.create_container_and_wait()
 
+        self.prep_configs()
+
         # configure juju environment for bootstrap
-        single_env = utils.load_template('juju-env/single.yaml')
-        single_env_modified = single_env.render(
-            openstack_password=self.config.openstack_password)
-        utils.spew('/tmp/single.yaml', single_env_modified)
         utils.container_run(self.container_name,
                             'mkdir -p .juju')
         utils.container_cp(self.container_name,
@@ -195,3 +310,4 @@ class SingleInstall(InstallBase):
         self.display_controller.info_message("Starting cloud deployment ..")
         utils.container_run_status(
             self.container_name, " ".join(cloud_status_bin))
+        self.report_apt_cache()
@@ -0,0 +1,271 @@
+#
+# ssh.py - Multiplexed SSH connections
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Persistent SSH connections to containers and juju machines
+
+Every command and file transfer to a host goes over one OpenSSH master
+connection (ControlMaster), so only the first one pays for the TCP
+connection and key exchange.
+
+run_bundle() copies a set of files and runs a command on a host in a
+single round trip: the files travel as a tar archive on the command's
+stdin and are unpacked before the command runs.
+"""
+
+import glob
+import io
+import logging
+import os
+import pwd
+import re
+import shutil
+from subprocess import Popen, PIPE, TimeoutExpired
+import tarfile
+import tempfile
+import threading
+import time
+
+from cloudinstall.trace import tracer
+
+log = logging.getLogger('cloudinstall.ssh')
+
+# ssh exits with 255 when the connection itself failed
+SSH_CONNECTION_ERROR = 255
+
+# ssh errors meaning the connection was never set up, so the command
+# did not start and can be run again
+CONNECT_FAILURE = re.compile(r'ssh: connect to host|'
+                             r'ssh: Could not resolve hostname|'
+                             r'ssh_exchange_identification|'
+                             r'Connection closed by \S+$|'
+                             r'Control socket connect|'
+                             r'mux_client_', re.MULTILINE)
+
+# exit status of a bundle whose archive could not be unpacked
+BUNDLE_UNPACK_ERROR = 254
+
+
+def make_bundle(files):
+    """ Returns a tar archive of files
+
+    :param dict files: {remote absolute path: local path}
+    :rtype: bytes
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for dst, src in sorted(files.items()):
+            if not os.path.isabs(dst):
+                raise ValueError("Bundle paths must be absolute: "
+                                 "{}".format(dst))
+            tar.add(src, arcname=dst.lstrip('/'))
+    return buf.getvalue()
+
+
+def bundle_command(cmd, archive=None):
+    """ Shell command unpacking a bundle at / and then running cmd
+
+    :param str archive: path of the archive on the remote host, by
+                        default it is read from stdin
+    """
+    unpack = "tar -x -C /"
+    if archive:
+        unpack += " -f {0} && rm -f {0}".format(archive)
+    return "{} || exit {}; {}".format(unpack, BUNDLE_UNPACK_ERROR, cmd)
+
+
+def bundle_error(status):
+    """ Names the step of a bundle run that failed, from its exit status
+
+    :returns: None, 'connection', 'unpack' or 'command'
+    """
+    if status == 0:
+        return None
+    if status == SSH_CONNECTION_ERROR:
+        return 'connection'
+    if status == BUNDLE_UNPACK_ERROR:
+        return 'unpack'
+    return 'command'
+
+
+class SSHConnectionPool:
+    """ Runs commands and copies files to hosts over persistent master
+    connections.
+
+    A master connection is started by the first command to a host and
+    kept open for `persist` seconds after the last one. If a command
+    fails to connect, the master is torn down and the command retried
+    once on a fresh connection. Commands that may have started on the
+    host are not retried.
+
+    Master sockets live in a directory only the local user can use. If
+    the directory belongs to someone else or is open to others,
+    connections are not shared.
+    """
+
+    def __init__(self, user='ubuntu', identity=None, run_as=None,
+                 persist=600, control_dir=None):
+        """
+        :param str user: remote login user
+        :param str identity: private key file
+        :param str run_as: local user to run ssh as, through sudo
+        :param int persist: seconds an idle master connection stays open
+        :param str control_dir: directory for master sockets, by default
+                                ~/.cloud-install/ssh of the local user
+        """
+        self.user = user
+        self.identity = identity
+        self.run_as = run_as
+        self.persist = persist
+        # socket paths are limited to 108 characters, keep them short
+        self.control_dir = control_dir or os.path.join(
+            os.path.expanduser('~' + (run_as or '')), '.cloud-install',
+            'ssh')
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self._control_dir_ok = None
+
+    def _check_control_dir(self):
+        """ Creates the socket directory, True if it is private to the
+        local user
+        """
+        uid = pwd.getpwnam(self.run_as).pw_uid if self.run_as \
+            else os.getuid()
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, mode=0o700)
+            if self.run_as:
+                shutil.chown(self.control_dir, user=self.run_as)
+        st = os.lstat(self.control_dir)
+        if st.st_uid != uid or st.st_mode & 0o077:
+            log.warning("{} is not private to uid {}, not sharing ssh "
+                        "connections".format(self.control_dir, uid))
+            return False
+        return True
+
+    def _control_options(self):
+        with self.lock:
+            if self._control_dir_ok is None:
+                self._control_dir_ok = self._check_control_dir()
+        if not self._control_dir_ok:
+            return ['-o', 'ControlMaster=no', '-o', 'ControlPath=none']
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}'.format(
+                    os.path.join(self.control_dir, "%r@%h:%p")),
+                '-o', 'ControlPersist={}'.format(self.persist)]
+
+    def _options(self):
+        opts = ['-o', 'StrictHostKeyChecking=no',
+                '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'LogLevel=ERROR',
+                '-o', 'BatchMode=yes'] + self._control_options()
+        if self.identity:
+            opts += ['-i', self.identity]
+        return opts
+
+    def _exec(self, argv, timeout=None, stdin=None):
+        if self.run_as:
+            argv = ['sudo', '-H', '-u', self.run_as] + argv
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C'
+        # a master started by this command keeps its stderr open once
+        # backgrounded, so stderr goes to a file rather than a pipe that
+        # communicate() would wait on until the master exits
+        with tempfile.TemporaryFile() as err:
+            p = Popen(argv, stdin=PIPE if stdin else None, stdout=PIPE,
+                      stderr=err, env=env, close_fds=True)
+            try:
+                stdout, _ = p.communicate(input=stdin, timeout=timeout)
+            except TimeoutExpired:
+                log.warning("Killing {} after {}s".format(argv, timeout))
+                p.kill()
+                stdout, _ = p.communicate()
+            err.seek(0)
+            stderr = err.read()
+        return (p.returncode, stdout.decode('utf-8', 'replace'),
+                stderr.decode('utf-8', 'replace'))
+
+    def _record(self, host, duration):
+        with self.lock:
+            self.latencies.setdefault(host, []).append(duration)
+
+    def _call(self, host, argv, what, timeout=None, stdin=None):
+        start = time.time()
+        with tracer.span('ssh ' + what, 'ssh', host=host):
+            status, output, errors = self._exec(argv, timeout, stdin)
+            if status == SSH_CONNECTION_ERROR and \
+               CONNECT_FAILURE.search(errors):
+                log.debug("ssh connection to {} failed, reconnecting: "
+                          "{}".format(host, errors.strip()))
+                self.close(host)
+                status, output, errors = self._exec(argv, timeout, stdin)
+        output += errors
+        duration = time.time() - start
+        self._record(host, duration)
+        log.debug("ssh {} to {} exited {} in {:.2f}s".format(
+            what, host, status, duration))
+        return dict(status=status, output=output, duration=duration)
+
+    def run(self, host, cmd, timeout=None):
+        """ Runs a shell command on host
+
+        :param str cmd: command line, interpreted by the remote shell
+        :returns: {status: returncode, output: stdout then stderr,
+                   duration: seconds}
+        :rtype: dict
+        """
+        argv = ['ssh'] + self._options() + \
+            ['-l', self.user, host, cmd]
+        return self._call(host, argv, 'run', timeout)
+
+    def cp(self, host, src, dst, timeout=None):
+        """ Copies local files or directories to dst on host
+
+        :param str src: local path, may contain shell wildcards
+        :returns: same as run()
+        """
+        srcs = sorted(glob.glob(src)) or [src]
+        argv = ['scp', '-r', '-q'] + self._options() + srcs + \
+            ['{}@{}:{}'.format(self.user, host, dst)]
+        return self._call(host, argv, 'cp', timeout)
+
+    def run_bundle(self, host, files, cmd, timeout=None):
+        """ Copies files to host and runs cmd there, in one round trip
+
+        :param dict files: {remote absolute path: local path}
+        :param str cmd: command line, run once the files are in place
+        :returns: same as run(), plus 'error' from bundle_error()
+        """
+        argv = ['ssh'] + self._options() + \
+            ['-l', self.user, host, bundle_command(cmd)]
+        ret = self._call(host, argv, 'bundle', timeout,
+                         stdin=make_bundle(files))
+        ret['error'] = bundle_error(ret['status'])
+        return ret
+
+    def close(self, host=None):
+        """ Closes the master connection to host, or to all hosts """
+        hosts = [host] if host else list(self.latencies.keys())
+        for h in hosts:
+            argv = ['ssh'] + self._options() + \
+                ['-O', 'exit', '-l', self.user, h]
+            self._exec(argv, timeout=10)
+
+    def stats(self):
+        """ Returns {host: (count, mean seconds, max seconds)} """
+        with self.lock:
+            return {h: (len(d), sum(d) / len(d), max(d))
+                    for h, d in self.latencies.items()}
@@ -0,0 +1,204 @@
+#
+# timings.py - History of installer task durations
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Keeps the duration of every installer task of every run
+
+The store is a file of JSON lines, one per finished task, appended as
+the task finishes. It lives outside ~/.cloud-install so that it survives
+uninstalls, and a report compares a run with the median of earlier runs
+of the same install type to spot regressions, eg from a new MAAS or Juju.
+"""
+
+from collections import namedtuple, OrderedDict
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.timings')
+
+TIMINGS_FILE = '/var/lib/cloud-install/install-timings.jsonl'
+
+# A task regressed if it took this many times its median...
+REGRESSION_RATIO = 1.25
+
+# ...and at least this many seconds longer
+REGRESSION_MIN_SECONDS = 10
+
+
+TaskComparison = namedtuple('TaskComparison', ['task', 'duration',
+                                               'median', 'samples',
+                                               'regressed'])
+
+
+def new_run_id():
+    """ Identifies an installer run in the store """
+    return "{}-{}".format(int(time.time()), os.getpid())
+
+
+def host_facts(install_type, node_count=None):
+    """ Facts about the host that explain differences between runs
+
+    :param str install_type: eg 'single' or 'multi'
+    :param int node_count: machines the install deploys to, if known
+    :rtype: dict
+    """
+    ram_mb = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    ram_mb = int(line.split()[1]) // 1024
+                    break
+    except OSError:
+        pass
+    return dict(hostname=socket.gethostname(), cores=os.cpu_count(),
+                ram_mb=ram_mb, install_type=install_type,
+                node_count=node_count)
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+
+class TimingStore:
+    """ Append-only store of task durations """
+
+    def __init__(self, filename=TIMINGS_FILE):
+        """
+        :param str filename: store path, created on first record
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def record(self, run_id, task, start, end, facts):
+        """ Appends a finished task. Errors are logged, not raised, so
+        that timings never get in the way of an install.
+
+        :param dict facts: from host_facts()
+        """
+        entry = dict(run=run_id, task=task, start=start,
+                     duration=end - start, facts=facts)
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            log.warning("Unable to record timing of {} in {}: {}".format(
+                task, self.filename, e))
+
+    def runs(self):
+        """ Reads every run, oldest first
+
+        :returns: OrderedDict {run id: {'facts': dict,
+                                         'tasks': OrderedDict {task:
+                                                               seconds}}}
+        """
+        runs = OrderedDict()
+        if not os.path.exists(self.filename):
+            return runs
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partial line, from an install that was killed
+                    continue
+                facts = entry.get('facts') or {}
+                run = runs.setdefault(entry['run'],
+                                      dict(facts=facts,
+                                           tasks=OrderedDict()))
+                # facts such as the node count are learnt during the run,
+                # the latest task has the most complete ones
+                run['facts'] = facts
+                run['tasks'][entry['task']] = entry['duration']
+        return runs
+
+    def compare(self, run_id=None, ratio=REGRESSION_RATIO,
+                min_seconds=REGRESSION_MIN_SECONDS):
+        """ Compares a run with the earlier runs of the same install type
+
+        :param str run_id: run to compare, by default the latest
+        :returns: (run id, facts, [TaskComparison]), run id is None if
+                  there are no runs. median is None for tasks that no
+                  earlier run has.
+        """
+        runs = self.runs()
+        if len(runs) == 0:
+            return (None, {}, [])
+        ids = list(runs.keys())
+        run_id = run_id or ids[-1]
+        if run_id not in runs:
+            raise KeyError("No run {} in {}".format(run_id, self.filename))
+        current = runs[run_id]
+        install_type = current['facts'].get('install_type')
+        earlier = [runs[r] for r in ids[:ids.index(run_id)]
+                   if runs[r]['facts'].get('install_type') == install_type]
+        rows = []
+        for task, duration in current['tasks'].items():
+            history = [r['tasks'][task] for r in earlier
+                       if task in r['tasks']]
+            if len(history) == 0:
+                rows.append(TaskComparison(task, duration, None, 0, False))
+                continue
+            m = median(history)
+            regressed = duration > m * ratio and \
+                duration - m >= min_seconds
+            rows.append(TaskComparison(task, duration, m, len(history),
+                                       regressed))
+        return (run_id, current['facts'], rows)
+
+
+def format_report(run_id, facts, rows):
+    """ Formats the result of TimingStore.compare() as text
+
+    Facts missing from the stored run, eg from an older release, are
+    shown as '?'.
+    """
+    if run_id is None:
+        return "No install timings recorded yet."
+
+    def fact(key):
+        value = facts.get(key)
+        return '?' if value is None else value
+    lines = ["Install {} ({}, {} cores, {} MB RAM, {} nodes)".format(
+        run_id, fact('install_type'), fact('cores'), fact('ram_mb'),
+        fact('node_count')), ""]
+    width = max([len(r.task) for r in rows] + [4])
+    lines.append("{:<{w}}  {:>9}  {:>9}  {:>5}".format(
+        "Task", "Seconds", "Median", "Runs", w=width))
+    for r in rows:
+        m = "-" if r.median is None else "{:.1f}".format(r.median)
+        lines.append("{:<{w}}  {:>9.1f}  {:>9}  {:>5}{}".format(
+            r.task, r.duration, m, r.samples,
+            "  REGRESSION" if r.regressed else "", w=width))
+    regressed = [r.task for r in rows if r.regressed]
+    lines.append("")
+    if regressed:
+        lines.append("{} task(s) slower than usual: {}".format(
+            len(regressed), ", ".join(regressed)))
+    else:
+        lines.append("No regressions.")
+    return "\n".join(lines)
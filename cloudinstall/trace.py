@@ -0,0 +1,171 @@
+#
+# trace.py - Deployment timeline tracing
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Timeline tracing in Chrome trace-event format
+
+Spans are recorded for installer tasks, Juju and MAAS API calls,
+subprocesses, CharmQueue attempts and unit state transitions, each with
+the id of the thread it ran on. Load the resulting file in
+chrome://tracing or any trace-event viewer.
+
+Tracing is set up by the openstack-install and openstack-status scripts,
+writing to ~/.cloud-install/<name>.trace.json. Set `UCI_NOTRACE` in the
+environment to disable it.
+"""
+
+import atexit
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.trace')
+
+# Oldest events are dropped beyond this many
+MAX_EVENTS = 200000
+
+
+class Tracer:
+    """ Collects trace events in memory until written out """
+
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        # the oldest events fall off once MAX_EVENTS are kept
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def enable(self, filename):
+        """ Starts recording, writing to filename at exit. Programs that
+        exec another one call write() first.
+        """
+        self.filename = filename
+        self.enabled = True
+        atexit.register(self.write)
+
+    def _add(self, event):
+        t = threading.current_thread()
+        event['pid'] = self.pid
+        event['tid'] = t.ident
+        with self.lock:
+            self.thread_names[t.ident] = t.name
+            self.events.append(event)
+
+    def complete(self, name, cat, start, end, **args):
+        """ Records a span that ran from start to end (time.time()) """
+        if not self.enabled:
+            return
+        self._add(dict(name=name, cat=cat, ph='X', ts=int(start * 1e6),
+                       dur=int((end - start) * 1e6), args=args))
+
+    def instant(self, name, cat, **args):
+        """ Records a point in time, eg a unit state transition """
+        if not self.enabled:
+            return
+        self._add(dict(name=name, cat=cat, ph='i', s='t',
+                       ts=int(time.time() * 1e6), args=args))
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """ Context manager recording its body as a span """
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.complete(name, cat, start, time.time(), **args)
+
+    def write(self, filename=None):
+        """ Writes every event recorded so far """
+        filename = filename or self.filename
+        if filename is None:
+            return
+        with self.lock:
+            events = list(self.events)
+            names = dict(self.thread_names)
+        meta = [dict(name='thread_name', ph='M', pid=self.pid, tid=tid,
+                     args=dict(name=name))
+                for tid, name in names.items()]
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(dict(traceEvents=meta + events,
+                               displayTimeUnit='ms'), f)
+            os.rename(filename + '.tmp', filename)
+        except IOError:
+            log.exception("Unable to write trace to {}".format(filename))
+
+
+tracer = Tracer()
+
+
+def setup_tracer(name):
+    """ Enables tracing to ~/.cloud-install/<name>.trace.json
+
+    :param str name: name of the traced program
+    """
+    if os.getenv('UCI_NOTRACE'):
+        return
+    cfg_path = os.path.join(os.getenv('HOME'), '.cloud-install')
+    if not os.path.isdir(cfg_path):
+        os.makedirs(cfg_path)
+    tracer.enable(os.path.join(cfg_path, '{}.trace.json'.format(name)))
+
+
+def traced(cat, name=None):
+    """ Decorator recording each call of a function as a span """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedClient:
+    """ Wraps an API client, recording each method call as a span
+
+    :param client: eg a JujuClient or MaasClient
+    :param str cat: trace category, eg 'juju'
+    """
+
+    def __init__(self, client, cat):
+        self._client = client
+        self._cat = cat
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        # only methods are traced, properties like MaasClient.nodes
+        # are fetched as they are accessed
+        if not inspect.isroutine(getattr(type(self._client), attr, None)):
+            return value
+        name = "{}.{}".format(self._cat, attr)
+
+        @wraps(value)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, self._cat):
+                return value(*args, **kwargs)
+        return wrapper
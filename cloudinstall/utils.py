@@ -16,7 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from subprocess import (Popen, PIPE, call, STDOUT, check_output,
+from subprocess import (Popen, PIPE, call, STDOUT,
                         check_call, DEVNULL, CalledProcessError)
 from contextlib import contextmanager
 from collections import deque
@@ -34,15 +34,31 @@ import time
 from importlib import import_module
 import pkgutil
 import sys
-import errno
+import json
 import shlex
 import shutil
+import tempfile
+import hashlib
+import requests
+
+from cloudinstall import poll, process
+from cloudinstall.ssh import (SSHConnectionPool, bundle_command,
+                              bundle_error, make_bundle)
 
 log = logging.getLogger('cloudinstall.utils')
 
 # String with number of minutes, or None.
 blank_len = None
 
+# Commands matching this are run through sh -c
+SHELL_SYNTAX = re.compile(r"[|&;<>()$`\\*?\[\]~{}\n]|^\s*\w+=")
+
+# SSHConnectionPools, created on first use
+_container_ssh = None
+_juju_ssh = None
+# juju machine id -> address
+_juju_addresses = {}
+
 
 def global_exchandler(type, value, tb):
     """ helper routine capturing tracebacks and printing to log file """
@@ -73,6 +89,14 @@ class UtilsException(Exception):
     pass
 
 
+class ChecksumMismatch(UtilsException):
+    """ A download does not have the expected sha256 """
+
+
+# Bytes read from the network at once by http_fetch
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
 def load_charms():
     """ Load known charm modules
     """
@@ -84,6 +108,18 @@ def load_charms():
     return charm_modules
 
 
+def load_charm_manifest():
+    """ Load charm metadata without importing the charm modules
+
+    :returns: stand-ins for each charm class, see
+              :class:`~cloudinstall.charm_manifest.CharmManifestEntry`
+    :rtype: list
+    """
+    from cloudinstall.charm_manifest import load_manifest
+
+    return load_manifest()
+
+
 def load_charm_byname(name):
     """ Load a charm by name
 
@@ -92,6 +128,39 @@ def load_charm_byname(name):
     return import_module('cloudinstall.charms.{}'.format(name))
 
 
+def http_fetch(url):
+    """ Yields the body of url in chunks """
+    r = requests.get(url, stream=True, timeout=60)
+    r.raise_for_status()
+    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+def download(url, dest, fetch=http_fetch, sha256=None, on_chunk=None):
+    """ Downloads url to dest through dest.part, so that dest is only
+    ever complete
+
+    :param fetch: fetch(url) yields the contents of url in chunks
+    :param str sha256: expected checksum, ChecksumMismatch is raised
+                       and nothing kept if it differs
+    :param on_chunk: on_chunk(bytes) is called as each chunk is written
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + '.part'
+    h = hashlib.sha256()
+    with open(tmp, 'wb') as f:
+        for chunk in fetch(url):
+            f.write(chunk)
+            h.update(chunk)
+            if on_chunk:
+                on_chunk(len(chunk))
+    if sha256 is not None and h.hexdigest() != sha256:
+        os.remove(tmp)
+        raise ChecksumMismatch("Checksum mismatch for {}: expected {}, "
+                               "got {}".format(url, sha256, h.hexdigest()))
+    os.rename(tmp, dest)
+
+
 def chown(path, user, group, recursive=False):
     """
     Change user/group ownership of file
@@ -143,12 +212,32 @@ def apt_install(pkgs):
         pass
 
 
-def get_command_output(command, timeout=None, user_sudo=False):
-    """ Execute command through system shell
+def command_argv(command):
+    """ Splits a command line into argv, leaving it to sh -c if it uses
+    any shell syntax
+
+    :param str command: command line
+    :rtype: list
+    """
+    if SHELL_SYNTAX.search(command):
+        return ['sh', '-c', command]
+    return shlex.split(command)
+
+
+def get_command_output(command, timeout=None, user_sudo=False,
+                       full_output=False, log_output=True):
+    """ Execute command, through the system shell only if it needs one
+
+    Output lines are streamed to the debug log as they are read, and only
+    the last process.DEFAULT_TAIL_LINES are kept.
 
     :param command: command to run
-    :param timeout: (optional) use 'timeout' to limit time. default 300
+    :param timeout: (optional) seconds to let it run. default no limit
     :param user_sudo: (optional) sudo into install users env. default False.
+    :param full_output: (optional) keep all of the output, for output
+                        that is parsed. default False.
+    :param log_output: (optional) log the output, False for secrets or
+                       output polled repeatedly. default True.
     :type command: str
     :returns: {status: returncode, output: stdout+stdeer}
     :rtype: dict
@@ -158,61 +247,82 @@ def get_command_output(command, timeout=None, user_sudo=False):
         # Get output of juju status
         cmd_dict = utils.get_command_output('juju status')
     """
-    cmd_env = os.environ.copy()
-    # set consistent locale
-    cmd_env['LC_ALL'] = 'C'
-    if timeout:
-        command = "timeout %ds %s" % (timeout, command)
-
-    if user_sudo:
-        command = "sudo -H -u {0} {1}".format(install_user(), command)
-
-    try:
-        p = Popen(command, shell=True,
-                  stdout=PIPE, stderr=STDOUT,
-                  bufsize=-1, env=cmd_env, close_fds=True)
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            return dict(ret=127, output="")
-        else:
-            raise e
-    stdout, stderr = p.communicate()
-    if p.returncode == 126 or p.returncode == 127:
-        stdout = bytes()
-    return dict(status=p.returncode,
-                output=stdout.decode('utf-8'))
+    user = install_user() if user_sudo else None
+    tail_lines = None if full_output else process.DEFAULT_TAIL_LINES
+    ret = process.run(command_argv(command), timeout=timeout, user=user,
+                      tail_lines=tail_lines, log_output=log_output)
+    return dict(status=ret.status, output=ret.output)
 
 
 def poll_until_true(cmd, predicate, frequency, timeout=600,
-                    ignore_exceptions=False):
+                    ignore_exceptions=False, backoff=1.0,
+                    max_frequency=None):
     """run get_command_output(cmd) every frequency seconds, until
     predicate(output) returns True. Timeout after timeout seconds.
 
     returns True if call eventually succeeded, or False if timeout was
     reached.
 
-    Exceptions raised during get_command_output are handled as per
-    ignore_exceptions. If True, they are just logged. If False, they
-    are re-raised.
+    Exceptions raised during get_command_output or predicate are handled
+    as per ignore_exceptions. If True, they are just logged. If False,
+    they are re-raised.
 
+    With backoff > 1 the wait grows by that factor after each attempt,
+    up to max_frequency seconds. Polls run on the shared
+    cloudinstall.poll.scheduler, this only blocks the calling thread.
     """
-    start_time = time.time()
-    frequency_stub = time.time()
-    while True:
-        # continue if frequency not met
-        if time.time() - frequency_stub <= frequency:
-            continue
+    p = poll.Poll(lambda: get_command_output(cmd, log_output=False),
+                  predicate, frequency,
+                  timeout=timeout, backoff=backoff,
+                  max_interval=max_frequency,
+                  ignore_exceptions=ignore_exceptions,
+                  name=cmd)
+    return poll.scheduler.submit(p).wait()
+
+
+def container_ssh():
+    """ SSHConnectionPool for containers created by the installer """
+    global _container_ssh
+    if _container_ssh is None:
+        _container_ssh = SSHConnectionPool(identity=ssh_privkey(),
+                                           run_as=install_user())
+    return _container_ssh
+
+
+def juju_ssh():
+    """ SSHConnectionPool for juju machines """
+    global _juju_ssh
+    if _juju_ssh is None:
+        identity = os.path.join(install_home(), '.juju/ssh/juju_id_rsa')
+        if not os.path.exists(identity):
+            identity = None
+        run_as = install_user() if os.geteuid() == 0 else None
+        _juju_ssh = SSHConnectionPool(identity=identity, run_as=run_as)
+    return _juju_ssh
+
+
+def juju_machine_address(machine_id):
+    """ Returns the address of a juju machine or container, or None
+
+    Addresses are cached, juju status is only read for unknown machines.
+    """
+    if machine_id not in _juju_addresses:
+        out = get_command_output("juju status --format=json",
+                                 full_output=True, log_output=False)
+        if out['status'] != 0:
+            log.debug("Unable to read juju status: {}".format(out))
+            return None
+
+        def add_machines(machines):
+            for mid, m in machines.items():
+                if m.get('dns-name'):
+                    _juju_addresses[mid] = m['dns-name']
+                add_machines(m.get('containers', {}))
         try:
-            output = get_command_output(cmd)
-        except Exception as e:
-            if not ignore_exceptions:
-                raise e
-            else:
-                log.debug("**Ignoring** exception: {}".format(e))
-        if predicate(output):
-            return True
-        if time.time() - start_time >= timeout:
-            return False
+            add_machines(json.loads(out['output']).get('machines', {}))
+        except ValueError:
+            log.debug("Unable to parse juju status: {}".format(out))
+    return _juju_addresses.get(machine_id)
 
 
 def remote_cp(machine_id, src, dst):
@@ -220,19 +330,71 @@ def remote_cp(machine_id, src, dst):
         src=src,
         dst=dst,
         m=machine_id))
-    ret = get_command_output(
-        "juju scp {src} {m}:{dst}".format(src=src, dst=dst, m=machine_id))
+    address = juju_machine_address(machine_id)
+    if address:
+        ret = juju_ssh().cp(address, src, dst)
+    else:
+        ret = get_command_output(
+            "juju scp {src} {m}:{dst}".format(src=src, dst=dst,
+                                              m=machine_id))
     log.debug("Remote copy result: {r}".format(r=ret))
+    return ret
 
 
 def remote_run(machine_id, cmds):
+    """ Runs cmds as root on a juju machine
+
+    :param cmds: command string, or list of commands to run in turn
+    :returns: {status: returncode, output: stdout+stderr}
+    """
     if type(cmds) is list:
         cmds = " && ".join(cmds)
     log.debug("Remote running ({cmds}) on machine {m}".format(
         m=machine_id, cmds=cmds))
-    ret = get_command_output(
-        "juju run --machine {m} '{cmds}'".format(m=machine_id,
-                                                 cmds=cmds))
+    address = juju_machine_address(machine_id)
+    if address:
+        # juju run runs commands as root, so does this
+        ret = juju_ssh().run(address,
+                             "sudo -n sh -c {}".format(shlex.quote(cmds)))
+    else:
+        ret = get_command_output(
+            "juju run --machine {m} '{cmds}'".format(m=machine_id,
+                                                     cmds=cmds))
+    log.debug("Remote run result: {r}".format(r=ret))
+    return ret
+
+
+def remote_bundle_run(machine_id, files, cmds):
+    """ Copies files to a juju machine and runs cmds there as root, in
+    one round trip
+
+    :param dict files: {remote absolute path: local path}
+    :param cmds: command string, or list of commands to run in turn
+    :returns: {status: returncode, output: stdout+stderr,
+               error: None, 'connection', 'unpack' or 'command'}
+    """
+    if type(cmds) is list:
+        cmds = " && ".join(cmds)
+    log.debug("Remote running ({cmds}) with {files} on machine {m}".format(
+        m=machine_id, cmds=cmds, files=sorted(files)))
+    address = juju_machine_address(machine_id)
+    if address:
+        ret = juju_ssh().run_bundle(
+            address, files, "sudo -n sh -c {}".format(shlex.quote(cmds)))
+    else:
+        # no address yet, go through juju: one copy and one run
+        with tempfile.NamedTemporaryFile(prefix='cloud-install-bundle-',
+                                         suffix='.tar') as f:
+            f.write(make_bundle(files))
+            f.flush()
+            archive = os.path.join('/tmp', os.path.basename(f.name))
+            get_command_output("juju scp {src} {m}:{dst}".format(
+                src=f.name, m=machine_id, dst=archive))
+        ret = get_command_output(
+            "juju run --machine {m} {cmds}".format(
+                m=machine_id,
+                cmds=shlex.quote(bundle_command(cmds, archive))))
+        ret['error'] = bundle_error(ret['status'])
     log.debug("Remote run result: {r}".format(r=ret))
     return ret
 
@@ -356,7 +518,7 @@ def random_password(size=32):
 
     :param int size: length of password
     """
-    out = get_command_output("pwgen -s {}".format(size))
+    out = get_command_output("pwgen -s {}".format(size), log_output=False)
     return out['output'].strip()
 
 
@@ -412,24 +574,16 @@ def container_run(name, cmd):
     ip = container_ip(name)
     if ip is None:
         raise Exception("could not find ip for container '{}'".format(name))
-    quoted_cmd = shlex.quote(cmd)
-    wrapped_cmd = ("sudo -H -u {3} TERM=xterm256-color ssh -t -q "
-                   "-l ubuntu -o \"StrictHostKeyChecking=no\" "
-                   "-o \"UserKnownHostsFile=/dev/null\" "
-                   "-i {2} "
-                   "{0} {1}".format(ip, quoted_cmd, ssh_privkey(),
-                                    install_user()))
-    log.debug("Running in container: {0}".format(wrapped_cmd))
+    log.debug("Running in container {0}: {1}".format(name, cmd))
 
-    try:
-        ret = check_output(wrapped_cmd, stderr=STDOUT, shell=True)
-        log.debug(ret)
-        return ret
-    except CalledProcessError as e:
+    ret = container_ssh().run(ip, cmd)
+    log.debug(ret['output'])
+    if ret['status'] != 0:
         raise Exception("There was a problem running ({0}) in the container "
-                        "({1}:{2}) Error: {3}\n"
-                        "Output: {4}".format(quoted_cmd, name, ip, e,
-                                             e.output))
+                        "({1}:{2}) Error: exit status {3}\n"
+                        "Output: {4}".format(cmd, name, ip, ret['status'],
+                                             ret['output']))
+    return ret['output'].encode('utf-8')
 
 
 def container_run_status(name, cmd):
@@ -454,33 +608,60 @@ def container_cp(name, filepath, dst):
     :param str dst: destination of remote path
     """
     ip = container_ip(name)
-    cmd = ("scp -r -q "
-           "-o \"StrictHostKeyChecking=no\" "
-           "-o \"UserKnownHostsFile=/dev/null\" "
-           "-i {identity} "
-           "{filepath} "
-           "ubuntu@{ip}:{dst} ".format(ip=ip, dst=dst,
-                                       identity=ssh_privkey(),
-                                       filepath=filepath))
-    ret = get_command_output(cmd)
+    ret = container_ssh().cp(ip, filepath, dst)
     if ret['status'] > 0:
         raise Exception("There was a problem copying ({0}) to the container "
-                        "({1}:{2}): {}".format(
+                        "({1}:{2}): {3}".format(
                             filepath, name, ip, ret['output']))
 
 
-def container_create(name, userdata):
+def container_create(name, userdata, backingstore=None):
     """ creates a container from ubuntu-cloud template
+
+    :param str backingstore: lxc backing store, eg 'btrfs', default 'dir'
     """
-    out = get_command_output(
-        'sudo lxc-create -t ubuntu-cloud '
-        '-n {0} -- -u {1}'.format(name, userdata))
+    cmd = 'sudo lxc-create -t ubuntu-cloud -n {0}'.format(name)
+    if backingstore:
+        cmd += ' -B {0}'.format(backingstore)
+    out = get_command_output('{0} -- -u {1}'.format(cmd, userdata))
     if out['status'] > 0:
         raise Exception("Unable to create container: "
                         "{0}".format(out['output']))
     return out['status']
 
 
+def container_snapshot_backingstore(path='/var/lib/lxc'):
+    """ backing store for copy-on-write clones of containers in path
+
+    :returns: 'btrfs' if path is on btrfs, else 'overlayfs'
+    """
+    out = get_command_output('stat -f -c %T {0}'.format(path))
+    if out['status'] == 0 and out['output'].strip() == 'btrfs':
+        return 'btrfs'
+    return 'overlayfs'
+
+
+def container_clone(base, name, userdata, backingstore='overlayfs'):
+    """ creates a copy-on-write clone of a stopped container
+
+    The ubuntu-cloud clone hook gives the clone a new cloud-init instance
+    id, so cloud-init runs again with userdata.
+
+    :param str base: name of container to clone
+    :param str name: name of the clone
+    :param str backingstore: 'overlayfs', or 'btrfs' if base is on btrfs
+    """
+    cmd = 'sudo lxc-clone -s -o {0} -n {1}'.format(base, name)
+    if backingstore != 'btrfs':
+        # btrfs snapshots need no backing store option
+        cmd += ' -B {0}'.format(backingstore)
+    out = get_command_output('{0} -- --userdata {1}'.format(cmd, userdata))
+    if out['status'] > 0:
+        raise Exception("Unable to clone container {0}: "
+                        "{1}".format(base, out['output']))
+    return out['status']
+
+
 def container_start(name):
     """ starts lxc container
 
@@ -525,6 +706,48 @@ def container_destroy(name):
     return out['status']
 
 
+def container_init_pid(name):
+    """ pid of the init process of a running container, its filesystem
+    as the container sees it is under /proc/<pid>/root
+
+    :param str name: name of container
+    :returns: pid, or None if the container is not running
+    """
+    out = get_command_output('sudo lxc-info -n {0} -p -H'.format(name))
+    if out['status'] != 0 or not out['output'].strip().isdigit():
+        return None
+    return int(out['output'].strip())
+
+
+def container_wait_for_file(name, path, timeout=3600):
+    """ waits for a file to exist in the container, with one command that
+    runs in the container until it does
+
+    :param str name: name of container
+    :param str path: absolute path in the container
+    :returns: contents of the file
+    """
+    cmd = ("sudo sh -c 'while [ ! -e {0} ]; do sleep 1; done; "
+           "cat {0}'".format(path))
+    deadline = time.time() + timeout
+    while True:
+        ip = container_ip(name)
+        status = None
+        if ip is not None:
+            ret = container_ssh().run(ip, cmd,
+                                      timeout=max(deadline - time.time(), 1))
+            if ret['status'] == 0:
+                return ret['output']
+            status = ret['status']
+        if time.time() >= deadline:
+            raise Exception("Timed out waiting for {0} in container "
+                            "{1}".format(path, name))
+        # the container has no address or sshd early in its boot
+        log.debug("Waiting for {0} in container {1} ({2}): exit status "
+                  "{3}".format(path, name, ip, status))
+        time.sleep(2)
+
+
 def container_wait(name):
     """ waits for the container to be in a RUNNING state
 
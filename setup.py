@@ -65,6 +65,7 @@ setup(name='openstack',
       license="AGPLv3+",
       scripts=['bin/openstack-install', 'bin/openstack-status'],
       packages=find_packages(exclude=["test"]),
+      package_data={'cloudinstall.charms': ['manifest.yaml']},
       data_files=[
           ('share/man/man1', ['man/en/openstack-status.1',
                               'man/en/openstack-install.1'])
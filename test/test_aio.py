@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# tests aio.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+import time
+import unittest
+
+from cloudinstall import aio
+from cloudinstall.process import TIMEOUT_STATUS
+
+
+class AioTestCase(unittest.TestCase):
+
+    def test_run_command(self):
+        seen = []
+        ret = aio.run_until_complete(aio.run_command(
+            ['sh', '-c', 'echo a; echo b >&2; exit 2'], on_line=seen.append))
+        self.assertEqual(ret.status, 2)
+        self.assertEqual(seen, ['a\n', 'b\n'])
+        self.assertEqual(ret.lines, 2)
+
+    def test_concurrent(self):
+        start = time.time()
+        results = aio.run_until_complete(aio.gather(
+            aio.run_command(['sleep', '0.3']),
+            aio.run_command(['sleep', '0.3'])))
+        self.assertEqual([r.status for r in results], [0, 0])
+        self.assertTrue(time.time() - start < 0.55)
+
+    def test_timeout(self):
+        ret = aio.run_until_complete(aio.run_command(['sleep', '30'],
+                                                     timeout=0.2))
+        self.assertTrue(ret.timed_out)
+        self.assertEqual(ret.status, TIMEOUT_STATUS)
+
+    def test_failure_cancels(self):
+        start = time.time()
+
+        @asyncio.coroutine
+        def slow():
+            yield from aio.run_command(['sleep', '30'])
+
+        self.assertRaises(aio.CommandError, aio.run_until_complete,
+                          aio.gather(slow(), aio.check_command(['false'])))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_worker_thread(self):
+        results = []
+
+        def worker():
+            results.append(aio.run_until_complete(
+                aio.run_command(['true'])).status)
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join(10)
+        self.assertEqual(results, [0])
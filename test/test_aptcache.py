@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# tests aptcache.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import socket
+import subprocess
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+from cloudinstall import aptcache
+
+
+class AptCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.utils = patch('cloudinstall.aptcache.utils').start()
+        self.listening = patch('cloudinstall.aptcache.listening').start()
+        self.addCleanup(patch.stopall)
+        self.installed = False
+
+        def get_command_output(cmd):
+            if cmd.startswith('dpkg-query'):
+                return dict(status=0 if self.installed else 1,
+                            output='install ok installed'
+                            if self.installed else '')
+            return dict(status=0, output='')
+        self.utils.get_command_output.side_effect = get_command_output
+
+    def test_reuses_running_proxy(self):
+        self.installed = True
+        self.listening.return_value = True
+        self.utils.slurp.return_value = aptcache.settings(
+            ['10.0.3.1']).strip()
+        self.assertTrue(aptcache.start(['10.0.3.1']))
+        self.assertFalse(self.utils.apt_install.called)
+        self.assertFalse(self.utils.spew.called)
+        self.utils.get_command_output.assert_called_once_with(
+            "dpkg-query -W -f='${Status}' apt-cacher-ng")
+
+    def test_installs_and_starts(self):
+        self.listening.side_effect = [False, True]
+        self.utils.slurp.side_effect = IOError
+
+        def install(pkgs):
+            self.installed = True
+        self.utils.apt_install.side_effect = install
+        with patch.dict('os.environ', {'http_proxy': 'http://squid:3128'}):
+            self.assertTrue(aptcache.start(['10.0.3.1']))
+        self.utils.apt_install.assert_called_once_with('apt-cacher-ng')
+        self.utils.spew.assert_called_once_with(
+            aptcache.ACNG_CONF,
+            "BindAddress: localhost 10.0.3.1\n" + aptcache.ACNG_SETTINGS +
+            "Proxy: http://squid:3128\n")
+        self.utils.get_command_output.assert_any_call(
+            'service apt-cacher-ng restart')
+
+    def test_restarts_to_listen_on_bridge(self):
+        self.installed = True
+        self.listening.return_value = True
+        self.utils.slurp.return_value = aptcache.settings().strip()
+        self.assertTrue(aptcache.start(['192.168.100.1']))
+        self.assertEqual(self.utils.spew.call_args[0][1].splitlines()[0],
+                         "BindAddress: localhost 192.168.100.1")
+        self.utils.get_command_output.assert_any_call(
+            'service apt-cacher-ng restart')
+
+    def test_no_open_relay(self):
+        pattern = [l.split(': ', 1)[1] for l in
+                   aptcache.settings().splitlines()
+                   if l.startswith("PassThroughPattern:")][0]
+        self.assertTrue(re.search(pattern, "images.maas.io:443"))
+        self.assertFalse(re.search(pattern, "evil.example.com:443"))
+        self.assertFalse(re.search(pattern, "images.maas.io.example.com:443"))
+        self.assertFalse(re.search(pattern, "images.maas.io:22"))
+
+    def test_boot_images_not_cached(self):
+        pattern = [l.split(': ', 1)[1] for l in
+                   aptcache.settings().splitlines()
+                   if l.startswith("DontCache:")][0]
+        for url in ["localhost/cloud-install-images/streams/v1/index.json",
+                    "maas.ubuntu.com/images/ephemeral-v2/releases/trusty/"
+                    "amd64/20141001/generic/boot-kernel"]:
+            self.assertTrue(re.search(pattern, url))
+        self.assertFalse(re.search(
+            pattern, "archive.ubuntu.com/ubuntu/pool/main/a/a.deb"))
+
+    def test_install_failure(self):
+        self.listening.return_value = False
+        self.assertFalse(aptcache.start())
+
+    @patch('cloudinstall.aptcache.os.chmod')
+    def test_use_on_host(self, mock_chmod):
+        aptcache.use_on_host()
+        self.utils.spew.assert_any_call(
+            aptcache.HOST_PROXY_CONF,
+            'Acquire::http::Proxy-Auto-Detect '
+            '"/etc/apt/cloud-install-proxy-detect";\n')
+        mock_chmod.assert_called_once_with(aptcache.HOST_PROXY_DETECT, 0o755)
+
+    def detect(self, port):
+        with TemporaryDirectory() as d:
+            script = os.path.join(d, 'detect')
+            with open(script, 'w') as f:
+                f.write(aptcache.HOST_PROXY_DETECT_SCRIPT.format(port=port))
+            return subprocess.check_output(['bash', script])
+
+    def test_host_uses_listening_proxy(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            s.listen(1)
+            port = s.getsockname()[1]
+            self.assertEqual(self.detect(port),
+                             'http://127.0.0.1:{}\n'.format(port).encode())
+
+    def test_host_falls_back_to_direct(self):
+        self.assertEqual(self.detect(1), b'DIRECT\n')
+
+
+class AptCacheStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        f = NamedTemporaryFile('w', suffix='apt-cacher.log', delete=False)
+        self.addCleanup(os.remove, f.name)
+        f.write("1000|I|500|10.0.0.1|ubuntu/pool/main/a/a.deb\n"
+                "1000|O|500|10.0.0.1|ubuntu/pool/main/a/a.deb\n"
+                "2000|I|100|10.0.0.2|ubuntu/pool/main/b/b.deb\n"
+                "2000|O|100|10.0.0.2|ubuntu/pool/main/b/b.deb\n"
+                "2001|O|500|10.0.0.3|ubuntu/pool/main/a/a.deb\n"
+                "2002|O|400|10.0.0.4|ubuntu/pool/main/c/c.deb\n"
+                "garbage\n")
+        f.close()
+        self.log = f.name
+
+    def test_transfer_stats(self):
+        self.assertEqual(aptcache.transfer_stats(log_file=self.log),
+                         (1500, 600))
+        self.assertEqual(aptcache.transfer_stats(2000, self.log),
+                         (1000, 100))
+
+    def test_format_stats(self):
+        self.assertEqual(aptcache.format_stats(1000 * 1024 * 1024,
+                                               100 * 1024 * 1024),
+                         "apt cache: 90% hit rate, 1000 MB served, 100 MB "
+                         "downloaded")
+        self.assertIsNone(aptcache.format_stats(0, 0))
+        self.assertEqual(aptcache.transfer_stats(log_file='/nonexistent'),
+                         (0, 0))
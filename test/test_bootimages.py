@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# tests maas/bootimages.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+from cloudinstall.maas.bootimages import (BootImageTracker,
+                                          BootImageImportStalled,
+                                          ImportProgress, format_progress,
+                                          resource_bytes)
+
+MB = 1024 * 1024
+
+
+def resource(**files):
+    return {'sets': {
+        '20140101': {'complete': True, 'size': 1},
+        '20141010': {'complete': False,
+                     'files': {n: dict(size=s * MB, complete=c)
+                               for n, (s, c) in files.items()}}}}
+
+
+class ResourceBytesTestCase(unittest.TestCase):
+
+    def test_latest_set_files(self):
+        r = resource(kernel=(10, True), initrd=(20, False))
+        self.assertEqual(resource_bytes(r), (10 * MB, 30 * MB))
+
+    def test_set_progress(self):
+        r = {'sets': {'20141010': {'size': 200, 'progress': 25.0}}}
+        self.assertEqual(resource_bytes(r), (50, 200))
+
+    def test_no_sets(self):
+        self.assertEqual(resource_bytes({'sets': {}}), (0, None))
+
+
+class BootImageTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory(suffix="boot-resources")
+        self.addCleanup(self.tempdir.cleanup)
+        self.resources = []
+        self.now = 1000.0
+        p = patch('cloudinstall.maas.bootimages.time.time',
+                  lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+        self.tracker = BootImageTracker(lambda: self.resources,
+                                        storage=self.tempdir.name,
+                                        stall_timeout=300)
+
+    def test_rate_and_eta(self):
+        self.resources = [resource(kernel=(10, False), root=(90, False))]
+        self.tracker.sample()
+        self.now += 10
+        self.resources = [resource(kernel=(10, True), root=(90, False))]
+        p = self.tracker.sample()
+        self.assertEqual((p.done, p.total), (10 * MB, 100 * MB))
+        self.assertEqual(p.rate, MB)
+        self.assertEqual(p.eta, 90)
+        self.assertEqual(format_progress(p), "10/100 MB, 1.0 MB/s, "
+                                             "1:30 left")
+
+    def test_disk_usage_counts(self):
+        with open(os.path.join(self.tempdir.name, 'root-tgz'), 'wb') as f:
+            f.write(b'\0' * MB)
+        self.assertEqual(self.tracker.sample().done, MB)
+
+    def test_stall(self):
+        self.resources = [resource(root=(90, False))]
+        self.tracker.sample()
+        self.now += 200
+        self.tracker.sample()
+        self.now += 200
+        self.assertRaises(BootImageImportStalled, self.tracker.sample)
+
+    def test_no_stall_once_downloaded(self):
+        self.resources = [resource(root=(90, True))]
+        self.tracker.sample()
+        self.now += 1000
+        self.assertEqual(self.tracker.sample().done, 90 * MB)
+
+    def test_format_unknown_total(self):
+        self.assertEqual(format_progress(ImportProgress(5 * MB, None, None,
+                                                        None)), "5 MB")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# tests charm_manifest.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from cloudinstall import utils
+from cloudinstall.charms.compute import CharmNovaCompute
+from cloudinstall.charm_manifest import (charm_metadata,
+                                         CharmManifestEntry,
+                                         load_manifest)
+from cloudinstall.placement.controller import AssignmentType
+
+
+class CharmManifestTestCase(unittest.TestCase):
+
+    def test_manifest_is_current(self):
+        "manifest.yaml must be regenerated when a charm class changes"
+        modules = utils.load_charms()
+        manifest = load_manifest()
+        self.assertEqual([m.__name__.split('.')[-1] for m in modules],
+                         [e.module_name for e in manifest])
+        for m, entry in zip(modules, manifest):
+            self.assertEqual(charm_metadata(m.__charm_class__),
+                             entry.metadata)
+
+    def test_entry_matches_class(self):
+        entry = next(e for e in load_manifest()
+                     if e.charm_name == 'nova-compute')
+        self.assertEqual(entry, CharmNovaCompute)
+        self.assertEqual(CharmNovaCompute, entry)
+        self.assertIn(CharmNovaCompute, set([entry]))
+        self.assertIn(entry, [CharmNovaCompute])
+        self.assertEqual(entry.allowed_assignment_types,
+                         [AssignmentType.BareMetal, AssignmentType.KVM])
+        self.assertEqual(entry.required_num_units(), 1)
+
+    def test_entry_imports_lazily(self):
+        entry = CharmManifestEntry('compute',
+                                   charm_metadata(CharmNovaCompute))
+        self.assertIsNone(entry._charm_class)
+        self.assertEqual(entry.display_name, 'Compute')
+        self.assertIsNone(entry._charm_class)
+
+        charm = entry(juju=None, juju_state=None, ui=None)
+        self.assertIsInstance(charm, CharmNovaCompute)
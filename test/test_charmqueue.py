@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# tests charms/__init__.py CharmQueue
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.charms import CharmQueue, CharmTask
+
+
+class FakeCharm:
+
+    def __init__(self, name, failures=0, related=()):
+        self.charm_name = name
+        self.related = list(related)
+        self.relation_endpoints = {}
+        self.deploy_prerequisites = []
+        self.juju_state = None
+        self.failures = failures
+        self.calls = 0
+        self.done = threading.Event()
+
+    def set_relations(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            return True
+        self.done.set()
+        return False
+
+
+class CharmQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.q = CharmQueue(ui=MagicMock())
+        self.q.BACKOFF_INITIAL = 0.01
+
+    def test_retries_with_backoff(self):
+        charm = FakeCharm('keystone', failures=2)
+        self.q.add_relation(charm)
+        self.assertEqual(self.q.queue_depth()['relations'], 1)
+
+        self.q.watch_relations()
+        self.assertTrue(charm.done.wait(5))
+        self.assertEqual(charm.calls, 3)
+        time.sleep(0.05)
+        self.assertEqual(self.q.queue_depth()['relations'], 0)
+        self.assertEqual(self.q.completed['relations'], 1)
+
+    def test_wait_done(self):
+        charm = FakeCharm('keystone', failures=1)
+        self.q.add_relation(charm)
+        self.q.watch_relations()
+        self.q.wait_done()
+        self.assertEqual(charm.calls, 2)
+        self.assertEqual(self.q.queue_depth()['relations'], 0)
+
+    def test_wait_done_timeout(self):
+        charm = FakeCharm('keystone', failures=100)
+        self.q.BACKOFF_INITIAL = 60
+        self.q.add_relation(charm)
+        self.q.watch_relations()
+        self.assertFalse(self.q.wait_done(0.1))
+
+    def test_wakes_on_relation_endpoints(self):
+        charm = FakeCharm('nova-compute', related=['glance'])
+        charm.relation_endpoints = {'mysql': 'shared-db'}
+        task = CharmTask('relations', charm)
+        self.assertTrue(task.wakes_on('glance'))
+        self.assertTrue(task.wakes_on('mysql'))
+        self.assertFalse(task.wakes_on('swift-proxy'))
+
+    def test_retry_counts(self):
+        charm = FakeCharm('keystone', failures=100)
+        self.q.BACKOFF_INITIAL = 60
+        self.q.add_relation(charm)
+        self.q.watch_relations()
+        time.sleep(0.1)
+        self.assertEqual(charm.calls, 1)
+        self.assertEqual(self.q.retry_counts(),
+                         {('relations', 'keystone'): 1})
+
+    def test_unwatched_stage_not_run(self):
+        charm = FakeCharm('keystone')
+        self.q.add_relation(charm)
+        self.q.add_post_proc(charm)
+        self.q.watch_post_proc()
+        time.sleep(0.05)
+        self.assertEqual(charm.calls, 0)
+        self.assertEqual(self.q.queue_depth(),
+                         {'deploy': 0, 'relations': 1, 'post_proc': 1})
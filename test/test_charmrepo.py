@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# tests charmrepo.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import os
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from cloudinstall.charmrepo import (CharmRepoError, LocalCharmRepository,
+                                    upload)
+from cloudinstall.charms import CharmBase
+
+STORE = 'https://store.example'
+
+
+class FakeStore:
+
+    def __init__(self):
+        self.archives = {'keystone': (12, b'keystone zip'),
+                         'mysql': (7, b'mysql zip')}
+        self.info_calls = []
+        self.fetched = []
+        self.offline = False
+        self.lock = threading.Lock()
+
+    def info(self, charm_ids, store_url):
+        if self.offline:
+            raise requests.ConnectionError("offline")
+        self.info_calls.append(charm_ids)
+        result = {}
+        for cid in charm_ids:
+            name = cid.split('/')[-1]
+            if name not in self.archives:
+                result[cid] = {'errors': ['entry not found']}
+                continue
+            rev, data = self.archives[name]
+            result[cid] = {'revision': rev,
+                           'sha256': hashlib.sha256(data).hexdigest()}
+        return result
+
+    def fetch(self, url):
+        if self.offline:
+            raise requests.ConnectionError("offline")
+        with self.lock:
+            self.fetched.append(url)
+        name, rev = url.split('/')[-1].rsplit('-', 1)
+        yield self.archives[name][1]
+
+
+class LocalCharmRepositoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.store = FakeStore()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def repo(self, **kwargs):
+        return LocalCharmRepository(root=self.tempdir.name,
+                                    store_url=STORE, info=self.store.info,
+                                    fetch=self.store.fetch, **kwargs)
+
+    def test_resolves_all_charms_in_one_request(self):
+        resolved = self.repo().resolve(['keystone', 'mysql', 'nope'])
+        self.assertEqual(self.store.info_calls,
+                         [['cs:trusty/keystone', 'cs:trusty/mysql',
+                           'cs:trusty/nope']])
+        self.assertEqual(resolved['keystone']['revision'], 12)
+        self.assertEqual(resolved['mysql']['revision'], 7)
+        self.assertNotIn('nope', resolved)
+
+    def test_mirror_fetches_archives_by_revision(self):
+        repo = self.repo()
+        archives = repo.mirror(['keystone', 'mysql'])
+        self.assertEqual(sorted(self.store.fetched),
+                         [STORE + '/charm/trusty/keystone-12',
+                          STORE + '/charm/trusty/mysql-7'])
+        self.assertEqual(archives['keystone'],
+                         repo.archive_path('keystone', 12))
+        with open(archives['mysql'], 'rb') as f:
+            self.assertEqual(f.read(), b'mysql zip')
+        self.assertEqual((repo.hits, repo.fetched), (0, 2))
+
+    def test_cached_charms_need_no_network(self):
+        self.repo().mirror(['keystone', 'mysql'])
+        self.store.offline = True
+        self.store.info_calls = []
+        repo = self.repo()
+        archives = repo.mirror(['keystone', 'mysql'])
+        self.assertEqual(self.store.info_calls, [])
+        self.assertEqual(len(archives), 2)
+        self.assertEqual((repo.hits, repo.fetched), (2, 0))
+
+    def test_stale_revisions_used_when_store_unreachable(self):
+        self.repo().mirror(['keystone'])
+        self.store.offline = True
+        archives = self.repo(max_age=0).mirror(['keystone'])
+        self.assertEqual(list(archives), ['keystone'])
+
+    def test_new_revision_fetched_once_stale(self):
+        self.repo().mirror(['keystone'])
+        self.store.archives['keystone'] = (13, b'new keystone zip')
+        repo = self.repo(max_age=0)
+        archives = repo.mirror(['keystone'])
+        self.assertEqual(archives['keystone'],
+                         repo.archive_path('keystone', 13))
+        self.assertTrue(os.path.exists(repo.archive_path('keystone', 12)))
+
+    def test_checksum_mismatch_left_out(self):
+        self.store.info = MagicMock(return_value={
+            'cs:trusty/keystone': {'revision': 12, 'sha256': 'bad'}})
+        repo = self.repo()
+        self.assertEqual(repo.mirror(['keystone']), {})
+        self.assertFalse(os.path.exists(repo.archive_path('keystone', 12)))
+
+
+class UploadTestCase(unittest.TestCase):
+
+    @patch('cloudinstall.charmrepo.requests.post')
+    def test_upload(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {
+            'CharmURL': 'local:trusty/keystone-0'}
+        with NamedTemporaryFile() as f:
+            url = upload(f.name, 'trusty', '10.0.0.1:17070', 'pw',
+                         '/tmp/ca.pem')
+        self.assertEqual(url, 'local:trusty/keystone-0')
+        args, kwargs = mock_post.call_args
+        self.assertEqual(args[0], 'https://10.0.0.1:17070/charms')
+        self.assertEqual(kwargs['params'], {'series': 'trusty'})
+        self.assertEqual(kwargs['auth'], ('user-admin', 'pw'))
+        self.assertEqual(kwargs['verify'], '/tmp/ca.pem')
+
+    @patch('cloudinstall.charmrepo.requests.post')
+    def test_upload_verifies_with_environment_ca(self, mock_post):
+        certs = []
+
+        def post(url, **kwargs):
+            with open(kwargs['verify']) as f:
+                certs.append(f.read())
+            return MagicMock(status_code=200, json=MagicMock(
+                return_value={'CharmURL': 'local:trusty/keystone-0'}))
+        mock_post.side_effect = post
+        with NamedTemporaryFile() as f:
+            repo = LocalCharmRepository(root='/nonexistent')
+            urls = repo.upload({'keystone': f.name}, '10.0.0.1:17070',
+                               'pw', 'PEM CA')
+        self.assertEqual(urls, {'keystone': 'local:trusty/keystone-0'})
+        self.assertEqual(certs, ['PEM CA'])
+
+    @patch('cloudinstall.charmrepo.requests.post')
+    def test_upload_error(self, mock_post):
+        mock_post.return_value.status_code = 400
+        mock_post.return_value.json.return_value = {'Error': 'bad charm'}
+        with NamedTemporaryFile() as f:
+            self.assertRaises(CharmRepoError, upload, f.name, 'trusty',
+                              '10.0.0.1:17070', 'pw', '/tmp/ca.pem')
+
+
+class CharmDeployTestCase(unittest.TestCase):
+
+    @patch('cloudinstall.charms.Config')
+    def test_deploys_from_store_without_charm_url(self, mock_config):
+        charm = CharmBase(juju=MagicMock())
+        charm.charm_name = 'keystone'
+        charm.juju_deploy(1, "", "lxc:1")
+        charm.juju.deploy.assert_called_once_with('keystone', 'keystone', 1,
+                                                  "", {}, "lxc:1")
+
+    @patch('cloudinstall.charms.Config')
+    def test_deploys_local_charm_url(self, mock_config):
+        charm = CharmBase(juju=MagicMock())
+        charm.charm_name = 'keystone'
+        charm.charm_url = 'local:trusty/keystone-0'
+        charm.juju_deploy(1, "", "lxc:1")
+        self.assertFalse(charm.juju.deploy.called)
+        params = charm.juju.call.call_args[0][0]
+        self.assertEqual(params['Request'], 'ServiceDeploy')
+        self.assertEqual(params['Params']['CharmUrl'],
+                         'local:trusty/keystone-0')
+        self.assertEqual(params['Params']['ToMachineSpec'], 'lxc:1')
@@ -16,11 +16,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
 import unittest
 from unittest.mock import ANY, MagicMock, patch, PropertyMock
 from tempfile import NamedTemporaryFile
 
 from cloudinstall import core
+from cloudinstall.placement.controller import AssignmentType
 
 
 @patch('cloudinstall.core.JujuClient')
@@ -68,3 +70,136 @@ class DisplayControllerTestCase(unittest.TestCase):
                                                 password=self.passwd)
         assert mock_maasauth.called is False
         assert mock_maasclient.called is False
+
+
+@patch('cloudinstall.core.Config')
+class ControllerMachineSpecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.journal = MagicMock()
+        self.journal.keys.return_value = ['iid-1']
+        self.journal.data.return_value = {'machine_id': '3'}
+
+    def test_get_machine_spec(self, mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.juju_m_idmap = {'iid-1': '3'}
+        m = MagicMock(instance_id='iid-1')
+        self.assertEqual(c.get_machine_spec(m, AssignmentType.BareMetal), '3')
+        self.assertEqual(c.get_machine_spec(m, AssignmentType.LXC), 'lxc:3')
+        self.assertIsNone(c.get_machine_spec(MagicMock(instance_id='iid-9'),
+                                             AssignmentType.KVM))
+
+    def test_update_juju_m_idmap(self, mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.journal = self.journal
+        c.juju_state = MagicMock()
+        c.juju_state.machines.return_value = [
+            MagicMock(instance_id='pending', machine_id='3'),
+            MagicMock(instance_id='iid-2', machine_id='4'),
+            MagicMock(instance_id='pending', machine_id='5')]
+        c.update_juju_m_idmap()
+        self.assertEqual(c.juju_m_idmap, {'iid-1': '3', 'iid-2': '4'})
+
+    def test_journaled_machine_not_in_status_ignored(self, mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.journal = self.journal
+        c.juju_state = MagicMock()
+        c.juju_state.machines.return_value = [
+            MagicMock(instance_id='iid-2', machine_id='1')]
+        c.update_juju_m_idmap()
+        self.assertEqual(c.juju_m_idmap, {'iid-2': '1'})
+
+    def test_get_machine_spec_waits_for_idmap_update(self, mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.journal = self.journal
+        m = MagicMock(instance_id='iid-2')
+        specs = []
+        reader = threading.Thread(target=lambda: specs.append(
+            c.get_machine_spec(m, AssignmentType.BareMetal)))
+
+        def machines():
+            if reader.ident is None:
+                reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            return [MagicMock(instance_id='iid-2', machine_id='4')]
+        c.juju_state = MagicMock()
+        c.juju_state.machines.side_effect = machines
+        c.update_juju_m_idmap()
+        reader.join()
+        self.assertEqual(specs, ['4'])
+
+    @patch('cloudinstall.core.SCALE_OUT_TIMEOUT', 0)
+    @patch('cloudinstall.core.time.sleep')
+    def test_scale_out_times_out(self, mock_sleep, mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.config.is_multi = False
+        c.juju = MagicMock()
+        c.juju_state = MagicMock()
+        c.juju_state.service.return_value.units = [
+            MagicMock(unit_name='nova-compute/1', agent_state='pending')]
+        c.error_message = MagicMock()
+        c.scale_out(MagicMock(charm_name='nova-compute',
+                              display_name='Compute'), 1)
+        c.juju.add_unit.assert_called_once_with('nova-compute', num_units=1)
+        self.assertTrue(c.error_message.called)
+
+    def _prepare_controller(self):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.config.is_single = True
+        c.juju_m_idmap = {'iid-controller': '1', 'iid-compute': '2'}
+        c.placement_controller = MagicMock()
+        c.placement_controller.assignments = {
+            'iid-controller': {AssignmentType.LXC: ['keystone'],
+                               AssignmentType.KVM: []},
+            'iid-compute': {AssignmentType.LXC: [],
+                            AssignmentType.BareMetal: ['nova-compute']}}
+        c.run_apt_go_fast = MagicMock(return_value=dict(status=1,
+                                                        output='fail'))
+        c.configure_lxc_network = MagicMock(return_value=dict(status=0))
+        return c
+
+    def test_prepare_lxc_host_despite_apt_go_fast(self, mock_config):
+        c = self._prepare_controller()
+        self.assertEqual(c.prepare_machine('1'), dict(status=0))
+        c.configure_lxc_network.assert_called_once_with('1')
+
+    def test_prepare_machine_without_lxc(self, mock_config):
+        c = self._prepare_controller()
+        c.prepare_machine('2')
+        self.assertFalse(c.configure_lxc_network.called)
+
+    @patch('cloudinstall.core.aptcache')
+    def test_apt_cache_reported_since_install(self, mock_apt, mock_config):
+        with patch.dict('os.environ', {'CLOUD_INSTALL_STARTED': '200.5'}):
+            c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.info_message = MagicMock()
+        mock_apt.summary.return_value = "apt cache: 90% hit rate"
+        c.report_apt_cache(c.install_started)
+        mock_apt.summary.assert_called_once_with(since=200.5)
+        c.info_message.assert_called_once_with("apt cache: 90% hit rate")
+
+    @patch('cloudinstall.core.aptcache')
+    def test_apt_cache_not_reported_without_transfers(self, mock_apt,
+                                                      mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.info_message = MagicMock()
+        mock_apt.summary.return_value = None
+        c.report_apt_cache(c.install_started)
+        self.assertFalse(c.info_message.called)
+
+    @patch('cloudinstall.core.LocalCharmRepository')
+    def test_mirror_skips_charms_not_from_store(self, mock_repo,
+                                                mock_config):
+        c = core.Controller(ui=MagicMock(), opts=MagicMock())
+        c.info_message = MagicMock()
+        c.juju_state_server = MagicMock(return_value='10.0.0.1:17070')
+        c.journal = MagicMock()
+        c.journal.done.return_value = False
+        c.placement_controller = MagicMock()
+        c.placement_controller.placed_charm_classes.return_value = [
+            MagicMock(charm_name='keystone', from_charm_store=True),
+            MagicMock(charm_name='glance-simplestreams-sync',
+                      from_charm_store=False)]
+        c.mirror_charms()
+        mock_repo.return_value.mirror.assert_called_once_with(['keystone'])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# tests deploy.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from cloudinstall import utils
+from cloudinstall.deploy import (DeployExecutor, DeployGraph,
+                                 DeployGraphError, DeployScheduler)
+
+
+def fake_charm(name, related=(), prerequisites=(), priority=10):
+    return type('Charm' + name, (),
+                dict(charm_name=name, related=list(related),
+                     deploy_prerequisites=list(prerequisites),
+                     deploy_priority=priority,
+                     display_name=name))
+
+
+class DeployGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mysql = fake_charm('mysql', priority=0)
+        self.keystone = fake_charm('keystone', ['mysql'], ['mysql'])
+        self.glance = fake_charm('glance', ['mysql', 'keystone',
+                                            'rabbitmq-server'])
+        self.gui = fake_charm('juju-gui')
+
+    def test_order(self):
+        g = DeployGraph([self.glance, self.gui, self.keystone, self.mysql])
+        self.assertEqual(g.order, [self.mysql, self.gui, self.keystone,
+                                   self.glance])
+
+    def test_unplaced_related_ignored(self):
+        g = DeployGraph([self.glance])
+        self.assertEqual(g.dependencies(self.glance), set())
+
+    def test_cycle(self):
+        a = fake_charm('a', ['b'])
+        b = fake_charm('b', ['a'])
+        self.assertRaises(DeployGraphError, DeployGraph, [a, b])
+
+    def test_manifest_is_acyclic(self):
+        DeployGraph(utils.load_charm_manifest())
+
+    def test_can_deploy(self):
+        g = DeployGraph([self.mysql, self.keystone])
+        self.assertFalse(g.can_deploy(self.keystone, [self.mysql], set()))
+        self.assertTrue(g.can_deploy(self.keystone, [self.mysql],
+                                     set([self.mysql])))
+
+
+class DeploySchedulerTestCase(unittest.TestCase):
+
+    def test_run(self):
+        mysql = fake_charm('mysql', priority=0)
+        keystone = fake_charm('keystone', ['mysql'], ['mysql'])
+        gui = fake_charm('juju-gui')
+        g = DeployGraph([mysql, keystone, gui])
+
+        lock = threading.Lock()
+        deployed = []
+
+        def deploy(cc):
+            with lock:
+                deployed.append(cc.charm_name)
+            return False
+
+        def refresh():
+            # mysql reports started as soon as its deploy is issued
+            with lock:
+                names = set(deployed)
+            return (names, names & set(['mysql']))
+
+        s = DeployScheduler(g, deploy, refresh, poll_interval=0.01)
+        issued = s.run()
+        self.assertEqual(set(issued), set([mysql, keystone, gui]))
+        self.assertTrue(deployed.index('keystone') >
+                        deployed.index('mysql'))
+
+    def test_already_deployed(self):
+        mysql = fake_charm('mysql')
+        g = DeployGraph([mysql])
+
+        def deploy(cc):
+            raise AssertionError("should not deploy")
+
+        s = DeployScheduler(g, deploy, lambda: (set(['mysql']), set()),
+                            poll_interval=0.01)
+        self.assertEqual(s.run(), [mysql])
+
+
+class DeployExecutorTestCase(unittest.TestCase):
+
+    def test_in_flight_limit(self):
+        ex = DeployExecutor(max_workers=8, max_in_flight=2)
+        lock = threading.Lock()
+        active = [0, 0]  # current, peak
+
+        def op(n):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return n == 3
+
+        futures = [ex.submit('add_unit', 'nova-compute', str(n), op, n)
+                   for n in range(8)]
+        results = [f.result() for f in futures]
+        ex.shutdown()
+        self.assertEqual(active[1], 2)
+        self.assertEqual(results, [n == 3 for n in range(8)])
+        self.assertEqual(len(ex.ops), 8)
+        self.assertEqual([o.error for o in ex.ops].count(True), 1)
+        count, mean, worst = ex.summary()['add_unit']
+        self.assertEqual(count, 8)
+        self.assertTrue(worst >= mean > 0)
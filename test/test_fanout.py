@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# tests fanout.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+
+from cloudinstall.fanout import FanOut
+
+
+class FanOutTestCase(unittest.TestCase):
+
+    def test_run_parallel(self):
+        lock = threading.Lock()
+        active = [0, 0]  # current, peak
+
+        def op(machine_id, cmd):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return dict(status=0, output=cmd + machine_id)
+
+        results = FanOut(op, max_workers=3).run(
+            [str(n) for n in range(6)], 'ls ')
+        self.assertEqual(active[1], 3)
+        self.assertEqual(sorted(results), [str(n) for n in range(6)])
+        self.assertEqual(results['4'].output, 'ls 4')
+        self.assertTrue(all(r.attempts == 1 for r in results.values()))
+
+    def test_retry(self):
+        calls = []
+
+        def op(machine_id):
+            calls.append(machine_id)
+            if machine_id == '1' and calls.count('1') < 2:
+                raise Exception("connection refused")
+            return dict(status=0 if machine_id != '2' else 1, output='')
+
+        fo = FanOut(op, retries=2, retry_delay=0)
+        fo.submit('1')
+        fo.submit('2')
+        fo.submit('1')
+        results = fo.wait()
+        self.assertEqual(results['1'].status, 0)
+        self.assertEqual(results['1'].attempts, 2)
+        self.assertEqual(results['2'].status, 1)
+        self.assertEqual(results['2'].attempts, 3)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# tests maas/imagecache.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest
+
+from cloudinstall.maas.imagecache import (BootImageCache, ImageCacheError,
+                                          read_signed_json, selected)
+
+UPSTREAM = 'http://images.example/releases/'
+
+SELECTIONS = [{'arches': ['amd64'], 'labels': ['release'],
+               'release': 'trusty', 'subarches': ['generic']}]
+
+
+def item(path, data):
+    return {'path': path, 'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def sign(data):
+    return ("-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n" +
+            json.dumps(data) +
+            "\n-----BEGIN PGP SIGNATURE-----\nabc\n"
+            "-----END PGP SIGNATURE-----\n")
+
+
+class FakeUpstream:
+
+    def __init__(self):
+        kernel = b'kernel' * 100
+        root = b'root' * 1000
+        self.files = {
+            'trusty/amd64/20141010/boot-kernel': kernel,
+            'trusty/amd64/20141010/root-tgz': root,
+            'trusty/amd64/20140901/root-tgz': b'old',
+            'precise/amd64/20141010/root-tgz': b'precise'}
+        products = {'products': {
+            'com.ubuntu.maas:v2:boot:14.04:amd64:generic': {
+                'release': 'trusty', 'arch': 'amd64', 'subarch': 'generic',
+                'label': 'release', 'versions': {
+                    '20140901': {'items': {'root-tgz': item(
+                        'trusty/amd64/20140901/root-tgz', b'old')}},
+                    '20141010': {'items': {
+                        'boot-kernel': item(
+                            'trusty/amd64/20141010/boot-kernel', kernel),
+                        'root-tgz': item(
+                            'trusty/amd64/20141010/root-tgz', root)}}}},
+            'com.ubuntu.maas:v2:boot:12.04:amd64:generic': {
+                'release': 'precise', 'arch': 'amd64',
+                'subarch': 'generic', 'label': 'release', 'versions': {
+                    '20141010': {'items': {'root-tgz': item(
+                        'precise/amd64/20141010/root-tgz', b'precise')}}}}}}
+        self.files['streams/v1/download.sjson'] = sign(products).encode()
+        self.files['streams/v1/index.sjson'] = sign({'index': {
+            'com.ubuntu.maas:v2:download': {
+                'datatype': 'image-downloads',
+                'path': 'streams/v1/download.sjson'}}}).encode()
+        self.fetched = []
+        self.offline = False
+
+    def fetch(self, url):
+        if self.offline:
+            raise OSError("network unreachable")
+        path = url[len(UPSTREAM):]
+        self.fetched.append(path)
+        yield self.files[path]
+
+
+class BootImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory(suffix="imagecache")
+        self.addCleanup(self.tempdir.cleanup)
+        self.upstream = FakeUpstream()
+        self.cache = BootImageCache(self.tempdir.name, UPSTREAM,
+                                    self.upstream.fetch)
+
+    def test_read_signed_json(self):
+        self.assertEqual(read_signed_json(sign({'a': 1})), {'a': 1})
+        self.assertEqual(read_signed_json('{"a": 1}'), {'a': 1})
+
+    def test_selected(self):
+        self.assertTrue(selected({'release': 'trusty', 'arch': 'amd64',
+                                  'subarch': 'generic', 'label': 'release'},
+                                 SELECTIONS))
+        self.assertFalse(selected({'release': 'trusty', 'arch': 'i386'},
+                                  SELECTIONS))
+
+    def test_sync_latest_selected_version(self):
+        progress = []
+        self.assertEqual(self.cache.sync(SELECTIONS,
+                                         lambda d, t: progress.append(d)),
+                         (0, 2))
+        mirrored = os.path.join(self.tempdir.name, 'mirror',
+                                'trusty/amd64/20141010/root-tgz')
+        with open(mirrored, 'rb') as f:
+            self.assertEqual(f.read(), b'root' * 1000)
+        self.assertEqual(progress[-1], 600 + 4000)
+        self.assertNotIn('trusty/amd64/20140901/root-tgz',
+                         self.upstream.fetched)
+        self.assertNotIn('precise/amd64/20141010/root-tgz',
+                         self.upstream.fetched)
+        # the signed metadata is mirrored unchanged
+        with open(os.path.join(self.tempdir.name, 'mirror',
+                               'streams/v1/index.sjson'), 'rb') as f:
+            self.assertEqual(f.read(),
+                             self.upstream.files['streams/v1/index.sjson'])
+
+    def test_second_sync_is_cached(self):
+        self.cache.sync(SELECTIONS)
+        self.upstream.fetched = []
+        self.assertEqual(self.cache.sync(SELECTIONS), (2, 0))
+        self.assertEqual(self.upstream.fetched,
+                         ['streams/v1/index.sjson',
+                          'streams/v1/download.sjson'])
+
+    def test_offline_uses_cached_metadata(self):
+        self.cache.sync(SELECTIONS)
+        self.upstream.offline = True
+        self.assertEqual(self.cache.sync(SELECTIONS), (2, 0))
+
+    def test_offline_without_cache(self):
+        self.upstream.offline = True
+        self.assertRaises(ImageCacheError, self.cache.sync, SELECTIONS)
+
+    def test_checksum_mismatch(self):
+        self.upstream.files['trusty/amd64/20141010/root-tgz'] = b'corrupt'
+        self.assertRaises(ImageCacheError, self.cache.sync, SELECTIONS)
+        objects = [f for _, _, files in os.walk(self.cache.objects)
+                   for f in files]
+        self.assertEqual(objects,
+                         [hashlib.sha256(b'kernel' * 100).hexdigest()])
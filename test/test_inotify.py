@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# tests inotify.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+
+from cloudinstall import inotify
+
+
+@unittest.skipUnless(inotify.available(), "inotify is not available")
+class WaitForPathTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory(suffix="inotify")
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, 'run', 'cloud-init',
+                                 'result.json')
+
+    def test_existing(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, 'w').close()
+        self.assertTrue(inotify.wait_for_path(self.path, timeout=0))
+
+    def test_created_with_missing_directories(self):
+        def create():
+            time.sleep(0.1)
+            os.makedirs(os.path.dirname(self.path))
+            time.sleep(0.1)
+            with open(self.path, 'w') as f:
+                f.write('{}')
+        t = threading.Thread(target=create)
+        t.start()
+        start = time.time()
+        self.assertTrue(inotify.wait_for_path(self.path, timeout=10))
+        self.assertTrue(time.time() - start < 5)
+        t.join()
+
+    def test_keep_waiting_false_stops_wait(self):
+        checks = []
+
+        def keep_waiting():
+            checks.append(time.time())
+            return len(checks) < 3
+        start = time.time()
+        self.assertFalse(inotify.wait_for_path(self.path, timeout=10,
+                                               wake_interval=0.05,
+                                               keep_waiting=keep_waiting))
+        self.assertEqual(len(checks), 3)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertFalse(inotify.wait_for_path(self.path, timeout=0.2))
+        self.assertTrue(time.time() - start >= 0.2)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# tests installbase.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloudinstall.installbase import InstallBase
+
+
+class InstallBaseTaskGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = patch('cloudinstall.installbase.TimingStore').start()
+        self.addCleanup(patch.stopall)
+        self.installer = InstallBase(MagicMock())
+        self.installer.config = MagicMock(cfg_path='/tmp')
+        self.installer.register_tasks(['install', 'scan', 'configure',
+                                       'images', 'finish'])
+
+    def test_run_task_graph(self):
+        running = set()
+        overlapped = []
+        lock = threading.Lock()
+
+        def task(name, duration):
+            def fn():
+                with lock:
+                    if running:
+                        overlapped.append((name, set(running)))
+                    running.add(name)
+                time.sleep(duration)
+                with lock:
+                    running.discard(name)
+            return fn
+
+        self.installer.run_task_graph([
+            ('install', [], task('install', 0.1)),
+            ('scan', [], task('scan', 0.05)),
+            ('configure', ['install'], task('configure', 0.05)),
+            ('images', ['configure'], task('images', 0.1)),
+            ('finish', ['images', 'scan'], task('finish', 0.01))])
+
+        times = {n: (s, e) for n, s, e in self.installer.tasks}
+        self.assertTrue(all(e is not None for s, e in times.values()))
+        self.assertTrue(times['configure'][0] >= times['install'][1])
+        self.assertTrue(times['finish'][0] >= times['images'][1])
+        self.assertIn(('scan', set(['install'])), overlapped)
+        self.assertEqual([n for n, d in self.installer.critical_path()],
+                         ['install', 'configure', 'images', 'finish'])
+        recorded = [c[0][1] for c in
+                    self.timings.return_value.record.call_args_list]
+        self.assertEqual(sorted(recorded), sorted(times.keys()))
+
+    def test_failure(self):
+        ran = []
+
+        def fail():
+            raise Exception("apt failed")
+
+        self.assertRaises(Exception, self.installer.run_task_graph, [
+            ('install', [], fail),
+            ('configure', ['install'], lambda: ran.append('configure'))])
+        self.assertEqual(ran, [])
+
+    def test_unlisted_dependency(self):
+        self.assertRaises(ValueError, self.installer.run_task_graph,
+                          [('configure', ['install'], lambda: None)])
+
+    def test_graph_checked_before_any_task_starts(self):
+        ran = []
+        self.assertRaises(ValueError, self.installer.run_task_graph, [
+            ('install', [], lambda: ran.append('install')),
+            ('images', ['configure'], lambda: None),
+            ('configure', ['install'], lambda: None)])
+        self.assertEqual(ran, [])
+
+    def test_start_task_by_name(self):
+        self.installer.update_progress = MagicMock()
+        self.installer.start_task('scan')
+        self.installer.start_task('install')
+        self.installer.stop_current_task()
+        s, e = self.installer.task_times('scan')
+        self.assertTrue(e >= s)
+        self.assertIsNone(self.installer.current_task)
+        self.assertEqual(self.installer.task_times('configure'),
+                         (None, None))
+
+    def test_registered_dependencies(self):
+        order = []
+        self.installer.register_tasks([('install', []),
+                                       ('configure', ['install'])])
+        self.installer.run_task_graph([
+            ('install', lambda: order.append('install')),
+            ('configure', lambda: order.append('configure'))])
+        self.assertEqual(order, ['install', 'configure'])
+
+
+class InstallBaseProgressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patch('cloudinstall.installbase.TimingStore').start()
+        self.addCleanup(patch.stopall)
+        self.display = MagicMock()
+        self.installer = InstallBase(self.display)
+        self.installer.register_tasks([('install', []),
+                                       ('images', ['install']),
+                                       'finish'])
+
+    def rendered(self):
+        return self.display.render_node_install_wait.call_args[0][0]
+
+    def test_running_tasks_and_progress(self):
+        now = time.time()
+        self.installer.tasks = [('install', now - 10, now - 5),
+                                ('images', now - 5, None),
+                                ('finish', None, None)]
+        self.installer.set_task_progress('images', '120/400 MB')
+        self.installer.update_progress()
+        m = self.rendered()
+        self.assertIn('5.00 sec', m[0][1])
+        self.assertIn('elapsed', m[1])
+        self.assertTrue(m[1].rstrip().endswith('120/400 MB'))
+        self.assertIn('-', m[2][1])
+
+    def test_waiting_for_dependencies(self):
+        self.installer.update_progress()
+        m = self.rendered()
+        self.assertIn('waiting for install', m[1][1])
+        self.assertNotIn('waiting', m[2][1])
+
+    def test_idle_progress_not_rerendered(self):
+        self.installer.update_progress()
+        first = self.rendered()
+        self.installer.update_progress()
+        self.assertEqual(self.display.render_node_install_wait.call_count, 1)
+        now = time.time()
+        self.installer.tasks[0] = ('install', now - 1, now)
+        self.installer.update_progress()
+        self.assertEqual(self.display.render_node_install_wait.call_count, 2)
+        # unchanged entries are reused rather than formatted again
+        self.assertIs(self.rendered()[2], first[2])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# tests journal.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudinstall.journal import (DeployJournal, DEPLOY_ISSUED,
+                                  MACHINE_ADDED, environment_id)
+
+
+class DeployJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        j = DeployJournal(self.filename)
+        self.assertFalse(j.done(DEPLOY_ISSUED, 'mysql'))
+        j.record(DEPLOY_ISSUED, 'mysql')
+        j.record(MACHINE_ADDED, 'abc', machine_id='1')
+        self.assertTrue(j.done(DEPLOY_ISSUED, 'mysql'))
+
+        j = DeployJournal(self.filename)
+        self.assertTrue(j.done(DEPLOY_ISSUED, 'mysql'))
+        self.assertFalse(j.done(DEPLOY_ISSUED, 'keystone'))
+        self.assertEqual(j.data(MACHINE_ADDED, 'abc'), {'machine_id': '1'})
+        self.assertEqual(j.keys(MACHINE_ADDED), ['abc'])
+
+    def test_partial_entry_ignored(self):
+        j = DeployJournal(self.filename)
+        j.record(DEPLOY_ISSUED, 'mysql')
+        with open(self.filename, 'a') as f:
+            f.write('{"step": "deploy-iss')
+
+        j = DeployJournal(self.filename)
+        self.assertEqual(j.keys(DEPLOY_ISSUED), ['mysql'])
+        j.record(DEPLOY_ISSUED, 'keystone')
+
+        j = DeployJournal(self.filename)
+        self.assertEqual(sorted(j.keys(DEPLOY_ISSUED)),
+                         ['keystone', 'mysql'])
+
+    def test_corrupt_entry_skipped(self):
+        j = DeployJournal(self.filename)
+        j.record(DEPLOY_ISSUED, 'mysql')
+        with open(self.filename, 'a') as f:
+            f.write('{"step": "deploy-iss\n')
+            f.write('["not", "an", "entry"]\n')
+        j.record(DEPLOY_ISSUED, 'keystone')
+
+        j = DeployJournal(self.filename)
+        self.assertEqual(sorted(j.keys(DEPLOY_ISSUED)),
+                         ['keystone', 'mysql'])
+
+    def test_same_environment_replayed(self):
+        j = DeployJournal(self.filename, environment='env-1')
+        j.record(DEPLOY_ISSUED, 'mysql')
+
+        j = DeployJournal(self.filename, environment='env-1')
+        self.assertTrue(j.done(DEPLOY_ISSUED, 'mysql'))
+
+    def test_other_environment_discarded(self):
+        j = DeployJournal(self.filename, environment='env-1')
+        j.record(DEPLOY_ISSUED, 'mysql')
+
+        j = DeployJournal(self.filename, environment='env-2')
+        self.assertFalse(j.done(DEPLOY_ISSUED, 'mysql'))
+        self.assertTrue(os.path.exists(self.filename + '.stale'))
+
+        j = DeployJournal(self.filename, environment='env-2')
+        self.assertFalse(j.done(DEPLOY_ISSUED, 'mysql'))
+
+    def test_journal_without_environment_discarded(self):
+        j = DeployJournal(self.filename)
+        j.record(DEPLOY_ISSUED, 'mysql')
+
+        j = DeployJournal(self.filename, environment='env-1')
+        self.assertFalse(j.done(DEPLOY_ISSUED, 'mysql'))
+
+    def test_environment_id(self):
+        self.assertEqual(environment_id({'environ-uuid': 'abc',
+                                         'ca-cert': 'cert'}), 'abc')
+        self.assertNotEqual(environment_id({'ca-cert': 'cert 1'}),
+                            environment_id({'ca-cert': 'cert 2'}))
@@ -18,9 +18,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest.mock import MagicMock, patch
 import sys
 import os
 import ipaddress
+import threading
+import time
 sys.path.insert(0, '../cloudinstall')
 from cloudinstall.utils import _run
 from cloudinstall.juju import JujuState
@@ -29,6 +32,20 @@ JUJU_USELIVE = os.environ.get('JUJU_USELIVE', 0)
 JUJU_INSTALLED = os.path.exists("/usr/bin/juju")
 
 
+@patch('cloudinstall.juju.Config')
+class JujuStateStatusCacheTest(unittest.TestCase):
+    def test_concurrent_status_fetched_once(self, mock_config):
+        juju = MagicMock()
+        juju.status.side_effect = lambda: time.sleep(0.1) or {'Machines': {}}
+        state = JujuState(juju)
+        threads = [threading.Thread(target=state.status) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(juju.status.call_count, 1)
+
+
 @unittest.skip
 class JujuStateMultiTest(unittest.TestCase):
     def setUp(self):
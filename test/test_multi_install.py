@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# tests multi_install.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloudinstall.multi_install import MultiInstallNewMaas
+
+
+class MultiInstallNewMaasTaskGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tempdir = TemporaryDirectory(suffix="multi-install")
+        self.addCleanup(tempdir.cleanup)
+        mock_config = patch('cloudinstall.multi_install.Config').start()
+        mock_config.return_value.cfg_path = tempdir.name
+        mock_config.return_value.is_landscape = False
+        patch('cloudinstall.installbase.TimingStore').start()
+        self.addCleanup(patch.stopall)
+        self.installer = MultiInstallNewMaas(MagicMock(), MagicMock())
+        self.installer.prompt_for_interface = MagicMock()
+        self.installer.update_progress = MagicMock()
+        self.installer.do_install = MagicMock()
+        self.order = []
+        self.lock = threading.Lock()
+
+    def record(self, name):
+        def fn():
+            with self.lock:
+                self.order.append(name)
+        return fn
+
+    def test_new_maas_graph(self):
+        installer = self.installer
+        for m in ['install_maas', 'search_for_dhcp', 'configure_maas',
+                  'register_cluster', 'configure_networks',
+                  'import_boot_images']:
+            setattr(installer, m, self.record(m))
+
+        @asyncio.coroutine
+        def create_bootstrap_kvm():
+            yield from asyncio.sleep(0)
+            self.record('create_bootstrap_kvm')()
+
+        installer.create_bootstrap_kvm = create_bootstrap_kvm
+        installer.run()
+        MultiInstallNewMaas.continue_with_interface.__wrapped__(installer)
+
+        self.assertEqual(len(self.order), 7)
+        for before, after in [('install_maas', 'configure_maas'),
+                              ('configure_maas', 'register_cluster'),
+                              ('register_cluster', 'configure_networks'),
+                              ('search_for_dhcp', 'configure_networks'),
+                              ('configure_networks', 'import_boot_images'),
+                              ('import_boot_images',
+                               'create_bootstrap_kvm')]:
+            self.assertLess(self.order.index(before),
+                            self.order.index(after))
+        installer.do_install.assert_called_once_with()
@@ -28,6 +28,7 @@ from cloudinstall.charms.jujugui import CharmJujuGui
 from cloudinstall.charms.keystone import CharmKeystone
 from cloudinstall.charms.compute import CharmNovaCompute
 
+from cloudinstall.maas import MaasMachineStatus
 from cloudinstall.placement.controller import (AssignmentType,
                                                PlacementController)
 
@@ -148,6 +149,27 @@ class PlacementControllerTestCase(unittest.TestCase):
             self.assertEqual(m2_as[AssignmentType.LXC], [CharmKeystone])
             self.assertEqual(m2_as[AssignmentType.KVM], [])
 
+    def test_select_machines(self):
+        satisfies_importstring = 'cloudinstall.placement.controller.satisfies'
+        self.mock_machine.status = MaasMachineStatus.READY
+        self.mock_machine_2.status = MaasMachineStatus.READY
+        self.pc.assign(self.mock_machine, CharmKeystone, AssignmentType.LXC)
+        with patch(satisfies_importstring) as mock_satisfies:
+            mock_satisfies.return_value = (True, )
+            selected = self.pc.select_machines(CharmNovaCompute, 5)
+        self.assertEqual(selected, [self.mock_machine_2])
+        self.assertEqual(self.pc.machines_for_charm(CharmNovaCompute),
+                         {AssignmentType.BareMetal: [self.mock_machine_2]})
+
+    def test_select_machines_only_ready(self):
+        satisfies_importstring = 'cloudinstall.placement.controller.satisfies'
+        self.mock_machine.status = MaasMachineStatus.COMMISSIONING
+        self.mock_machine_2.status = MaasMachineStatus.READY
+        with patch(satisfies_importstring) as mock_satisfies:
+            mock_satisfies.return_value = (True, )
+            selected = self.pc.select_machines(CharmNovaCompute, 2)
+        self.assertEqual(selected, [self.mock_machine_2])
+
     def test_remove_one_assignment_sametype(self):
         self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
         self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
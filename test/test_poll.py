@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# tests poll.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import unittest
+
+from cloudinstall.poll import Poll, PollScheduler
+
+
+class PollTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PollScheduler(max_workers=4)
+
+    def test_succeeds(self):
+        calls = []
+
+        def fn():
+            calls.append(time.time())
+            return len(calls)
+
+        p = self.scheduler.submit(Poll(fn, lambda n: n == 3, 0.05))
+        self.assertTrue(p.wait())
+        self.assertEqual(p.attempts, 3)
+        # slept between attempts instead of spinning
+        self.assertTrue(calls[2] - calls[0] >= 0.08)
+
+    def test_timeout(self):
+        p = self.scheduler.submit(Poll(lambda: 0, bool, 0.02, timeout=0.1))
+        self.assertFalse(p.wait())
+        self.assertTrue(1 < p.attempts < 10)
+
+    def test_exception(self):
+        def fn():
+            raise ValueError("no json")
+
+        p = self.scheduler.submit(Poll(fn, bool, 0.01))
+        self.assertRaises(ValueError, p.wait)
+
+        p = self.scheduler.submit(Poll(fn, bool, 0.01, timeout=0.05,
+                                       ignore_exceptions=True))
+        self.assertFalse(p.wait())
+        self.assertTrue(p.attempts > 1)
+
+    def test_backoff(self):
+        p = Poll(lambda: 0, bool, 1, backoff=2, max_interval=5, jitter=0)
+        delays = []
+        for n in range(5):
+            p.attempts = n + 1
+            delays.append(p.next_delay())
+        self.assertEqual([round(d) for d in delays], [1, 2, 4, 5, 5])
+
+    def test_concurrent(self):
+        start = time.time()
+        polls = [self.scheduler.submit(Poll(time.time,
+                                            lambda t: t - start > 0.2,
+                                            0.05))
+                 for _ in range(10)]
+        self.assertTrue(all(p.wait() for p in polls))
+        self.assertTrue(time.time() - start < 1)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# tests process.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import unittest
+
+from cloudinstall import process
+from cloudinstall.utils import command_argv, get_command_output
+
+
+class ProcessTestCase(unittest.TestCase):
+
+    def test_run(self):
+        seen = []
+        ret = process.run(['seq', '5'], on_line=seen.append, tail_lines=2)
+        self.assertEqual(ret.status, 0)
+        self.assertEqual(seen, ['1\n', '2\n', '3\n', '4\n', '5\n'])
+        self.assertEqual(ret.output, '4\n5\n')
+        self.assertEqual(ret.lines, 5)
+        self.assertFalse(ret.timed_out)
+
+    def test_exit_status(self):
+        ret = process.run(['sh', '-c', 'echo oops >&2; exit 3'])
+        self.assertEqual(ret.status, 3)
+        self.assertEqual(ret.output, 'oops\n')
+
+    def test_not_found(self):
+        ret = process.run(['/nonexistent/command'])
+        self.assertEqual(ret.status, process.NOT_FOUND_STATUS)
+
+    def test_timeout(self):
+        start = time.time()
+        ret = process.run(['sh', '-c', 'sleep 30 & wait'], timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(ret.timed_out)
+        self.assertEqual(ret.status, process.TIMEOUT_STATUS)
+
+
+class CommandArgvTestCase(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(command_argv("juju set glance 'a=b c'"),
+                         ['juju', 'set', 'glance', 'a=b c'])
+
+    def test_shell(self):
+        for cmd in ['route -n | grep UG', 'ls *.yaml', 'A=1 env',
+                    'echo $HOME', 'true && false']:
+            self.assertEqual(command_argv(cmd), ['sh', '-c', cmd])
+
+
+class GetCommandOutputTestCase(unittest.TestCase):
+
+    def test_output_capped(self):
+        n = process.DEFAULT_TAIL_LINES + 5
+        out = get_command_output('seq {}'.format(n))
+        self.assertEqual(out['status'], 0)
+        lines = out['output'].splitlines()
+        self.assertEqual(len(lines), process.DEFAULT_TAIL_LINES)
+        self.assertEqual(lines[-1], str(n))
+
+    def test_full_output(self):
+        n = process.DEFAULT_TAIL_LINES + 5
+        out = get_command_output('seq {}'.format(n), full_output=True)
+        self.assertEqual(len(out['output'].splitlines()), n)
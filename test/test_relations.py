@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# tests relations.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.charms.compute import CharmNovaCompute
+from cloudinstall.charms.keystone import CharmKeystone
+from cloudinstall.relations import RelationPlanner
+from cloudinstall.service import Service
+
+
+def service(name, state='started', relations=None):
+    return Service(name, {'Units': {name + '/0': {'AgentState': state}},
+                          'Relations': relations or {}})
+
+
+class RelationPlannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.juju = MagicMock()
+        self.juju_state = MagicMock()
+        self.compute = CharmNovaCompute(juju=self.juju,
+                                        juju_state=self.juju_state)
+        self.keystone = CharmKeystone(juju=self.juju,
+                                      juju_state=self.juju_state)
+        self.planner = RelationPlanner(self.juju, self.juju_state,
+                                       [self.compute, self.keystone])
+
+    def test_desired_includes_interfaces(self):
+        desired = self.planner.desired()
+        self.assertEqual(desired[frozenset(['nova-compute', 'mysql'])],
+                         ('nova-compute:shared-db', 'mysql:shared-db'))
+        self.assertEqual(desired[frozenset(['nova-compute',
+                                            'rabbitmq-server'])],
+                         ('nova-compute:amqp', 'rabbitmq-server:amqp'))
+        self.assertIn(frozenset(['keystone', 'mysql']), desired)
+        self.assertEqual(len(desired), 5)
+
+    def test_plan(self):
+        services = [service('nova-compute',
+                            relations={'shared-db': ['mysql']}),
+                    service('mysql', relations={'shared-db':
+                                                ['nova-compute']}),
+                    service('keystone', state='pending'),
+                    service('glance'),
+                    service('nova-cloud-controller'),
+                    service('rabbitmq-server')]
+        ready, waiting = self.planner.plan(services)
+        self.assertEqual(ready, [('nova-compute', 'glance'),
+                                 ('nova-compute', 'nova-cloud-controller'),
+                                 ('nova-compute:amqp',
+                                  'rabbitmq-server:amqp')])
+        self.assertEqual(waiting, [('keystone', 'mysql')])
+
+    def test_set_relations_batches(self):
+        self.juju_state.services = [service('keystone'), service('mysql')]
+        self.planner.charms = [self.keystone]
+        self.assertFalse(self.planner.set_relations())
+        self.juju.add_relation.assert_called_once_with('keystone', 'mysql')
+        self.juju_state.invalidate_status_cache.assert_called_once_with()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# tests single_install.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+from tempfile import TemporaryDirectory
+import time
+import unittest
+from unittest.mock import MagicMock, patch, call
+
+from cloudinstall.single_install import (SingleInstall, BASE_CONTAINER,
+                                         SingleInstallException)
+
+
+class SingleInstallBaseContainerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tempdir = TemporaryDirectory(suffix="single-install")
+        self.addCleanup(tempdir.cleanup)
+        mock_config = patch('cloudinstall.single_install.Config').start()
+        mock_config.return_value.cfg_path = tempdir.name
+        patch('cloudinstall.installbase.TimingStore').start()
+        self.utils = patch('cloudinstall.single_install.utils').start()
+        self.addCleanup(patch.stopall)
+        self.utils.load_template.return_value.render.return_value = 'ud'
+        self.utils.container_snapshot_backingstore.return_value = \
+            'overlayfs'
+        self.installer = SingleInstall(MagicMock(), MagicMock())
+        self.installer.update_progress = MagicMock()
+        self.installer.register_tasks(["Creating container"])
+        self.installer.wait_for_cloud_init = MagicMock()
+
+    def test_node_count_from_topology(self):
+        self.installer.opts.enable_swift = False
+        # the controller and the nova-compute and quantum-gateway KVMs
+        self.assertEqual(self.installer.placed_node_count(), 3)
+
+    def base_info(self, **info):
+        self.utils.slurp.return_value = json.dumps(info)
+
+    def test_current_base_is_cloned(self):
+        self.base_info(key=self.installer.base_container_key(),
+                       created=time.time() - 60)
+        self.installer.create_container_and_wait()
+        self.assertFalse(self.utils.container_create.called)
+        self.utils.container_clone.assert_called_once_with(
+            BASE_CONTAINER, 'uoi-bootstrap', self.installer.clone_userdata,
+            'overlayfs')
+        self.installer.wait_for_cloud_init.assert_called_once_with(
+            'uoi-bootstrap')
+
+    def test_missing_base_is_built(self):
+        self.utils.slurp.side_effect = IOError
+        self.installer.create_container_and_wait()
+        self.utils.container_create.assert_called_once_with(
+            BASE_CONTAINER, self.installer.userdata, None)
+        self.assertEqual(self.installer.wait_for_cloud_init.call_args_list,
+                         [call(BASE_CONTAINER), call('uoi-bootstrap')])
+        self.utils.container_stop.assert_called_once_with(BASE_CONTAINER)
+        self.assertTrue(self.utils.container_clone.called)
+
+    def test_stale_base(self):
+        key = self.installer.base_container_key()
+        self.base_info(key=key, created=0)
+        self.assertFalse(self.installer.base_container_current())
+        self.base_info(key='other', created=time.time())
+        self.assertFalse(self.installer.base_container_current())
+        self.base_info(key=key, created=time.time())
+        self.assertTrue(self.installer.base_container_current())
+
+    def test_base_key_covers_apt_proxy(self):
+        self.installer.apt_proxy = 'http://10.0.3.1:3142'
+        self.installer.base_container_key()
+        render = self.utils.load_template.return_value.render
+        self.assertEqual(render.call_args[1]['apt_proxy'],
+                         'http://10.0.3.1:3142')
+
+
+class SingleInstallCloudInitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tempdir = TemporaryDirectory(suffix="single-install")
+        self.addCleanup(tempdir.cleanup)
+        mock_config = patch('cloudinstall.single_install.Config').start()
+        mock_config.return_value.cfg_path = tempdir.name
+        patch('cloudinstall.installbase.TimingStore').start()
+        self.utils = patch('cloudinstall.single_install.utils').start()
+        self.inotify = patch('cloudinstall.single_install.inotify').start()
+        self.addCleanup(patch.stopall)
+        self.installer = SingleInstall(MagicMock(), MagicMock())
+        self.result = json.dumps({'v1': {'errors': []}})
+
+    def test_watched_from_host(self):
+        self.utils.container_init_pid.return_value = 42
+        self.inotify.wait_for_path.return_value = True
+        self.utils.slurp.return_value = self.result
+        self.installer.wait_for_cloud_init('uoi-bootstrap')
+        self.assertEqual(self.inotify.wait_for_path.call_args[0][0],
+                         '/proc/42/root/run/cloud-init/result.json')
+        self.assertFalse(self.utils.container_wait_for_file.called)
+
+    @patch('cloudinstall.single_install.os.path.isdir')
+    def test_stopped_container_fails_fast(self, mock_isdir):
+        self.utils.container_init_pid.return_value = 42
+        mock_isdir.return_value = False
+
+        def wait_for_path(path, timeout, wake_interval, keep_waiting):
+            return keep_waiting()
+        self.inotify.wait_for_path.side_effect = wait_for_path
+        with self.assertRaisesRegex(SingleInstallException, 'stopped'):
+            self.installer.wait_for_cloud_init('uoi-bootstrap')
+        mock_isdir.assert_called_with('/proc/42')
+        self.assertFalse(self.utils.container_wait_for_file.called)
+
+    def test_remote_wait_without_host_access(self):
+        self.utils.container_init_pid.return_value = 42
+        self.inotify.wait_for_path.side_effect = OSError
+        self.utils.container_wait_for_file.return_value = self.result
+        self.installer.wait_for_cloud_init('uoi-bootstrap')
+        self.utils.container_wait_for_file.assert_called_once_with(
+            'uoi-bootstrap', '/run/cloud-init/result.json', 3600)
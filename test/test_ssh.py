@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# tests ssh.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloudinstall.ssh import (SSHConnectionPool, SSH_CONNECTION_ERROR,
+                              BUNDLE_UNPACK_ERROR, bundle_command,
+                              make_bundle)
+
+
+def fake_popen(returncodes, errors=None):
+    """ Popen stand-in exiting with each of returncodes in turn, writing
+    the matching entry of errors to stderr
+    """
+    calls = []
+
+    def popen(argv, **kwargs):
+        calls.append(argv)
+        i = min(len(calls), len(returncodes)) - 1
+        if errors:
+            kwargs['stderr'].write(errors[i].encode())
+        p = MagicMock()
+        p.returncode = returncodes[i]
+        p.communicate.return_value = (b'out', None)
+        return p
+    return popen, calls
+
+
+class SSHConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.pool = SSHConnectionPool(identity='/id_rsa',
+                                      control_dir=self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_run_multiplexed(self):
+        popen, calls = fake_popen([0])
+        with patch('cloudinstall.ssh.Popen', popen):
+            ret = self.pool.run('10.0.0.2', 'uptime')
+        self.assertEqual(ret['status'], 0)
+        self.assertEqual(ret['output'], 'out')
+        argv = calls[0]
+        self.assertEqual(argv[0], 'ssh')
+        self.assertIn('ControlMaster=auto', argv)
+        self.assertEqual(argv[-3:], ['ubuntu', '10.0.0.2', 'uptime'])
+        self.assertEqual(argv[argv.index('-i') + 1], '/id_rsa')
+        self.assertEqual(self.pool.stats()['10.0.0.2'][0], 1)
+
+    def test_reconnect(self):
+        # connection failure, 'ssh -O exit', then the retried command
+        popen, calls = fake_popen(
+            [SSH_CONNECTION_ERROR, 0, 0],
+            ["ssh: connect to host 10.0.0.2 port 22: Connection refused\n",
+             "", ""])
+        with patch('cloudinstall.ssh.Popen', popen):
+            ret = self.pool.run('10.0.0.2', 'uptime')
+        self.assertEqual(ret['status'], 0)
+        self.assertEqual(len(calls), 3)
+        self.assertIn('exit', calls[1])
+        self.assertEqual(calls[0], calls[2])
+
+    def test_started_command_not_retried(self):
+        # the connection dropped, or the command itself exited 255
+        popen, calls = fake_popen(
+            [SSH_CONNECTION_ERROR],
+            ["Connection to 10.0.0.2 closed by remote host.\n"])
+        with patch('cloudinstall.ssh.Popen', popen):
+            ret = self.pool.run('10.0.0.2', 'reboot')
+        self.assertEqual(ret['status'], SSH_CONNECTION_ERROR)
+        self.assertEqual(len(calls), 1)
+        self.assertIn('closed by remote host', ret['output'])
+
+    def test_control_dir_private(self):
+        control_dir = os.path.join(self.tempdir.name, 'ssh')
+        pool = SSHConnectionPool(control_dir=control_dir)
+        popen, calls = fake_popen([0])
+        with patch('cloudinstall.ssh.Popen', popen):
+            pool.run('10.0.0.2', 'uptime')
+        self.assertEqual(os.stat(control_dir).st_mode & 0o777, 0o700)
+        self.assertIn('ControlMaster=auto', calls[0])
+
+    def test_shared_control_dir_not_used(self):
+        os.chmod(self.tempdir.name, 0o777)
+        popen, calls = fake_popen([0])
+        with patch('cloudinstall.ssh.Popen', popen):
+            self.pool.run('10.0.0.2', 'uptime')
+        self.assertIn('ControlMaster=no', calls[0])
+        self.assertIn('ControlPath=none', calls[0])
+
+    @patch('cloudinstall.ssh.pwd.getpwnam')
+    def test_run_as(self, mock_getpwnam):
+        mock_getpwnam.return_value.pw_uid = os.getuid()
+        pool = SSHConnectionPool(run_as='ubuntu',
+                                 control_dir=self.tempdir.name)
+        popen, calls = fake_popen([0])
+        with patch('cloudinstall.ssh.Popen', popen):
+            pool.cp('10.0.0.2', '/nonexistent', '/tmp')
+        self.assertEqual(calls[0][:5],
+                         ['sudo', '-H', '-u', 'ubuntu', 'scp'])
+        self.assertEqual(calls[0][-2:], ['/nonexistent',
+                                         'ubuntu@10.0.0.2:/tmp'])
+
+    def test_run_bundle(self):
+        popen, calls = fake_popen([BUNDLE_UNPACK_ERROR])
+        src = os.path.join(self.tempdir.name, 'script.sh')
+        with open(src, 'w') as f:
+            f.write('true')
+        with patch('cloudinstall.ssh.Popen', popen):
+            ret = self.pool.run_bundle('10.0.0.2', {'/tmp/s.sh': src},
+                                       'sh /tmp/s.sh')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][-1], bundle_command('sh /tmp/s.sh'))
+        self.assertEqual(ret['error'], 'unpack')
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def test_make_bundle(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'data')
+            f.flush()
+            data = make_bundle({'/tmp/a': f.name})
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.assertEqual(tar.getnames(), ['tmp/a'])
+            self.assertEqual(tar.extractfile('tmp/a').read(), b'data')
+
+    def test_make_bundle_relative(self):
+        self.assertRaises(ValueError, make_bundle, {'a': '/etc/hostname'})
+
+    def test_bundle_command(self):
+        self.assertEqual(bundle_command('ls', '/tmp/b.tar'),
+                         "tar -x -C / -f /tmp/b.tar && rm -f /tmp/b.tar "
+                         "|| exit 254; ls")
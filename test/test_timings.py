@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# tests timings.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest
+
+from cloudinstall.timings import TimingStore, format_report, host_facts
+
+
+class TimingStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory(suffix="timings")
+        self.addCleanup(self.tempdir.cleanup)
+        self.filename = os.path.join(self.tempdir.name, 'lib',
+                                     'timings.jsonl')
+        self.store = TimingStore(self.filename)
+        self.facts = host_facts('single')
+
+    def add_run(self, run_id, durations, facts=None):
+        for task, d in durations:
+            self.store.record(run_id, task, 100.0, 100.0 + d,
+                              facts or self.facts)
+
+    def test_runs_are_appended(self):
+        self.add_run('1', [('Creating container', 60)])
+        self.add_run('2', [('Creating container', 62),
+                           ('Starting Juju server', 30)])
+        runs = self.store.runs()
+        self.assertEqual(list(runs.keys()), ['1', '2'])
+        self.assertEqual(list(runs['2']['tasks'].items()),
+                         [('Creating container', 62),
+                          ('Starting Juju server', 30)])
+        self.assertEqual(runs['1']['facts']['install_type'], 'single')
+
+    def test_latest_facts_reported(self):
+        self.store.record('1', 'Creating container', 100.0, 160.0,
+                          host_facts('multi'))
+        self.store.record('1', 'Starting Juju server', 160.0, 190.0,
+                          host_facts('multi', node_count=5))
+        self.assertEqual(self.store.runs()['1']['facts']['node_count'], 5)
+
+    def test_partial_line_skipped(self):
+        self.add_run('1', [('Creating container', 60)])
+        with open(self.filename, 'a') as f:
+            f.write('{"run": "2", "ta')
+        self.assertEqual(list(self.store.runs().keys()), ['1'])
+
+    def test_regression_against_median(self):
+        for i, d in enumerate([60, 300, 64, 58]):
+            self.add_run(str(i), [('Creating container', d),
+                                  ('Starting Juju server', 30)])
+        # other install types are not compared with
+        self.add_run('multi', [('Creating container', 1)],
+                     host_facts('multi'))
+        self.add_run('latest', [('Creating container', 90),
+                                ('Starting Juju server', 31),
+                                ('Copying data', 5)])
+        run_id, facts, rows = self.store.compare()
+        self.assertEqual(run_id, 'latest')
+        rows = {r.task: r for r in rows}
+        self.assertEqual(rows['Creating container'].median, 62)
+        self.assertEqual(rows['Creating container'].samples, 4)
+        self.assertTrue(rows['Creating container'].regressed)
+        self.assertFalse(rows['Starting Juju server'].regressed)
+        self.assertIsNone(rows['Copying data'].median)
+
+        report = format_report(*self.store.compare())
+        self.assertIn('slower than usual: Creating container', report)
+
+    def test_report_with_missing_facts(self):
+        self.add_run('r1', [('Creating container', 60)])
+        # an entry written without any facts at all
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(dict(run='r2', task='Copying data',
+                                    start=0, duration=5)) + "\n")
+        self.add_run('r2', [('Creating container', 60)],
+                     facts={'install_type': 'single', 'cores': 4})
+        report = format_report(*self.store.compare())
+        self.assertIn('Install r2 (single, 4 cores, ? MB RAM, ? nodes)',
+                      report)
+
+    def test_empty_store(self):
+        self.assertEqual(format_report(*self.store.compare()),
+                         "No install timings recorded yet.")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# tests trace.py
+#
+# Copyright 2014 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import unittest
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+
+from cloudinstall.trace import Tracer, TracedClient
+
+
+class FakeClient:
+    nodes = ['a']
+
+    def status(self):
+        return 'ok'
+
+
+class TracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer()
+        self.tracer.enabled = True
+
+    def test_disabled_records_nothing(self):
+        t = Tracer()
+        with t.span('x', 'test'):
+            pass
+        self.assertEqual(list(t.events), [])
+
+    def test_oldest_events_dropped(self):
+        with patch('cloudinstall.trace.MAX_EVENTS', 3):
+            t = Tracer()
+        t.enabled = True
+        for i in range(5):
+            t.instant(str(i), 'test')
+        self.assertEqual([e['name'] for e in t.events], ['2', '3', '4'])
+
+    def test_span_and_write(self):
+        with self.tracer.span('deploy mysql', 'deploy', machine='1'):
+            pass
+        self.tracer.instant('mysql/0 started', 'unit')
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'test.trace.json')
+            self.tracer.write(filename)
+            with open(filename) as f:
+                trace = json.load(f)
+
+        events = trace['traceEvents']
+        meta = [e for e in events if e['ph'] == 'M']
+        self.assertEqual(meta[0]['args']['name'],
+                         threading.current_thread().name)
+        span = next(e for e in events if e['ph'] == 'X')
+        self.assertEqual(span['name'], 'deploy mysql')
+        self.assertEqual(span['args'], {'machine': '1'})
+        self.assertEqual(span['tid'], threading.current_thread().ident)
+        self.assertTrue(span['dur'] >= 0)
+        self.assertEqual(len([e for e in events if e['ph'] == 'i']), 1)
+
+    def test_traced_client(self):
+        import cloudinstall.trace as trace
+        orig, trace.tracer = trace.tracer, self.tracer
+        try:
+            c = TracedClient(FakeClient(), 'juju')
+            self.assertEqual(c.status(), 'ok')
+            self.assertEqual(c.nodes, ['a'])
+        finally:
+            trace.tracer = orig
+        self.assertEqual([e['name'] for e in self.tracer.events],
+                         ['juju.status'])